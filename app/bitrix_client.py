@@ -0,0 +1,444 @@
+# app/bitrix_client.py
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+from urllib.parse import quote
+
+import httpx
+
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class BitrixError(RuntimeError):
+    """Ошибка, которую вернул REST Битрикса (поле error в ответе)."""
+
+    def __init__(self, method: str, code: str, description: str = ""):
+        super().__init__(f"{method}: {code} {description}".strip())
+        self.method = method
+        self.code = code
+        self.description = description
+
+# Полосы приоритета: запросы, которых ждёт человек, обгоняют фоновые
+INTERACTIVE = 0
+BACKGROUND = 1
+LANES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("bitrix_priority", default=INTERACTIVE)
+
+@contextmanager
+def priority(lane: int) -> Iterator[None]:
+    """
+    Все вызовы Битрикса внутри блока (в том числе из вложенных функций)
+    идут в полосе lane:
+
+        with priority(BACKGROUND):
+            await send_to_bitrix(order, username)
+    """
+    token = _priority.set(lane)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class RateLimiter:
+    """
+    Token bucket перед вызовами REST: rate запросов в секунду, до burst подряд.
+
+    Когда токенов нет, запрос встаёт в очередь-кучу по (полоса, номер в
+    очереди): интерактивные запросы выходят раньше фоновых, внутри полосы —
+    строго в порядке поступления. Очередь разбирает одна задача, выдавая
+    токены по мере их накопления.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._drainer: Optional[asyncio.Task] = None
+        self._depth = {lane: 0 for lane in LANES}
+        self._waited = {lane: 0.0 for lane in LANES}
+        self._granted = {lane: 0 for lane in LANES}
+
+    def configure(self, rate: float, burst: int) -> None:
+        """Меняет лимит на ходу (доля процесса в общем лимите портала, см. app/rate_share.py)."""
+        self._refill()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = min(self._tokens, float(burst))
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, lane: int = INTERACTIVE) -> float:
+        """Ждёт токен; возвращает время ожидания в секундах."""
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            self._granted[lane] += 1
+            return 0.0
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), future))
+        self._depth[lane] += 1
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain(), name="bitrix-rate-limiter")
+        try:
+            await future
+        finally:
+            self._depth[lane] -= 1
+        waited = time.monotonic() - started
+        self._waited[lane] += waited
+        self._granted[lane] += 1
+        return waited
+
+    async def _drain(self) -> None:
+        while self._waiters:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # ожидающий отменён — токен не тратим
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            name: {
+                "queued":      self._depth[lane],
+                "granted":     self._granted[lane],
+                "avg_wait_ms": round(self._waited[lane] / self._granted[lane] * 1000, 1)
+                               if self._granted[lane] else 0.0,
+            }
+            for lane, name in LANES.items()
+        }
+
+class BitrixBatchError(BitrixError):
+    """Одна или несколько команд batch завершились ошибкой."""
+
+    def __init__(self, errors: dict[str, Any], results: dict[str, Any]):
+        first = next(iter(errors.values()), {})
+        code = first.get("error", "BATCH_ERROR") if isinstance(first, dict) else "BATCH_ERROR"
+        super().__init__("batch", str(code), f"failed commands: {', '.join(errors)}")
+        self.errors = errors
+        self.results = results
+
+def encode_query(params: Any, prefix: str = "") -> str:
+    """
+    Кодирует параметры в строку запроса в формате PHP http_build_query
+    (fields[PHONE][0][VALUE]=…), как их ждут команды batch.
+    Ссылки вида $result[name] остаются ссылками: Битрикс подставляет
+    их после разбора строки.
+    """
+    if isinstance(params, dict):
+        items = params.items()
+    elif isinstance(params, (list, tuple)):
+        items = enumerate(params)
+    else:
+        return f"{prefix}={quote(_scalar(params), safe='')}"
+
+    parts = []
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        part = encode_query(value, name)
+        if part:
+            parts.append(part)
+    return "&".join(parts)
+
+def _scalar(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+class BitrixBatch:
+    """
+    Несколько вызовов REST одним HTTP-запросом (метод batch, до 50 команд).
+    Команды выполняются по порядку; результат предыдущей доступен
+    следующим через ref("name") → "$result[name]".
+
+        batch = BitrixBatch()
+        batch.add("company", "crm.company.add", {"fields": {...}})
+        batch.add("deal", "crm.deal.add", {"fields": {"COMPANY_ID": batch.ref("company")}})
+        results = await batch.execute(bitrix)
+        results["deal"]  # ID сделки
+    """
+
+    MAX_COMMANDS = 50
+
+    def __init__(self, halt: bool = True):
+        self.halt = halt
+        self._commands: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def add(self, name: str, method: str, params: Optional[dict] = None) -> "BitrixBatch":
+        if name in self._commands:
+            raise ValueError(f"Duplicate batch command name: {name}")
+        if len(self._commands) >= self.MAX_COMMANDS:
+            raise ValueError(f"Bitrix batch is limited to {self.MAX_COMMANDS} commands")
+        query = encode_query(params or {})
+        self._commands[name] = f"{method}?{query}" if query else method
+        return self
+
+    @staticmethod
+    def ref(name: str, path: str = "") -> str:
+        """Ссылка на результат команды name (path — вложенный ключ, например «ID»)."""
+        return f"$result[{name}]" + "".join(f"[{p}]" for p in path.split(".") if p)
+
+    def build(self) -> dict:
+        return {"halt": 1 if self.halt else 0, "cmd": dict(self._commands)}
+
+    async def execute(self, client: "BitrixClient") -> dict[str, Any]:
+        """
+        Выполняет команды и возвращает {name: result}.
+        :raises BitrixBatchError: хотя бы одна команда вернула ошибку
+                                  (в .results — то, что успело выполниться)
+        """
+        if not self._commands:
+            return {}
+        payload = await client.call("batch", self.build()) or {}
+        results = payload.get("result") or {}
+        errors = payload.get("result_error") or {}
+        # пустые коллекции PHP приходят списком
+        if isinstance(results, list):
+            results = dict(enumerate(results))
+        if isinstance(errors, list):
+            errors = dict(enumerate(errors))
+        if errors:
+            raise BitrixBatchError(errors, results)
+        return results
+
+class MethodStats:
+    __slots__ = ("calls", "errors", "retries", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls":   self.calls,
+            "errors":  self.errors,
+            "retries": self.retries,
+            "avg_ms":  round(self.total / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_ms":  round(self.max * 1000, 1),
+        }
+
+class BitrixClient:
+    """
+    Общий на процесс клиент REST-вебхука Битрикс24.
+
+    Один httpx.AsyncClient с пулом keep-alive соединений и HTTP/2 —
+    запросы не платят за новый TCP+TLS хендшейк. Для каждого метода свой
+    таймаут (генерация документов заметно медленнее CRUD), при 5xx, сетевых
+    ошибках и QUERY_LIMIT_EXCEEDED запрос повторяется с экспоненциальной
+    задержкой (*.add и batch — только если запрос заведомо не дошёл).
+    Каждая попытка проходит через RateLimiter, чтобы не упираться
+    в QUERY_LIMIT_EXCEEDED. По каждому методу копится статистика задержек,
+    по полосам лимитера — глубина очереди и ожидание (stats()).
+    """
+
+    # Коды ошибок REST, после которых идемпотентный запрос имеет смысл повторить
+    RETRY_ERRORS = {"QUERY_LIMIT_EXCEEDED", "INTERNAL_SERVER_ERROR"}
+
+    # Таймауты, отличные от BITRIX_TIMEOUT
+    TIMEOUTS = {
+        "crm.documentgenerator.document.add": 30.0,
+        "crm.documentgenerator.document.get.json": 20.0,
+        "batch": 30.0,
+    }
+
+    def __init__(self, base_url: str, timeout: float, max_connections: int, retries: int, backoff: float,
+                 limiter: RateLimiter):
+        self.base_url = base_url
+        self.limiter = limiter
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats: dict[str, MethodStats] = {}
+
+    async def start(self) -> None:
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=True,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+        )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            "methods": {method: s.as_dict() for method, s in self._stats.items()},
+            "limiter": self.limiter.stats(),
+        }
+
+    async def call(self, method: str, params: Optional[dict] = None) -> Any:
+        """
+        Вызывает метод REST и возвращает поле result ответа.
+        :raises BitrixError: Битрикс вернул error (после исчерпания повторов)
+        :raises httpx.HTTPError: сетевая ошибка или не-2xx ответ
+        """
+        if self._client is None:
+            # вызов вне жизненного цикла приложения (скрипт, задача) — поднимаем пул лениво
+            await self.start()
+
+        stats = self._stats.setdefault(method, MethodStats())
+        timeout = self.TIMEOUTS.get(method, self.timeout)
+        lane = _priority.get()
+        started = time.monotonic()
+        waited = 0.0  # время в очереди лимитера в задержку метода не входит
+        attempt = 0
+        try:
+            while True:
+                waited += await self.limiter.acquire(lane)
+                try:
+                    return await self._request(method, params or {}, timeout)
+                except (BitrixError, httpx.HTTPError) as e:
+                    if attempt >= self.retries or not self._retryable(method, e):
+                        stats.errors += 1
+                        raise
+                    delay = self.backoff * 2 ** attempt * (1 + random.random())
+                    attempt += 1
+                    stats.retries += 1
+                    logger.warning("Bitrix %s failed (%s), retry %s in %.1fs", method, e, attempt, delay)
+                    await asyncio.sleep(delay)
+        finally:
+            elapsed = time.monotonic() - started - waited
+            stats.calls += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            logger.info("Bitrix %s took %.0f ms", method, elapsed * 1000)
+
+    async def _request(self, method: str, params: dict, timeout: float) -> Any:
+        resp = await self._client.post(method, json=params, timeout=timeout)
+        try:
+            payload = resp.json()
+        except ValueError:
+            payload = None
+
+        # Битрикс отдаёт ошибки REST и с 4xx/5xx, и с 200 — смотрим в тело
+        if isinstance(payload, dict) and "error" in payload:
+            raise BitrixError(method, str(payload["error"]), payload.get("error_description", ""))
+        resp.raise_for_status()
+        if not isinstance(payload, dict):
+            raise BitrixError(method, "BAD_RESPONSE", resp.text[:200])
+        return payload.get("result")
+
+    def _retryable(self, method: str, e: Exception) -> bool:
+        # запрос точно не выполнен: лимит, 503 от балансировщика, соединение не установлено
+        if isinstance(e, BitrixError):
+            return e.code == "QUERY_LIMIT_EXCEEDED" or (
+                e.code in self.RETRY_ERRORS and self._idempotent(method)
+            )
+        if isinstance(e, httpx.HTTPStatusError):
+            status = e.response.status_code
+            return status == 503 or (status >= 500 and self._idempotent(method))
+        if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return True
+        # таймаут чтения / обрыв: *.add мог выполниться — повтор создал бы дубль
+        return isinstance(e, httpx.TransportError) and self._idempotent(method)
+
+    @staticmethod
+    def _idempotent(method: str) -> bool:
+        return method != "batch" and not method.endswith(".add")
+
+class DealUpdate:
+    """
+    Накопитель изменений одной сделки на время обработки апдейта.
+
+    Хендлер может несколько раз вызвать set() (и set_product_rows()),
+    а в Битрикс уходит один crm.deal.update — или один batch из update
+    и crm.deal.productrows.set, если менялись и товарные позиции:
+
+        async with DealUpdate(deal_id) as deal:
+            deal.set({"UF_CRM_…": qty, "OPPORTUNITY": cost})
+            …
+            deal.set({"STAGE_ID": "C2:PREPAYMENT_INVOICE"})
+
+    Ошибки отправки логируются и не пробрасываются — как и раньше
+    в хендлерах водителя, где обновление сделки было «best effort».
+    """
+
+    def __init__(self, deal_id, client: "BitrixClient" = None):
+        self.deal_id = deal_id
+        self.client = client or bitrix
+        self.fields: dict[str, Any] = {}
+        self.rows: Optional[list[dict]] = None
+
+    def set(self, fields: dict) -> None:
+        self.fields.update(fields)
+
+    def set_product_rows(self, rows: list[dict]) -> None:
+        self.rows = rows
+
+    async def flush(self) -> bool:
+        """Отправляет накопленное; True, если отправлять было нечего или всё прошло."""
+        fields, rows = self.fields, self.rows
+        self.fields, self.rows = {}, None
+        try:
+            if fields and rows is not None:
+                batch = BitrixBatch()
+                batch.add("update", "crm.deal.update", {"id": self.deal_id, "fields": fields})
+                batch.add("rows", "crm.deal.productrows.set", {"id": self.deal_id, "rows": rows})
+                await batch.execute(self.client)
+            elif fields:
+                await self.client.call("crm.deal.update", {"id": self.deal_id, "fields": fields})
+            elif rows is not None:
+                await self.client.call("crm.deal.productrows.set", {"id": self.deal_id, "rows": rows})
+        except (BitrixError, httpx.HTTPError) as e:
+            logger.error("Bitrix deal %s update failed: %s (fields=%s)", self.deal_id, e, fields)
+            return False
+        return True
+
+    async def __aenter__(self) -> "DealUpdate":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        # уже накопленные изменения отправляем, даже если блок упал дальше
+        await self.flush()
+
+bitrix = BitrixClient(
+    settings.BITRIX_WEBHOOK_URL,
+    settings.BITRIX_TIMEOUT,
+    settings.BITRIX_MAX_CONNECTIONS,
+    settings.BITRIX_RETRIES,
+    settings.BITRIX_BACKOFF,
+    RateLimiter(
+        settings.BITRIX_RATE / settings.BITRIX_PROCESSES,
+        max(1, settings.BITRIX_BURST // settings.BITRIX_PROCESSES),
+    ),
+)
@@ -0,0 +1,194 @@
+# app/capacity.py
+
+import asyncio
+import logging
+from datetime import date, datetime
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from app.config import get_settings
+from app.db import capacity_collection, orders_collection
+from app.schedule import schedule_index
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+def load_units(cargo_type: str, quantity: int) -> int:
+    """Сколько места в машине занимает груз, в коробах (палета = BOXES_PER_PALLET коробов)."""
+    if cargo_type == "pallets":
+        return quantity * settings.BOXES_PER_PALLET
+    return quantity
+
+def day_capacity(warehouse: str) -> int:
+    pallets = settings.CAPACITY_BY_WAREHOUSE.get(warehouse, settings.CAPACITY_PALLETS_PER_DAY)
+    return pallets * settings.BOXES_PER_PALLET
+
+class CapacityBook:
+    """
+    Вместимость машин по складу и дате сдачи.
+
+    На каждую пару склад + дата — документ в коллекции capacity
+    ({capacity, booked} в коробах, палета = BOXES_PER_PALLET коробов).
+    Документ создаётся при первой брони с вместимостью из настроек;
+    чтобы поменять вместимость конкретного дня, достаточно поправить
+    его capacity в Mongo.
+
+    Бронь при отправке заявки — условный $inc (booked + груз ≤ capacity),
+    поэтому параллельные заявки не переполнят машину. Что и сколько
+    забронировано, запоминается в заказе (capacity_booking): повторная
+    отправка не бронирует дважды, отмена освобождает ровно то, что заняли.
+
+    Остаток места по дням держится в памяти (карта room): заполненные
+    дни убираются из календаря дат (schedule_index), а дни, где места
+    меньше, чем занимает груз заказа, не предлагаются этому заказу
+    (remaining). Карта обновляется при своих бронях и раз в poll_interval
+    секунд из Mongo — для броней других процессов.
+
+    Бронь заказа, который так и не ушёл в outbox (ошибка при отправке,
+    «Начать заново»), снимается через release(..., unsubmitted_only=True).
+    """
+
+    def __init__(self, collection, orders, poll_interval: float):
+        self.collection = collection
+        self.orders = orders
+        self.poll_interval = poll_interval
+        self.room: dict[tuple[str, date], int] = {}
+        self.full: set[tuple[str, date]] = set()
+        self._poll_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(warehouse: str, day: date) -> str:
+        return f"{warehouse}:{day.isoformat()}"
+
+    async def start(self) -> None:
+        try:
+            await self.refresh()
+        except PyMongoError as e:
+            logger.error("Cannot load capacity map: %s", e)
+        self._poll_task = asyncio.create_task(self._poll(), name="capacity-poll")
+
+    async def stop(self) -> None:
+        if self._poll_task:
+            self._poll_task.cancel()
+            await asyncio.gather(self._poll_task, return_exceptions=True)
+            self._poll_task = None
+
+    def remaining(self, warehouse: str, day: date) -> int:
+        """Свободное место на склад + дату, в коробах (по последней известной карте)."""
+        return self.room.get((warehouse, day), day_capacity(warehouse))
+
+    async def reserve(self, order: dict) -> bool:
+        """
+        Бронирует место под груз заказа на его склад и дату сдачи.
+        False — места не хватает (заказ не тронут).
+        """
+        if order.get("capacity_booking"):
+            return True
+        warehouse = order["warehouse"]
+        day = date.fromisoformat(order["delivery_date"])
+        units = load_units(order.get("cargo_type"), order.get("cargo_quantity", 0))
+        key = self._key(warehouse, day)
+        booking = {"key": key, "units": units}
+
+        # заказ «застолбляем» первым — двойное нажатие не забронирует дважды
+        claimed = await self.orders.update_one(
+            {"_id": order["_id"], "capacity_booking": {"$exists": False}},
+            {"$set": {"capacity_booking": booking}}
+        )
+        if not claimed.modified_count:
+            return True
+
+        try:
+            await self._ensure_day(key, warehouse, day)
+            res = await self.collection.update_one(
+                {"_id": key, "$expr": {"$lte": [{"$add": ["$booked", units]}, "$capacity"]}},
+                {"$inc": {"booked": units}, "$set": {"updated_at": datetime.utcnow()}}
+            )
+        except Exception:
+            # место не заняли — снимаем отметку, иначе release() вычтет то, чего не прибавляли
+            await self.orders.update_one({"_id": order["_id"]}, {"$unset": {"capacity_booking": ""}})
+            raise
+        if not res.modified_count:
+            await self.orders.update_one({"_id": order["_id"]}, {"$unset": {"capacity_booking": ""}})
+            logger.info("Capacity: %s has no room for %s units (order %s)", key, units, order["_id"])
+            await self._sync_day(key, warehouse, day)
+            return False
+
+        order["capacity_booking"] = booking
+        await self._sync_day(key, warehouse, day)
+        return True
+
+    async def release(self, order_id, unsubmitted_only: bool = False) -> bool:
+        """
+        Освобождает бронь заказа (если была). True — что-то освободили.
+        unsubmitted_only — только если заказ не поставлен в outbox (брошенная заявка).
+        """
+        query = {"_id": order_id, "capacity_booking": {"$exists": True}}
+        if unsubmitted_only:
+            query["sync_status"] = {"$exists": False}
+        order = await self.orders.find_one_and_update(query, {"$unset": {"capacity_booking": ""}})
+        if order is None:
+            return False
+        booking = order["capacity_booking"]
+        await self.collection.update_one(
+            {"_id": booking["key"]},
+            {"$inc": {"booked": -booking["units"]}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+        warehouse, day = booking["key"].rsplit(":", 1)
+        await self._sync_day(booking["key"], warehouse, date.fromisoformat(day))
+        logger.info("Capacity: released %s units on %s (order %s)", booking["units"], booking["key"], order_id)
+        return True
+
+    async def refresh(self) -> None:
+        """Перечитывает остаток места по дням начиная с сегодняшнего."""
+        room = {}
+        cursor = self.collection.find(
+            {"date": {"$gte": date.today().isoformat()}},
+            {"warehouse": 1, "date": 1, "booked": 1, "capacity": 1},
+        )
+        async for doc in cursor:
+            room[(doc["warehouse"], date.fromisoformat(doc["date"]))] = doc["capacity"] - doc["booked"]
+        self._set_room(room)
+
+    async def _ensure_day(self, key: str, warehouse: str, day: date) -> None:
+        try:
+            await self.collection.update_one(
+                {"_id": key},
+                {"$setOnInsert": {
+                    "warehouse": warehouse,
+                    "date":      day.isoformat(),
+                    "capacity":  day_capacity(warehouse),
+                    "booked":    0,
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # документ одновременно создал другой запрос
+            pass
+
+    async def _sync_day(self, key: str, warehouse: str, day: date) -> None:
+        doc = await self.collection.find_one({"_id": key}, {"booked": 1, "capacity": 1})
+        room = dict(self.room)
+        if doc:
+            room[(warehouse, day)] = doc["capacity"] - doc["booked"]
+        else:
+            room.pop((warehouse, day), None)
+        self._set_room(room)
+
+    def _set_room(self, room: dict[tuple[str, date], int]) -> None:
+        self.room = room
+        full = {key for key, left in room.items() if left <= 0}
+        if full != self.full:
+            self.full = full
+            schedule_index.set_blocked(full)
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.refresh()
+            except PyMongoError as e:
+                logger.warning("Capacity map refresh failed: %s", e)
+
+capacity = CapacityBook(capacity_collection, orders_collection, settings.CAPACITY_POLL_INTERVAL)
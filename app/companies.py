@@ -0,0 +1,116 @@
+# app/companies.py
+
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from httpx import HTTPError
+
+from app.bitrix_client import bitrix, BitrixError
+from app.cache import LRUCache
+from app.config import get_settings
+from app.db import bitrix_companies_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+def _is_not_found(error: BitrixError) -> bool:
+    """crm.*.get по несуществующему ID: ERROR_NOT_FOUND или пустой код с «Not found»."""
+    return error.code == "ERROR_NOT_FOUND" or "not found" in error.description.lower()
+
+class CompanyCache:
+    """
+    Соответствие ИНН + название организации → company_id / requisite_id в Битриксе.
+
+    Записи хранятся в коллекции bitrix_companies (общие для всех воркеров),
+    перед ней — LRU в памяти. Запись создаётся, когда компания найдена
+    через crm.company.list или создана при отправке заявки. Запись старше
+    revalidate_after при следующем обращении перепроверяется через
+    crm.company.get: если компанию удалили в CRM, запись выбрасывается.
+    """
+
+    def __init__(self, collection, client, maxsize: int, revalidate_after: int):
+        self.collection = collection
+        self.client = client
+        self.revalidate_after = timedelta(seconds=revalidate_after)
+        self._local = LRUCache(maxsize)
+
+    @staticmethod
+    def _key(inn: str, org_name: str) -> str:
+        return f"{inn}:{org_name}"
+
+    async def lookup(self, inn: str, org_name: str) -> Optional[dict]:
+        """
+        Возвращает {"company_id", "requisite_id"} или None, если компании
+        в Битриксе нет (тогда её нужно создать и передать в remember()).
+        """
+        key = self._key(inn, org_name)
+        entry = self._local.get(key)
+        if entry is None:
+            entry = await self.collection.find_one({"_id": key})
+
+        if entry is not None:
+            if datetime.utcnow() - entry["checked_at"] < self.revalidate_after:
+                self._local.set(key, entry)
+                return entry
+            exists = await self._still_exists(entry)
+            if exists is None:
+                # проверить не удалось — отдаём запись, checked_at не трогаем
+                self._local.set(key, entry)
+                return entry
+            if exists:
+                return await self._save(key, inn, org_name, entry["company_id"], entry.get("requisite_id"))
+            logger.info("Bitrix company %s for %s is gone, dropping cache entry", entry["company_id"], key)
+            await self.forget(inn, org_name)
+
+        # — crm.company.list: компания могла появиться в CRM без бота
+        payload = {"filter": {"TITLE": org_name}, "select": ["ID"]}
+        logger.info("Bitrix → crm.company.list: %s", payload)
+        items = await self.client.call("crm.company.list", payload) or []
+        if not items:
+            return None
+        return await self._save(key, inn, org_name, items[0]["ID"], None)
+
+    async def remember(self, inn: str, org_name: str, company_id, requisite_id=None) -> dict:
+        return await self._save(self._key(inn, org_name), inn, org_name, company_id, requisite_id)
+
+    async def forget(self, inn: str, org_name: str) -> None:
+        key = self._key(inn, org_name)
+        self._local.pop(key)
+        await self.collection.delete_one({"_id": key})
+
+    async def _still_exists(self, entry: dict) -> Optional[bool]:
+        """True — компания есть, False — удалена, None — проверить не удалось."""
+        try:
+            company = await self.client.call("crm.company.get", {"id": entry["company_id"]})
+        except BitrixError as e:
+            if _is_not_found(e):
+                return False
+            # лимит запросов и прочие ошибки — не повод считать компанию удалённой
+            logger.warning("Bitrix company revalidation failed: %s", e)
+            return None
+        except HTTPError as e:
+            # Битрикс недоступен — доверяем записи, проверим в следующий раз
+            logger.warning("Bitrix company revalidation failed: %s", e)
+            return None
+        return bool(company)
+
+    async def _save(self, key: str, inn: str, org_name: str, company_id, requisite_id) -> dict:
+        entry = {
+            "_id":          key,
+            "inn":          inn,
+            "org_name":     org_name,
+            "company_id":   str(company_id),
+            "requisite_id": str(requisite_id) if requisite_id else None,
+            "checked_at":   datetime.utcnow(),
+        }
+        await self.collection.replace_one({"_id": key}, entry, upsert=True)
+        self._local.set(key, entry)
+        return entry
+
+companies = CompanyCache(
+    bitrix_companies_collection,
+    bitrix,
+    settings.BITRIX_COMPANY_CACHE_SIZE,
+    settings.BITRIX_COMPANY_REVALIDATE,
+)
@@ -11,12 +11,41 @@ class Settings(BaseModel):
 
     # Bitrix24
     BITRIX_WEBHOOK_URL: str = "https://XXXXX.bitrix24.ru/rest/1/XXXXX/"
+    BITRIX_TIMEOUT: float = 10.0
+    BITRIX_MAX_CONNECTIONS: int = 20
+    BITRIX_RETRIES: int = 3
+    BITRIX_BACKOFF: float = 0.5
+    # Лимит вебхука Битрикса (запросов/с и размер «пачки») на весь портал;
+    # делится поровну между живыми процессами (см. app/rate_share.py).
+    # BITRIX_PROCESSES — число процессов до первого подсчёта и при недоступной
+    # базе, должно совпадать с --workers в start.sh
+    BITRIX_RATE: float = 2.0
+    BITRIX_BURST: int = 10
+    BITRIX_PROCESSES: int = 2
+    # Как часто (сек) процесс отмечается в коллекции bitrix_processes
+    BITRIX_HEARTBEAT: float = 10.0
+    # Кэш ID компаний Битрикса по ИНН: размер LRU и через сколько секунд
+    # запись перепроверяется через crm.company.get
+    BITRIX_COMPANY_CACHE_SIZE: int = 2000
+    BITRIX_COMPANY_REVALIDATE: int = 7 * 24 * 3600
 
     # MongoDB
     MONGODB_URI: str = "mongodb://XXXXX/?authSource=admin"
 
     # Dadata
     DADATA_TOKEN: str = "XXXXX"
+    DADATA_TIMEOUT: float = 5.0
+    # Кэш организаций по ИНН: размер LRU, срок жизни записи, через сколько
+    # секунд её перечитывать в фоне, сколько помнить «не найдено» и сколько
+    # ещё хранить протухшую запись на случай недоступности Dadata
+    DADATA_CACHE_SIZE: int = 5000
+    DADATA_TTL: int = 30 * 24 * 3600
+    DADATA_REFRESH_AFTER: int = 7 * 24 * 3600
+    DADATA_NEGATIVE_TTL: int = 24 * 3600
+    DADATA_STALE_GRACE: int = 90 * 24 * 3600
+
+    # Справочник БИК ЦБ (ED807, XML); пусто — БИК проверяется только по формату
+    BIK_DIRECTORY_PATH: str = ""
 
     # Payments
     PAYKEEPER_TOKEN_URL: str = "https://ecomdelivery.server.paykeeper.ru/info/settings/token/"
@@ -24,6 +53,56 @@ class Settings(BaseModel):
     PAYKEEPER_USER: str = "payment"
     PAYKEEPER_PASSWORD: str = "XXXXX"
     PAYKEEPER_SECRET: str = "XXXXX"
+    PAYKEEPER_TIMEOUT: float = 10.0
+    # Сколько секунд считаем токен PayKeeper действительным
+    PAYKEEPER_TOKEN_TTL: int = 12 * 3600
+
+    # Очередь входящих апдейтов Telegram
+    UPDATE_WORKERS: int = 16
+    UPDATE_QUEUE_SIZE: int = 10000
+    # Дедупликация апдейтов по update_id
+    UPDATE_DEDUP_CACHE_SIZE: int = 10000
+    UPDATE_DEDUP_TTL: int = 24 * 3600
+
+    # Кэш пользовательских сессий (документы users)
+    SESSION_CACHE_SIZE: int = 5000
+    SESSION_CACHE_TTL: int = 1800
+
+    # Планировщик задач: lease лидера в секундах
+    SCHEDULER_LEASE_SECONDS: int = 60
+
+    # Outbox синхронизации заявок с Битриксом
+    OUTBOX_WORKERS: int = 4
+    OUTBOX_POLL_INTERVAL: float = 5.0
+    OUTBOX_LEASE_SECONDS: int = 120
+    OUTBOX_MAX_ATTEMPTS: int = 12
+    OUTBOX_BACKOFF: float = 5.0
+    OUTBOX_BACKOFF_MAX: float = 900.0
+
+    # Счета Битрикса: lease генерации одного счёта (сек), период и размер
+    # пачки фонового «догоняющего» прохода
+    INVOICE_LEASE_SECONDS: int = 60
+    INVOICE_SWEEP_MINUTES: int = 5
+    INVOICE_SWEEP_BATCH: int = 20
+
+    # Как часто (сек) проверять, не появилась ли новая версия тарифов
+    TARIFFS_POLL_INTERVAL: float = 30.0
+
+    # Вместимость машин на склад в день (в палетах; короба пересчитываются
+    # по BOXES_PER_PALLET), исключения по складам и период опроса карты
+    # заполненных дней
+    CAPACITY_PALLETS_PER_DAY: int = 33
+    CAPACITY_BY_WAREHOUSE: dict[str, int] = {}
+    BOXES_PER_PALLET: int = 16
+    CAPACITY_POLL_INTERVAL: float = 30.0
+
+    # Как часто (сек) перечитывать исключения календаря (праздники, закрытия складов)
+    CALENDAR_POLL_INTERVAL: float = 60.0
+
+    # Профили клиентов: сколько вариантов показывать на клавиатуре,
+    # за сколько дней «вес» использования падает вдвое
+    PROFILE_MAX_BUTTONS: int = 10
+    PROFILE_HALF_LIFE_DAYS: int = 30
 
 @lru_cache()
 def get_settings() -> Settings:
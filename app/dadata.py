@@ -0,0 +1,148 @@
+# app/dadata.py
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+import httpx
+
+from app.cache import LRUCache
+from app.config import get_settings
+from app.db import dadata_parties_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+FIND_PARTY_URL = "https://suggestions.dadata.ru/suggestions/api/4_1/rs/findById/party"
+
+def _parse_party(inn: str, suggestions: list) -> Optional[dict]:
+    """Первая подсказка Dadata → {inn, org_name, org_address} (None — не найдено)."""
+    if not suggestions:
+        return None
+    data = suggestions[0]["data"]
+    addr_obj = data.get("address")
+    return {
+        "inn":         inn,
+        "org_name":    data["name"]["full_with_opf"],
+        "org_address": addr_obj["value"] if addr_obj else "— адрес не указан —",
+    }
+
+class PartyLookup:
+    """
+    Поиск организации по ИНН (Dadata findById/party) с кэшем.
+
+    Ответы хранятся в коллекции dadata_parties (общей для всех воркеров),
+    перед ней — LRU в памяти. Запись действует до expires_at, а удаляется
+    TTL-индексом только по purge_at = expires_at + stale_grace.
+    Запись старше refresh_after отдаётся сразу, а в фоне перечитывается
+    из Dadata (refresh-ahead), так что клиент не ждёт, пока запись
+    не протухла совсем. «Не найдено» тоже кэшируется, но на negative_ttl.
+
+    Одновременные запросы одного ИНН ждут один запрос к Dadata.
+    Если Dadata недоступна, отдаётся протухшая запись, когда она есть —
+    в том числе процессом, который её ещё ни разу не читал.
+    """
+
+    def __init__(self, collection, token: str, timeout: float, maxsize: int,
+                 ttl: int, refresh_after: int, negative_ttl: int, stale_grace: int):
+        self.collection = collection
+        self.token = token
+        self.timeout = timeout
+        self.ttl = timedelta(seconds=ttl)
+        self.refresh_after = timedelta(seconds=refresh_after)
+        self.negative_ttl = timedelta(seconds=negative_ttl)
+        self.stale_grace = timedelta(seconds=stale_grace)
+        self._local = LRUCache(maxsize)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._refreshes: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                headers={
+                    "Content-Type":  "application/json",
+                    "Accept":        "application/json",
+                    "Authorization": f"Token {self.token}",
+                },
+            )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def find_party(self, inn: str) -> Optional[dict]:
+        """
+        Возвращает {inn, org_name, org_address} или None, если организация не найдена.
+        :raises httpx.HTTPError: Dadata недоступна и в кэше ничего нет
+        """
+        inn = inn.strip()
+        entry = self._local.get(inn)
+        if entry is None:
+            entry = await self.collection.find_one({"_id": inn})
+
+        now = datetime.utcnow()
+        if entry is not None and entry["expires_at"] > now:
+            self._local.set(inn, entry)
+            if entry["party"] is not None and now - entry["fetched_at"] > self.refresh_after:
+                # не ждём: отдаём кэш, обновляем в фоне
+                task = asyncio.create_task(self._refresh_quietly(inn))
+                self._refreshes.add(task)
+                task.add_done_callback(self._refreshes.discard)
+            return entry["party"]
+
+        try:
+            entry = await self._single_flight(inn)
+        except httpx.HTTPError as e:
+            if entry is None or entry["party"] is None:
+                raise
+            logger.warning("Dadata unavailable, serving stale party for %s: %s", inn, e)
+        return entry["party"]
+
+    async def _refresh_quietly(self, inn: str) -> None:
+        try:
+            await self._single_flight(inn)
+        except Exception as e:
+            logger.warning("Dadata refresh for %s failed: %s", inn, e)
+
+    async def _single_flight(self, inn: str) -> dict:
+        future = self._inflight.get(inn)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(inn))
+            self._inflight[inn] = future
+            future.add_done_callback(lambda _: self._inflight.pop(inn, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, inn: str) -> dict:
+        if self._client is None:
+            await self.start()
+        resp = await self._client.post(FIND_PARTY_URL, json={"query": inn})
+        resp.raise_for_status()
+        party = _parse_party(inn, resp.json().get("suggestions", []))
+
+        now = datetime.utcnow()
+        expires_at = now + (self.ttl if party else self.negative_ttl)
+        entry = {
+            "_id":        inn,
+            "party":      party,
+            "fetched_at": now,
+            "expires_at": expires_at,
+            "purge_at":   expires_at + self.stale_grace,
+        }
+        await self.collection.replace_one({"_id": inn}, entry, upsert=True)
+        self._local.set(inn, entry)
+        return entry
+
+parties = PartyLookup(
+    dadata_parties_collection,
+    settings.DADATA_TOKEN,
+    settings.DADATA_TIMEOUT,
+    settings.DADATA_CACHE_SIZE,
+    settings.DADATA_TTL,
+    settings.DADATA_REFRESH_AFTER,
+    settings.DADATA_NEGATIVE_TTL,
+    settings.DADATA_STALE_GRACE,
+)
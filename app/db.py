@@ -9,3 +9,14 @@ db = client["ecom"]
 users_collection = db["users"]
 orders_collection = db["orders"]
 calcs_collection = db["calcs"]
+updates_collection = db["updates"]
+locks_collection = db["locks"]
+job_runs_collection = db["job_runs"]
+client_profiles_collection = db["client_profiles"]
+bitrix_companies_collection = db["bitrix_companies"]
+outbox_collection = db["outbox"]
+dadata_parties_collection = db["dadata_parties"]
+tariffs_collection = db["tariffs"]
+capacity_collection = db["capacity"]
+calendar_exceptions_collection = db["calendar_exceptions"]
+bitrix_processes_collection = db["bitrix_processes"]
@@ -1,141 +1,43 @@
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, HTTPException
 import logging
+import msgspec
 
 import app.handlers.driver  # Регистрируем хендлеры
-from app.db import users_collection
-from app.handlers.decorators import (
-    COMMAND_HANDLERS,
-    STATE_HANDLERS,
-    CALLBACK_HANDLERS,
-    CALLBACK_PREFIXES
-)
-import app.services as svc  # для send_text
+from app.handlers.decorators import Dispatcher
+from app.telegram import decode_update
+from app.updates import update_queue, update_dedup
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+dispatcher = Dispatcher("driver")
+
 @router.post("/driver")
 async def driver_webhook(request: Request):
-    data = await request.json()
-    logger.info("[DRIVER] incoming: %s", data)
-
-    bot_type = "driver"
-
-    # === обработка callback-кнопок ===
-    callback = data.get("callback_query")
+    try:
+        update = decode_update(await request.body())
+    except msgspec.DecodeError as e:
+        logger.warning("[DRIVER] bad update: %s", e)
+        return {"ok": False, "reason": "bad update"}
+    logger.debug("[DRIVER] update %s", update.update_id)
+
+    # Повтор уже принятого апдейта — подтверждаем, но не обрабатываем
+    if await update_dedup.is_duplicate("driver", update.update_id):
+        return {"ok": True}
+
+    # Отвечаем Telegram сразу, обработка — в фоновой очереди чата
+    callback = update.callback_query
     if callback:
-        chat_id = callback["from"]["id"]
-        data_text = callback.get("data", "").strip()
-
-        user = await users_collection.find_one({"chat_id": chat_id, "type": bot_type})
-        state = user.get("state") if user else None
-
-        # 🔒 если водитель в ожидании ворот — блокируем все коллбеки
-        if state == "awaiting_gate":
-            deal_id = user.get("active_deal_id")
-            await svc.send_text(
-                chat_id,
-                f"Для завершения заявки #{deal_id} введите номер ворот:",
-                svc.driver_bot
-            )
-            return {"ok": True}
-
-        # 🔒 Если водитель в ожидании qty — блокируем любые коллбеки
-        if state == "awaiting_final_qty":
-            deal_id = user.get("active_deal_id")
-            order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
-            cargo_type = order.get("cargo_type", "boxes")
-            unit_label = "коробов" if cargo_type == "boxes" else "палет"
-            await svc.send_text(
-                chat_id,
-                f"❗ Введите итоговое количество {unit_label} для заявки #{deal_id} (целое число)",
-                svc.driver_bot
-            )
-            return {"ok": True}
-
-        handler = CALLBACK_HANDLERS.get(bot_type, {}).get(data_text)
-        handler = CALLBACK_HANDLERS.get(bot_type, {}).get(data_text)
-
-        if handler is None:
-            for prefix, h in CALLBACK_PREFIXES.get(bot_type, []):
-                if data_text.startswith(prefix):
-                    handler = h
-                    break
-        if handler:
-            await handler(chat_id, user, callback)
-            return {"ok": True}
-        else:
-            logger.info("No callback handler for: %s", data_text)
-            return {"ok": False, "reason": "no handler"}
-
-    # === обычное сообщение ===
-    message = data.get("message")
-    if message:
-        chat_id = message.get("chat", {}).get("id")
-        if not chat_id:
-            return {"ok": False, "reason": "no chat_id"}
-
-        text = message.get("text", "").strip()
-        if text == "/start":
-            from datetime import datetime
-
-            first_name = message.get("from", {}).get("first_name")
-            last_name = message.get("from", {}).get("last_name")
-            username = message.get("from", {}).get("username")
-
-            existing_user = await users_collection.find_one({"chat_id": chat_id, "type": bot_type})
-            if not existing_user:
-                await users_collection.insert_one({
-                    "type": bot_type,
-                    "chat_id": chat_id,
-                    "created_at": datetime.utcnow(),
-                    "first_name": first_name,
-                    "last_name": last_name,
-                    "username": username,
-                })
-
-            await svc.send_text(
-                chat_id,
-                "✅ Ваш аккаунт успешно добавлен. Теперь заявки будут поступать в этот чат.",
-                svc.driver_bot
-            )
+        chat_id = callback.from_.id
+        submitted = update_queue.submit(chat_id, dispatcher.feed_callback, chat_id, callback)
+    else:
+        message = update.message
+        if not message:
             return {"ok": True}
-        user = await users_collection.find_one({"chat_id": chat_id, "type": bot_type})
-        state = user.get("state") if user else None
-
-        if state == "awaiting_gate":
-            from app.handlers.driver import handle_gate_input
-            await handle_gate_input(chat_id, user, text)
-            return {"ok": True}
-
-        # 🔒 Если водитель в ожидании qty — принимаем только числа
-        if state == "awaiting_final_qty":
-            deal_id = user.get("active_deal_id")
-            if not text.isdigit():
-                order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
-                cargo_type = order.get("cargo_type", "boxes")
-                unit_label = "коробов" if cargo_type == "boxes" else "палет"
-                await svc.send_text(
-                    chat_id,
-                    f"❗ Введите итоговое количество {unit_label} для заявки #{deal_id} (целое число)",
-                    svc.driver_bot
-                )
-                return {"ok": False, "reason": "not a number"}
-
-            # всё валидно — передаём qty в хендлер
-            from app.handlers.driver import handle_final_quantity_input
-            await handle_final_quantity_input(chat_id, user, int(text), deal_id)
-            return {"ok": True}
-
-        # Обычные команды
-        cmd_handler = COMMAND_HANDLERS.get(bot_type, {}).get(text)
-        if cmd_handler:
-            await cmd_handler(chat_id, user, message)
-        else:
-            st_handler = STATE_HANDLERS.get(bot_type, {}).get(state)
-            if st_handler:
-                await st_handler(chat_id, user, text)
-            else:
-                logger.info("No handler for driver state: %s", state)
+        chat_id = message.chat.id
+        submitted = update_queue.submit(chat_id, dispatcher.feed_message, chat_id, message)
 
+    if not submitted:
+        await update_dedup.forget("driver", update.update_id)
+        raise HTTPException(status_code=503, detail="update queue is full")
     return {"ok": True}
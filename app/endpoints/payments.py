@@ -4,7 +4,7 @@ import re
 import hashlib
 import logging
 from fastapi import APIRouter, Request, HTTPException
-from httpx import AsyncClient
+from app.bitrix_client import bitrix
 from app.config import get_settings
 from app.db import users_collection
 
@@ -62,16 +62,11 @@ async def payments_hook(request: Request):
         raise HTTPException(status_code=400, detail="Sum mismatch")
 
     # 6) Переводим сделку в Bitrix в стадию C2:WON
-    async with AsyncClient() as client:
-        try:
-            resp = await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.deal.update",
-                json={"id": deal_id, "fields": {"STAGE_ID": "C2:WON"}}
-            )
-            resp.raise_for_status()
-        except Exception as e:
-            logger.error("Bitrix deal.update failed for deal %s: %s", deal_id, e)
-            raise HTTPException(status_code=500, detail="Failed to update Bitrix")
+    try:
+        await bitrix.call("crm.deal.update", {"id": deal_id, "fields": {"STAGE_ID": "C2:WON"}})
+    except Exception as e:
+        logger.error("Bitrix deal.update failed for deal %s: %s", deal_id, e)
+        raise HTTPException(status_code=500, detail="Failed to update Bitrix")
 
     logger.info("Payment hook processed successfully for deal %s", deal_id)
     return {"ok": True}
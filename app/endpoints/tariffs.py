@@ -0,0 +1,45 @@
+# app/endpoints/tariffs.py
+
+import csv
+import io
+import logging
+from typing import Iterator
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from app.tariffs import tariffs, TariffError
+
+router = APIRouter()
+logger = logging.getLogger("tariffs")
+
+@router.get("/tariffs/price-list.csv")
+async def price_list_csv(
+    bot_type: str = Query("delivery", pattern="^(delivery|fulfilment)$"),
+    max_quantity: int = Query(100, ge=1, le=10000),
+):
+    """Прайс-лист действующей версии тарифов: склад × тип поставки × количество."""
+    try:
+        batches = tariffs.price_list(bot_type, max_quantity)
+        first = next(batches, [])
+    except TariffError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    version = tariffs.version
+
+    def rows() -> Iterator[str]:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["warehouse", "cargo_type", "quantity", "cost"])
+        for batch in (first, *batches):
+            writer.writerows(batch)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    filename = f"price-list-{bot_type}-v{version}.csv"
+    return StreamingResponse(
+        rows(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
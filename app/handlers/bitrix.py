@@ -1,12 +1,16 @@
 # app/handlers/bitrix.py
 
 import re
+import logging
+from app.capacity import capacity
 from app.db import users_collection
 import app.services as svc
 from bson import ObjectId
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from html import escape
 
+logger = logging.getLogger(__name__)
+
 bot_by_type = {
     "delivery": svc.delivery_bot,
     "fulfilment": svc.fulfilment_bot
@@ -126,6 +130,9 @@ async def handle_change_driver(params: dict):
     deal_type = order.get("type")
     bot = bot_by_type.get(deal_type)
 
+    # 0. Освобождаем место в машине, занятое заявкой
+    await capacity.release(order["_id"])
+
     # 1. Уведомление водителю
     driver_chat_id = order.get("driver_chat_id")
     if driver_chat_id:
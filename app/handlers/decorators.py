@@ -1,27 +1,45 @@
-from typing import Callable
+import logging
+from typing import Callable, NamedTuple, Optional
 from functools import wraps
 
+from app.sessions import sessions
+from app.telegram import Message, CallbackQuery
+
+logger = logging.getLogger(__name__)
+
 COMMAND_HANDLERS: dict[str, dict[str, Callable]] = {}
-STATE_HANDLERS:   dict[str, dict[str, Callable]] = {}
+STATE_HANDLERS:   dict[str, dict[str, "StateRoute"]] = {}
 CALLBACK_HANDLERS: dict[str, dict[str, Callable]] = {}
 CALLBACK_PREFIXES: dict[str, list[tuple[str, Callable]]] = {}  # ← поддержка префиксов
 
+# Что передаётся в обработчик состояния третьим аргументом
+PAYLOAD_TEXT = "text"        # text сообщения без пробелов по краям
+PAYLOAD_MESSAGE = "message"  # весь Message (нужен, например, для contact)
+PAYLOAD_INT = "int"          # text, приведённый к int; иначе вызывается guard
+
+class StateRoute(NamedTuple):
+    handler: Callable
+    payload: str
+    # guard(chat_id, user) — ответ, когда апдейт не подходит состоянию:
+    # нажата inline-кнопка или payload не приводится к нужному типу
+    guard: Optional[Callable]
+
+def _bot_type(func: Callable) -> str:
+    module_name = func.__module__.split('.')[-1]
+    return module_name.split('_', 1)[0]
+
 def on_command(cmd: str):
     def decorator(func: Callable):
-        module_name = func.__module__.split('.')[-1]
-        bot_type = module_name.split('_', 1)[0]
-        COMMAND_HANDLERS.setdefault(bot_type, {})[cmd] = func
+        COMMAND_HANDLERS.setdefault(_bot_type(func), {})[cmd] = func
         @wraps(func)
         async def wrapper(chat_id, user, message):
             return await func(chat_id, user, message)
         return wrapper
     return decorator
 
-def on_state(state: str):
+def on_state(state: str, payload: str = PAYLOAD_TEXT, guard: Optional[Callable] = None):
     def decorator(func: Callable):
-        module_name = func.__module__.split('.')[-1]
-        bot_type = module_name.split('_', 1)[0]
-        STATE_HANDLERS.setdefault(bot_type, {})[state] = func
+        STATE_HANDLERS.setdefault(_bot_type(func), {})[state] = StateRoute(func, payload, guard)
         @wraps(func)
         async def wrapper(chat_id, user, payload):
             return await func(chat_id, user, payload)
@@ -30,8 +48,7 @@ def on_state(state: str):
 
 def on_callback(data: str):
     def decorator(func: Callable):
-        module_name = func.__module__.split('.')[-1]
-        bot_type = module_name.split('_', 1)[0]
+        bot_type = _bot_type(func)
 
         # если data заканчивается на # — значит это префикс
         if data.endswith("#"):
@@ -44,3 +61,103 @@ def on_callback(data: str):
             return await func(chat_id, user, callback_query)
         return wrapper
     return decorator
+
+def _build_prefix_trie(prefixes: list[tuple[str, Callable]]) -> dict:
+    """
+    Префиксное дерево для callback_data: {символ: узел}, обработчик
+    хранится в узле под ключом None. Поиск — один проход по data.
+    """
+    root: dict = {}
+    for prefix, handler in prefixes:
+        node = root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[None] = handler
+    return root
+
+class Dispatcher:
+    """
+    Маршрутизатор апдейтов одного бота.
+
+    Таблицы команд, состояний и callback-кнопок собираются один раз при создании
+    (после импорта модулей с хендлерами), дальше каждый апдейт разбирается
+    одним поиском в словаре или проходом по префиксному дереву.
+
+    Порядок для сообщений: команда по тексту → обработчик текущего состояния.
+    Для callback: guard текущего состояния (если есть) → точное совпадение → префикс.
+    """
+
+    def __init__(self, bot_type: str):
+        self.bot_type = bot_type
+        self.commands = dict(COMMAND_HANDLERS.get(bot_type, {}))
+        self.states = dict(STATE_HANDLERS.get(bot_type, {}))
+        self.callbacks = dict(CALLBACK_HANDLERS.get(bot_type, {}))
+        self.callback_trie = _build_prefix_trie(CALLBACK_PREFIXES.get(bot_type, []))
+        logger.info(
+            "Compiled %s dispatcher: %s commands, %s states, %s callbacks, %s prefixes",
+            bot_type, len(self.commands), len(self.states),
+            len(self.callbacks), len(CALLBACK_PREFIXES.get(bot_type, [])),
+        )
+
+    async def load_user(self, chat_id: int) -> Optional[dict]:
+        return await sessions.get(chat_id, self.bot_type)
+
+    def match_callback(self, data: str) -> Optional[Callable]:
+        handler = self.callbacks.get(data)
+        if handler is not None:
+            return handler
+        node = self.callback_trie
+        for ch in data:
+            node = node.get(ch)
+            if node is None:
+                break
+            handler = node.get(None, handler)
+        return handler
+
+    async def feed_message(self, chat_id: int, message: Message) -> None:
+        text = message.text.strip()
+        user = await self.load_user(chat_id)
+        state = user.get("state") if user else None
+
+        logger.info("Dispatching %s: text=%r, state=%r", self.bot_type, text, state)
+
+        # Сначала пробуем команду
+        cmd_handler = self.commands.get(text)
+        if cmd_handler:
+            await cmd_handler(chat_id, user, message)
+            return
+
+        # затем — по состоянию
+        route = self.states.get(state)
+        if route is None:
+            logger.info("No handler for %s: cmd=%r state=%r", self.bot_type, text, state)
+            return
+
+        if route.payload == PAYLOAD_MESSAGE:
+            payload = message
+        elif route.payload == PAYLOAD_INT:
+            if not text.isdigit():
+                if route.guard:
+                    await route.guard(chat_id, user)
+                return
+            payload = int(text)
+        else:
+            payload = text
+        await route.handler(chat_id, user, payload)
+
+    async def feed_callback(self, chat_id: int, callback: CallbackQuery) -> None:
+        data = callback.data.strip()
+        user = await self.load_user(chat_id)
+        state = user.get("state") if user else None
+
+        # 🔒 состояние с guard блокирует все inline-кнопки
+        route = self.states.get(state)
+        if route is not None and route.guard:
+            await route.guard(chat_id, user)
+            return
+
+        handler = self.match_callback(data)
+        if handler:
+            await handler(chat_id, user, callback)
+        else:
+            logger.info("No callback handler for %s: %s", self.bot_type, data)
@@ -2,13 +2,22 @@
 import re
 import logging
 from datetime import datetime
-from app.handlers.decorators import on_command, on_state
+from app.handlers.decorators import on_command, on_state, PAYLOAD_MESSAGE
+from app.telegram import Message
+from app.capacity import capacity
+from app.dadata import parties
 from app.db import users_collection
+from app.invoices import invoices
+from app.outbox import outbox
+from app.paykeeper import paykeeper, PayKeeperError
+from app.profiles import profiles
+from app import requisites
+from app.sessions import sessions
+from app.tariffs import tariffs
 from app.db import calcs_collection
 import app.services as svc
 from bson import ObjectId
-from httpx import AsyncClient
-import base64
+from httpx import HTTPError
 from aiogram.enums.chat_action import ChatAction
 from app.config import get_settings
 
@@ -21,20 +30,19 @@ logger = logging.getLogger(__name__)
 async def handle_delivery_start(chat_id, user, message):
     # если пользователя нет — создаём
     if not user:
-        await users_collection.insert_one({
+        await sessions.create({
             "chat_id":    chat_id,
-            "username":   message["chat"].get("username"),
-            "first_name": message["chat"].get("first_name"),
-            "last_name":  message["chat"].get("last_name"),
+            "username":   message.chat.username,
+            "first_name": message.chat.first_name,
+            "last_name":  message.chat.last_name,
             "type":       "delivery",
             "created_at": datetime.utcnow()
         })
     else:
-        # сбрасываем состояние
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": None}}
-        )
+        # сбрасываем состояние; брошенная неотправленная заявка не держит место в машине
+        if user.get("active_order"):
+            await capacity.release(ObjectId(user["active_order"]), unsubmitted_only=True)
+        await sessions.update(chat_id, "delivery", {"state": None})
 
     # 1) Приветствие и выбор действия
     keyboard = {
@@ -52,10 +60,7 @@ async def handle_delivery_start(chat_id, user, message):
     )
 
     # 2) Переходим в состояние "start"
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "start"}}
-    )
+    await sessions.update(chat_id, "delivery", {"state": "start"})
 
 @on_command("📦 Создать новую заявку")
 @on_command("/new")
@@ -63,36 +68,21 @@ async def handle_delivery_new_application(chat_id, user, message):
     # Отправляем вводное сообщение для создания заявки
     await svc.send_intro_message(chat_id)
     # Устанавливаем состояние на ожидание ввода следующих данных
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "awaiting_inn"}}
-    )
+    await sessions.update(chat_id, "delivery", {"state": "awaiting_inn"})
 
 @on_command("📦 Создать заявку")
 async def handle_create_application(chat_id, user, message):
-    # 1) Собираем из прошлых заказов ИНН и «org_name» (ИП / организации)
-    cursor = users_collection.database["orders"].find({"chat_id": chat_id})
-    ips = set()
-    async for order in cursor:
-        if (
-            order.get("inn")
-            and order.get("org_name")
-            and order.get("org_address")
-            and order.get("rs")
-            and order.get("bik")
-        ):
-            ips.add(order["org_name"])
+    # 1) Берём из профиля клиента ИП / организации с полными реквизитами
+    profile = await profiles.get(chat_id)
+    ips = [org["org_name"] for org in profiles.ranked(profile, "orgs")]
 
     if ips:
         # 2a) Есть ИП / организации — предлагаем выбрать или ввести ИНН ИП / компании
-        buttons = [[{"text": name}] for name in sorted(ips)]
+        buttons = [[{"text": name}] for name in ips]
         buttons.append([{"text": "🔄 Начать заново"}])
         keyboard = {"keyboard": buttons, "resize_keyboard": True}
 
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "select_existing_org"}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "select_existing_org"})
         await svc.send_text(
             chat_id,
             "Выберите ИП / организацию из списка или введите ИНН ИП / компании",
@@ -102,10 +92,7 @@ async def handle_create_application(chat_id, user, message):
 
     else:
         # 2b) Нет — сразу просим ИНН ИП / компании
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "awaiting_inn"}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "awaiting_inn"})
         await svc.send_text(
             chat_id,
             "Введите ИНН ИП / компании",
@@ -114,24 +101,28 @@ async def handle_create_application(chat_id, user, message):
 
 @on_state("awaiting_inn")
 async def handle_inn_input(chat_id, user, text):
-    inn = text
-
-    # 1) Запрос к Dadata
-    async with AsyncClient() as client:
-        resp = await client.post(
-            "https://suggestions.dadata.ru/suggestions/api/4_1/rs/findById/party",
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Token {settings.DADATA_TOKEN}"
-            },
-            json={"query": inn}
+    inn = text.strip()
+
+    # 0) Опечатки отсекаем по контрольным цифрам, не тратя запрос к Dadata
+    error = requisites.check_inn(inn)
+    if error:
+        await svc.send_text(chat_id, f"❌ {error} Проверьте ИНН.", svc.delivery_bot)
+        return
+
+    # 1) Организация по ИНН (кэш, при промахе — Dadata)
+    try:
+        party = await parties.find_party(inn)
+    except HTTPError as e:
+        logger.error("Dadata findById/party failed for %s: %s", inn, e)
+        await svc.send_text(
+            chat_id,
+            "❌ Не удалось проверить ИНН. Попробуйте ещё раз чуть позже.",
+            svc.delivery_bot
         )
-    data = resp.json()
-    suggestions = data.get("suggestions", [])
+        return
 
     # 2) Если не нашли — остаёмся в той же стадии
-    if not suggestions:
+    if party is None:
         await svc.send_text(
             chat_id,
             "❌ ИП / компания не найдена. Проверьте ИНН ИП / компании.",
@@ -139,11 +130,9 @@ async def handle_inn_input(chat_id, user, text):
         )
         return  # :contentReference[oaicite:0]{index=0}
 
-    # 3) Берём первую подсказку
-    item       = suggestions[0]
-    org_name   = item["data"]["name"]["full_with_opf"]
-    addr_obj   = item["data"].get("address")
-    org_address = addr_obj["value"] if addr_obj else "— адрес не указан —"
+    # 3) Название и адрес организации
+    org_name    = party["org_name"]
+    org_address = party["org_address"]
 
     # 4) Создаём новый «плоский» заказ с type="delivery"
     order_doc = {
@@ -160,10 +149,7 @@ async def handle_inn_input(chat_id, user, text):
     order_id = str(res.inserted_id)  # :contentReference[oaicite:1]{index=1}
 
     # 5) Сохраняем активный заказ и переключаем состояние
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"active_order": order_id, "state": "confirm_inn"}}
-    )
+    await sessions.update(chat_id, "delivery", {"active_order": order_id, "state": "confirm_inn"})
 
     # 6) Просим подтвердить или ввести другой ИНН
     keyboard = {
@@ -185,23 +171,13 @@ async def handle_select_existing_org(chat_id, user, text):
     # Если ввели цифры — это новый ИНН, перенаправляем в handle_inn_input
     if text.isdigit():
         # обновим профиль пользователя и передадим в существующий хендлер ввода ИНН
-        user = await users_collection.find_one({"chat_id": chat_id, "type": "delivery"})
+        user = await sessions.get(chat_id, "delivery")
         await handle_inn_input(chat_id, user, text)
         return  # :contentReference[oaicite:0]{index=0}
 
-    # Иначе выбранная ИП / организация по названию
+    # Иначе выбранная ИП / организация по названию — реквизиты из профиля клиента
     org_name = text
-    last_order = await users_collection.database["orders"].find_one(
-        {
-            "chat_id":      chat_id,
-            "org_name":     org_name,
-            "inn":          {"$exists": True},
-            "org_address":  {"$exists": True},
-            "rs":           {"$exists": True},
-            "bik":          {"$exists": True},
-        },
-        sort=[("created_at", -1)]
-    )
+    last_order = profiles.find_org(await profiles.get(chat_id), org_name)
 
     if not last_order:
         # Не нашли — просим ввести ИНН ИП / компании заново
@@ -211,10 +187,7 @@ async def handle_select_existing_org(chat_id, user, text):
             svc.delivery_bot,
             {"keyboard":[[{"text":"🔄 Начать заново"}]], "resize_keyboard": True}
         )
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "select_existing_org"}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "select_existing_org"})
         return  # :contentReference[oaicite:1]{index=1}
 
     # Копируем поля из последнего заказа в новый
@@ -234,10 +207,7 @@ async def handle_select_existing_org(chat_id, user, text):
     new_order_id = str(res.inserted_id)
 
     # Сохраняем новый active_order и переходим к выбору склада
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"active_order": new_order_id, "state": "select_warehouse"}}
-    )
+    await sessions.update(chat_id, "delivery", {"active_order": new_order_id, "state": "select_warehouse"})
 
     # Предлагаем выбрать склад — используем WAREHOUSES из services.py
     rows = [svc.WAREHOUSES[i : i + 2] for i in range(0, len(svc.WAREHOUSES), 2)]
@@ -256,10 +226,7 @@ async def handle_select_existing_org(chat_id, user, text):
 async def handle_confirm_inn(chat_id, user, text):
     # 1) Подтвердили найденную ИП / организацию → ввод Р/С
     if text == "✅ Продолжить":
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "awaiting_rs"}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "awaiting_rs"})
         keyboard = {
             "keyboard": [[{"text": "🔄 Начать заново"}]],
             "resize_keyboard": True
@@ -274,10 +241,7 @@ async def handle_confirm_inn(chat_id, user, text):
 
     # 2) Хотят ввести ИНН заново → возвращаем в awaiting_inn
     if text == "❌ Ввести другой ИНН":
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "awaiting_inn"}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "awaiting_inn"})
         await svc.send_text(
             chat_id,
             "Введите ИНН ИП / компании",
@@ -304,16 +268,12 @@ async def handle_confirm_inn(chat_id, user, text):
 async def handle_rs_input(chat_id, user, text):
     rs = text.strip()
     order_id = user.get("active_order")
-    # Сохраняем расчётный счёт в заказ
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"rs": rs}}
-    )
-    # Переходим к вводу БИК
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "awaiting_bik"}}
-    )
+    error = requisites.check_account(rs)
+    if error:
+        await svc.send_text(chat_id, f"❌ {error} Введите расчётный счёт ещё раз.", svc.delivery_bot)
+        return
+    # Сохраняем расчётный счёт в заказ и переходим к вводу БИК
+    await svc.transition(chat_id, "delivery", order_id, {"rs": rs}, {"state": "awaiting_bik"})
     # Только «Начать заново»
     await svc.send_text(
         chat_id,
@@ -326,16 +286,25 @@ async def handle_rs_input(chat_id, user, text):
 async def handle_bik_input(chat_id, user, text):
     bik = text.strip()
     order_id = user.get("active_order")
-    # Сохраняем БИК в заказ
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"bik": bik}}
-    )
-    # Переходим к выбору склада
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "select_warehouse"}}
-    )
+    error = requisites.check_bik(bik)
+    if error:
+        await svc.send_text(chat_id, f"❌ {error} Введите БИК ещё раз.", svc.delivery_bot)
+        return
+    # Ключ счёта считается от БИК: при несовпадении ошибка может быть в любом из двух,
+    # поэтому возвращаемся к вводу счёта
+    order = await users_collection.database["orders"].find_one({"_id": ObjectId(order_id)}, {"rs": 1})
+    rs = (order or {}).get("rs")
+    if rs and not requisites.account_key_valid(rs, bik):
+        await sessions.update(chat_id, "delivery", {"state": "awaiting_rs"})
+        await svc.send_text(
+            chat_id,
+            "❌ Расчётный счёт не соответствует БИК банка. Введите расчётный счёт ещё раз.",
+            svc.delivery_bot,
+            {"keyboard": [[{"text": "🔄 Начать заново"}]], "resize_keyboard": True}
+        )
+        return
+    # Сохраняем БИК в заказ и переходим к выбору склада
+    await svc.transition(chat_id, "delivery", order_id, {"bik": bik}, {"state": "select_warehouse"})
     # Предлагаем выбрать склад — используем svc.WAREHOUSES
     rows = [svc.WAREHOUSES[i : i + 2] for i in range(0, len(svc.WAREHOUSES), 2)]
     buttons = [[{"text": w} for w in row] for row in rows]
@@ -368,14 +337,7 @@ async def handle_select_warehouse(chat_id, user, text):
         return
 
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"warehouse": warehouse}}
-    )
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "select_delivery_date"}}
-    )
+    await svc.transition(chat_id, "delivery", order_id, {"warehouse": warehouse}, {"state": "select_delivery_date"})
 
     await svc.prompt_delivery_date_selection(chat_id, svc.delivery_bot, warehouse)
 
@@ -387,40 +349,37 @@ async def handle_select_delivery_date(chat_id, user, text):
     try:
         delivery_date = _dt.strptime(text.strip(), "%d.%m.%Y").date()
     except ValueError:
+        delivery_date = None
+
+    order_id = user.get("active_order")
+    oid = ObjectId(order_id) if isinstance(order_id, str) else order_id
+    order = await users_collection.database["orders"].find_one({"_id": oid})
+    warehouse = order.get("warehouse", "")
+    # груз уже известен, если вернулись к выбору даты с шага количества или отправки
+    load = svc.load_units(order.get("cargo_type"), order["cargo_quantity"]) if order.get("cargo_quantity") else 0
+
+    # Дата должна быть в текущем календаре склада: клавиатура могла устареть
+    # (праздник, закрытие склада, заполненная машина), а дату могли ввести вручную
+    if delivery_date is None or not svc.delivery_date_available(warehouse, delivery_date, load):
         await svc.send_text(
             chat_id,
-            "❌ Неверный формат даты. Выберите из кнопок.",
+            "❌ Неверный формат даты. Выберите из кнопок." if delivery_date is None
+            else "❌ Эта дата недоступна. Выберите из кнопок.",
             svc.delivery_bot
         )
-        order_id = user.get("active_order")
-        oid = ObjectId(order_id) if isinstance(order_id, str) else order_id
-        order = await users_collection.database["orders"].find_one({"_id": oid})
-        warehouse = order.get("warehouse", "")
-        await svc.prompt_delivery_date_selection(chat_id, svc.delivery_bot, warehouse)
+        await svc.prompt_delivery_date_selection(chat_id, svc.delivery_bot, warehouse, load)
         return
 
-    order_id = user.get("active_order")
-    # 2) Сохраняем дату сдачи в заказе
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"delivery_date": delivery_date.isoformat()}}
-    )  # :contentReference[oaicite:0]{index=0}
+    # 2) Сохраняем дату сдачи в заказе — склад берём из обновлённого заказа
+    order = await svc.transition(chat_id, "delivery", order_id, {"delivery_date": delivery_date.isoformat()})
 
     # 3) Получаем все возможные даты забора для этой доставки
-    warehouse = user.get("warehouse") or (await users_collection.database["orders"]
-        .find_one({"_id": ObjectId(order_id)})).get("warehouse", "")
+    warehouse = order.get("warehouse", "")
     pickups = svc.get_pickup_dates(warehouse, delivery_date)  # :contentReference[oaicite:1]{index=1}
 
     # 4) Если только одна дата забора — сразу записываем и идём к выбору типа груза
     if len(pickups) == 1:
-        await users_collection.database["orders"].update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": {"pickup_date": pickups[0].isoformat()}}
-        )
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "select_cargo_type"}}
-        )
+        await svc.transition(chat_id, "delivery", order_id, {"pickup_date": pickups[0].isoformat()}, {"state": "select_cargo_type"})
         await svc.send_cargo_type_selection(chat_id, svc.delivery_bot)
         return  # :contentReference[oaicite:2]{index=2}
 
@@ -436,10 +395,7 @@ async def handle_select_delivery_date(chat_id, user, text):
     buttons.append([{"text": "🔄 Начать заново"}])
     keyboard = {"keyboard": buttons, "resize_keyboard": True}
 
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "select_pickup_date"}}
-    )
+    await sessions.update(chat_id, "delivery", {"state": "select_pickup_date"})
     await svc.send_text(
         chat_id,
         "🚚 Выберите дату забора поставки:",
@@ -487,14 +443,7 @@ async def handle_select_pickup_date(chat_id, user, text):
 
     order_id = user.get("active_order")
     # 2) Сохраняем дату забора и идём к выбору типа груза
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"pickup_date": pickup_date.isoformat()}}
-    )
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "select_cargo_type"}}
-    )
+    await svc.transition(chat_id, "delivery", order_id, {"pickup_date": pickup_date.isoformat()}, {"state": "select_cargo_type"})
     await svc.send_cargo_type_selection(chat_id, svc.delivery_bot)
 
 @on_state("select_cargo_type")
@@ -512,18 +461,9 @@ async def handle_select_cargo_type(chat_id, user, text):
     # Определяем тип груза
     cargo_type = "boxes" if "Короба" in text else "pallets"
 
-    # Сохраняем в заказе
+    # Сохраняем в заказе, переходим к вводу количества и меняем состояние
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"cargo_type": cargo_type}}
-    )
-
-    # Переходим к вводу количества и меняем состояние
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "enter_cargo_quantity"}}
-    )
+    await svc.transition(chat_id, "delivery", order_id, {"cargo_type": cargo_type}, {"state": "enter_cargo_quantity"})
 
     # Запрос количества
     cargo_label = "коробов" if cargo_type == "boxes" else "палет"
@@ -556,17 +496,14 @@ async def handle_enter_cargo_quantity(chat_id, user, text):
         )
         return
 
-    # сохраняем количество
+    # груз должен поместиться в машину на выбранную дату
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"cargo_quantity": qty}}
-    )
-    # переходим к выбору/вводу адреса
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "enter_pickup_address"}}
-    )
+    order = await users_collection.database["orders"].find_one({"_id": ObjectId(order_id)})
+    if not await svc.check_cargo_room(chat_id, svc.delivery_bot, "delivery", order, qty):
+        return
+
+    # сохраняем количество и переходим к выбору/вводу адреса
+    await svc.transition(chat_id, "delivery", order_id, {"cargo_quantity": qty}, {"state": "enter_pickup_address"})
     await svc.prompt_pickup_address_selection(chat_id, svc.delivery_bot)
 
 # 2) Выбор или ввод адреса
@@ -582,29 +519,22 @@ async def handle_enter_pickup_address(chat_id, user, text):
         return
 
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"pickup_address": address}}
-    )
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "enter_phone_number"}}
-    )
+    await svc.transition(chat_id, "delivery", order_id, {"pickup_address": address}, {"state": "enter_phone_number"})
     await svc.prompt_phone_number_selection(chat_id, svc.delivery_bot)
 
-@on_state("enter_phone_number")
+@on_state("enter_phone_number", payload=PAYLOAD_MESSAGE)
 async def handle_enter_phone_number(chat_id, user, message):
     # 0) Логируем, что пришло
     logger.info("enter_phone_number ➔ %r", message)
 
     # 1) Пробуем достать контакт
     phone = None
-    contact = message.get("contact")
-    if contact and contact.get("phone_number"):
-        phone = contact["phone_number"]
+    contact = message.contact
+    if contact and contact.phone_number:
+        phone = contact.phone_number
 
     # 2) Иначе пробуем извлечь из текста
-    text = message.get("text", "").strip()
+    text = message.text.strip()
     if phone is None and text.startswith("📞 "):
         phone = text.lstrip("📞 ").strip()
     if phone is None and re.fullmatch(r"\+\d+", text):
@@ -627,7 +557,7 @@ async def handle_enter_phone_number(chat_id, user, message):
 
     order = None
     if oid:
-        order = await users_collection.database["orders"].find_one({"_id": oid})
+        order = await svc.transition(chat_id, "delivery", oid, {"phone_number": phone})
 
     if not order:
         # заказ удалён или не найден — просим начать заново
@@ -638,20 +568,10 @@ async def handle_enter_phone_number(chat_id, user, message):
             {"keyboard": [[{"text": "📦 Создать новую заявку"}]], "resize_keyboard": True}
         )
         # сброс состояния
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "start", "active_order": None}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "start", "active_order": None})
         return
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"phone_number": phone}}
-    )
 
-    # 5) Рассчитываем стоимость через calculate_delivery_cost
-    order = await users_collection.database["orders"].find_one(
-        {"_id": ObjectId(order_id)}
-    )
+    # 5) Рассчитываем стоимость по действующим тарифам
     delivery_iso = order.get("delivery_date")
     pickup_iso   = order.get("pickup_date")
 
@@ -676,22 +596,10 @@ async def handle_enter_phone_number(chat_id, user, message):
         "pallets":"Палеты"
     }.get(raw_ct, raw_ct)
 
-    cost = svc.calculate_delivery_cost(
-        warehouse,
-        cargo_type,
-        quantity
-    )  # :contentReference[oaicite:0]{index=0}
+    cost = tariffs.quote("delivery", warehouse, cargo_type, quantity)
 
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"delivery_cost": cost}}
-    )
-
-    # 6) Переходим к финальному суммари
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "awaiting_order_submit"}}
-    )
+    # 6) Сохраняем стоимость и переходим к финальному суммари
+    await svc.transition(chat_id, "delivery", oid, {"delivery_cost": cost}, {"state": "awaiting_order_submit"})
 
     # 7) Шлём итоговое сообщение с проверкой данных
     parts = [
@@ -762,30 +670,28 @@ async def handle_awaiting_order_submit(chat_id, user, text):
     order = await users_collection.database["orders"].find_one(
         {"_id": ObjectId(order_id)}
     )
-    delivery_iso = order.get("delivery_date")
-    pickup_iso   = order.get("pickup_date")
-
-    delivery_str = (
-    datetime.fromisoformat(delivery_iso)
-    .strftime("%d.%m.%Y")
-    if delivery_iso
-    else "—"
-    )
-    pickup_str = (
-        datetime.fromisoformat(pickup_iso)
-        .strftime("%d.%m.%Y")
-        if pickup_iso
-        else "—"
-    )
+    if order.get("sync_status"):
+        await svc.send_text(
+            chat_id,
+            "ℹ️ Эта заявка уже отправлена.",
+            svc.delivery_bot
+        )
+        return
 
-    # Отправляем в Битрикс и получаем номер заявки
-    await svc.delivery_bot.send_chat_action(chat_id, ChatAction.TYPING)
-    deal_id = await svc.send_to_bitrix(order, user.get("username", ""))
-    # Сохраняем bitrix_deal_id в заказе
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"bitrix_deal_id": deal_id}}
-    )
+    # Бронируем место в машине на дату сдачи; если день уже заполнен —
+    # возвращаем к выбору даты (заполненные дни в клавиатуру не попадут)
+    if not await capacity.reserve(order):
+        await sessions.update(chat_id, "delivery", {"state": "select_delivery_date"})
+        await svc.send_text(
+            chat_id,
+            "⛔ На выбранную дату машины уже заполнены. Пожалуйста, выберите другую дату сдачи.",
+            svc.delivery_bot
+        )
+        await svc.prompt_delivery_date_selection(
+            chat_id, svc.delivery_bot, order.get("warehouse", ""),
+            svc.load_units(order.get("cargo_type"), order.get("cargo_quantity", 0))
+        )
+        return
 
     # Удаляем прежнее суммари
     summ_mid = order.get("summ_mid")
@@ -795,39 +701,20 @@ async def handle_awaiting_order_submit(chat_id, user, text):
         except:
             pass
 
-    # Составляем окончательный суммари с номером заявки
-    parts = [
-        "✅ Ваша заявка успешно отправлена!",
-        "📋 Содержимое заявки:",
-        "",
-        f"🆔 Номер заявки: #{deal_id}",
-        f"🏢 ИП / организация: {order.get('org_name', '—')}",
-        f"📍 Адрес ИП / организации: {order.get('org_address', '—')}",
-        f"🏦 БИК: {order.get('bik', '—')}",
-        f"💳 Р/С: {order.get('rs', '—')}",
-        f"📦 Тип поставки: {'Короба' if order.get('cargo_type') == 'boxes' else 'Палеты'}",
-        f"🔢 Количество: {order.get('cargo_quantity', '—')}",
-        f"🏬 Склад: {order.get('warehouse', '—')}",
-        f"📅 Дата сдачи: {delivery_str}",
-        f"🚚 Дата забора: {pickup_str}",
-        f"🏠 Адрес забора: {order.get('pickup_address', '—')}",
-        f"📞 Телефон: {order.get('phone_number', '—')}",
-        f"💰 Стоимость: {order.get('delivery_cost', '—')} ₽"
-    ]
-    final_summary = "\n".join(parts)
-
-    # 1) Отправляем суммари без кнопок и сохраняем summ_mid
-    sent = await svc.send_text(
-        chat_id,
-        final_summary,
-        svc.delivery_bot
-    )
-    new_mid = getattr(sent, "message_id", None) or sent.json().get("result", {}).get("message_id")
-    if new_mid:
-        await users_collection.database["orders"].update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": {"summ_mid": new_mid}}
+    # Сразу подтверждаем приём: номер заявки допишет в это сообщение
+    # воркер outbox, когда сделка будет создана в Битриксе
+    try:
+        sent = await svc.send_text(
+            chat_id,
+            svc.render_order_summary(order),
+            svc.delivery_bot
         )
+        new_mid = getattr(sent, "message_id", None) or sent.json().get("result", {}).get("message_id")
+        await outbox.enqueue(order, user.get("username", ""), new_mid)
+    except Exception:
+        # заявка не ушла в outbox — место в машине не держим
+        await capacity.release(order["_id"], unsubmitted_only=True)
+        raise
 
     notify_text = "📨 При изменении статуса вы получите уведомление."
     keyboard = {
@@ -842,8 +729,7 @@ async def handle_awaiting_order_submit(chat_id, user, text):
     )
 
 @on_command("Оплатить по счету")
-async def handle_pay_by_invoice(chat_id: int, user: dict, message: dict):
-    await svc.delivery_bot.send_chat_action(chat_id, ChatAction.TYPING)
+async def handle_pay_by_invoice(chat_id: int, user: dict, message: Message):
     # 1) Берём самый свежий заказ в статусе awaiting_payment, где ещё нет ссылки на счёт
     order = await users_collection.database["orders"].find_one(
         {
@@ -870,9 +756,9 @@ async def handle_pay_by_invoice(chat_id: int, user: dict, message: dict):
         )
         return
 
-    # 2) Генерируем публичную ссылку на счёт
+    # 2) Ссылка на счёт: обычно уже сгенерирована в фоне после доставки
     try:
-        url_public = await svc.generate_deal_invoice_public_url(deal_id)
+        url_public = await invoices.get(order)
     except Exception as e:
         logger.error("Ошибка при генерации счёта для сделки %s: %s", deal_id, e)
         await svc.send_text(
@@ -904,7 +790,7 @@ async def handle_pay_by_invoice(chat_id: int, user: dict, message: dict):
     )
 
 @on_command("Оплатить по СБП")
-async def handle_pay_by_sbp(chat_id: int, user: dict, message: dict):
+async def handle_pay_by_sbp(chat_id: int, user: dict, message: Message):
     await svc.delivery_bot.send_chat_action(chat_id, ChatAction.TYPING)
     # 1) Берём самый свежий заказ в статусе awaiting_payment без invoice_url
     order = await users_collection.database["orders"].find_one(
@@ -930,74 +816,25 @@ async def handle_pay_by_sbp(chat_id: int, user: dict, message: dict):
     service_name  = order.get("service_name", "Услуга")
     client_phone  = order.get("phone_number", "")
 
-    # 2) Получаем токен от PayKeeper
-    creds = f"{settings.PAYKEEPER_USER}:{settings.PAYKEEPER_PASSWORD}".encode()
-    b64   = base64.b64encode(creds).decode()
-    headers = {
-        "Content-Type":  "application/x-www-form-urlencoded",
-        "Authorization": f"Basic {b64}"
-    }
-
-    async with AsyncClient() as client:
-        # запрос токена
-        r1 = await client.get(
-            settings.PAYKEEPER_TOKEN_URL,
-            headers=headers
-        )
-        try:
-            r1.raise_for_status()
-            token = r1.json().get("token")
-            if not token:
-                raise ValueError("нет поля token")
-        except Exception as e:
-            logger.error("Ошибка получения токена PayKeeper: %s — %s", e, r1.text)
-            await svc.send_text(
-                chat_id,
-                "❌ Не удалось получить токен оплаты. Попробуйте позже.",
-                svc.delivery_bot
-            )
-            return
-
-        # 3) Формируем данные и запрашиваем счет
-        payment_data = {
-            "pay_amount":   amount,
-            "clientid":     client_name,
-            "orderid":      orderid,
-            "service_name": service_name,
-            "client_phone": client_phone,
-            "token":        token
-        }
-        body = client.build_request(
-            "POST",
-            settings.PAYKEEPER_INVOICE_URL,
-            data=payment_data,
-            headers=headers
-        ).content  # сформированный x-www-form-urlencoded
-        r2 = await client.post(
-            settings.PAYKEEPER_INVOICE_URL,
-            data=body,
-            headers=headers
+    # 2) Создаём счёт в PayKeeper (токен и соединения переиспользуются)
+    try:
+        link = await paykeeper.create_invoice(
+            amount=amount,
+            clientid=client_name,
+            orderid=orderid,
+            service_name=service_name,
+            client_phone=client_phone,
+        )
+    except (PayKeeperError, HTTPError) as e:
+        logger.error("Ошибка создания счёта PayKeeper: %s", e)
+        await svc.send_text(
+            chat_id,
+            "❌ Не удалось сформировать счёт СБП. Попробуйте позже.",
+            svc.delivery_bot
         )
-        try:
-            r2.raise_for_status()
-            resp2 = r2.json()
-            invoice_id = resp2.get("invoice_id")
-            if not invoice_id:
-                raise ValueError("нет invoice_id")
-        except Exception as e:
-            logger.error("Ошибка создания счёта PayKeeper: %s — %s", e, r2.text)
-            await svc.send_text(
-                chat_id,
-                "❌ Не удалось сформировать счёт СБП. Попробуйте позже.",
-                svc.delivery_bot
-            )
-            return
-
-    # 4) Собираем публичную ссылку
-    server = settings.PAYKEEPER_INVOICE_URL.split("/change")[0]
-    link   = f"{server}/bill/{invoice_id}/"
-
-    # 5) Сохраняем в ордере
+        return
+
+    # 3) Сохраняем в ордере
     await users_collection.database["orders"].update_one(
         {"_id": ObjectId(order["_id"])},
         {"$set": {
@@ -1013,7 +850,7 @@ async def handle_pay_by_sbp(chat_id: int, user: dict, message: dict):
         ],
         "resize_keyboard": True
     }
-    # 6) Отправляем клиенту ссылку
+    # 4) Отправляем клиенту ссылку
     await svc.send_text(
         chat_id,
         f"🔗 Ссылка для оплаты заявки #{deal_id}:\n{link}",
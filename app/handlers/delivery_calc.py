@@ -4,7 +4,9 @@ from datetime import datetime
 from bson import ObjectId
 
 from app.handlers.decorators import on_command, on_state
-from app.db import users_collection, calcs_collection
+from app.db import calcs_collection
+from app.sessions import sessions
+from app.tariffs import tariffs
 import app.services as svc
 
 logger = logging.getLogger(__name__)
@@ -17,10 +19,7 @@ async def handle_delivery_calc(chat_id, user, message):
     # сразу создаём расчёт для Wildberries
     calc_id = await svc.init_calc(chat_id, "Wildberries")
     # сохраняем active_calc и назначаем следующее состояние
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"active_calc": calc_id, "state": "delivery_calc_warehouse"}}
-    )
+    await sessions.update(chat_id, "delivery", {"active_calc": calc_id, "state": "delivery_calc_warehouse"})
     # сразу показываем выбор склада
     await svc.prompt_warehouse_selection(chat_id, svc.delivery_bot)
 
@@ -47,10 +46,7 @@ async def handle_warehouse_selected(chat_id, user, payload):
     )
 
     # Переходим к состоянию выбора типа груза
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "delivery_calc_cargo_type"}}
-    )
+    await sessions.update(chat_id, "delivery", {"state": "delivery_calc_cargo_type"})
     await svc.prompt_cargo_type_selection(chat_id, svc.delivery_bot)
 
 @on_state("delivery_calc_cargo_type")
@@ -75,10 +71,7 @@ async def handle_cargo_type_selected(chat_id, user, payload):
     )
 
     # Переходим в состояние ввода количества
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "delivery"},
-        {"$set": {"state": "delivery_calc_quantity"}}
-    )
+    await sessions.update(chat_id, "delivery", {"state": "delivery_calc_quantity"})
 
     # Формируем текст с учётом выбранного типа
     label = "коробов" if cargo_type == "Короба" else "палет"
@@ -119,10 +112,7 @@ async def handle_quantity_input(chat_id, user, payload):
             "❗ Пожалуйста, выберите склад перед вводом количества.",
             svc.delivery_bot
         )
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "delivery"},
-            {"$set": {"state": "delivery_calc_warehouse"}}
-        )
+        await sessions.update(chat_id, "delivery", {"state": "delivery_calc_warehouse"})
         await svc.prompt_warehouse_selection(chat_id, svc.delivery_bot)
         return
 
@@ -149,7 +139,7 @@ async def handle_quantity_input(chat_id, user, payload):
         {"$set": {"quantity": quantity}}
     )
     schedule = svc.calculate_schedule(warehouse)   # список словарей с pickup/delivery
-    cost     = svc.calculate_delivery_cost(warehouse, cargo_type, quantity)
+    cost     = tariffs.quote("delivery", warehouse, cargo_type, quantity)
 
     # Формируем и отправляем ответ
     lines = [
@@ -1,52 +1,67 @@
-from aiogram.types import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from app.config import get_settings
 import logging
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import re
 from app.db import users_collection
+from app.sessions import sessions
 import app.services as svc
 from bson import ObjectId
-from httpx import AsyncClient
-from app.handlers.decorators import on_callback, on_state, on_command
+from httpx import HTTPError
+from app.bitrix_client import bitrix, BitrixError, DealUpdate
+from app.invoices import invoices
+from app.tariffs import tariffs
+from app.handlers.decorators import on_callback, on_state, on_command, PAYLOAD_INT
+from app.telegram import CallbackQuery
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
-driver_bot = Bot(token=settings.TELEGRAM_DRIVER_TOKEN)
 
-async def handle_driver_start(update_data: dict):
-    update = Update(**update_data)
-    message = update.message
+@on_command("/start")
+async def handle_driver_start(chat_id, user, message):
+    # если водителя ещё нет — создаём
+    if not user:
+        sender = message.from_
+        await sessions.create({
+            "type": "driver",
+            "chat_id": chat_id,
+            "created_at": datetime.utcnow(),
+            "first_name": sender.first_name if sender else None,
+            "last_name": sender.last_name if sender else None,
+            "username": sender.username if sender else None,
+        })
 
-    if not message or not message.from_user:
-        logger.warning("[DRIVER] no message or from_user")
-        return
+    await svc.send_text(
+        chat_id,
+        "✅ Ваш аккаунт успешно добавлен. Теперь заявки будут поступать в этот чат.",
+        svc.driver_bot
+    )
 
-    user_data = {
-        "chat_id": message.chat.id,
-        "username": message.from_user.username,
-        "first_name": message.from_user.first_name,
-        "last_name": message.from_user.last_name,
-        "type": "driver",
-        "created_at": datetime.utcnow()
-    }
-
-    # Обновляем запись, если есть такая пара chat_id + type; иначе создаём
-    await users_collection.update_one(
-        {"chat_id": message.chat.id, "type": "driver"},
-        {"$set": user_data},
-        upsert=True
+async def prompt_final_quantity(chat_id: int, user: dict):
+    # 🔒 водитель в ожидании qty — принимаем только целое число
+    deal_id = user.get("active_deal_id")
+    order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
+    cargo_type = order.get("cargo_type", "boxes")
+    unit_label = "коробов" if cargo_type == "boxes" else "палет"
+    await svc.send_text(
+        chat_id,
+        f"❗ Введите итоговое количество {unit_label} для заявки #{deal_id} (целое число)",
+        svc.driver_bot
     )
 
-    await driver_bot.send_message(
-        chat_id=message.chat.id,
-        text=f"Аккаунт @{message.from_user.username} успешно добавлен. Теперь новые заявки будут поступать в этот чат."
+async def prompt_gate(chat_id: int, user: dict):
+    # 🔒 водитель в ожидании ворот — просим номер ворот
+    deal_id = user.get("active_deal_id")
+    await svc.send_text(
+        chat_id,
+        f"Для завершения заявки #{deal_id} введите номер ворот:",
+        svc.driver_bot
     )
 
 @on_callback("got#")  # будет перехватывать все got#...
 async def handle_driver_got(chat_id, user, callback_query):
-    data = callback_query.get("data", "")
+    data = callback_query.data
     match = re.match(r"got#(\d+)", data)
     if not match:
         return
@@ -79,13 +94,10 @@ async def handle_driver_got(chat_id, user, callback_query):
     cargo_type = order.get("cargo_type", "boxes")
     unit_label = "коробов" if cargo_type == "boxes" else "палет"
 
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "driver"},
-        {"$set": {
-            "state": "awaiting_final_qty",
-            "active_deal_id": deal_id
-        }}
-    )
+    await sessions.update(chat_id, "driver", {
+        "state": "awaiting_final_qty",
+        "active_deal_id": deal_id
+    })
 
     await svc.send_text(
         chat_id,
@@ -93,7 +105,9 @@ async def handle_driver_got(chat_id, user, callback_query):
         svc.driver_bot
     )
 
-async def handle_final_quantity_input(chat_id: int, user: dict, qty: int, deal_id: str):
+@on_state("awaiting_final_qty", payload=PAYLOAD_INT, guard=prompt_final_quantity)
+async def handle_final_quantity_input(chat_id: int, user: dict, qty: int):
+    deal_id = user.get("active_deal_id")
     # 1. Найти заказ
     order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
     if not order:
@@ -102,18 +116,22 @@ async def handle_final_quantity_input(chat_id: int, user: dict, qty: int, deal_i
     orig_qty = order.get("cargo_quantity", 0)
     warehouse = order.get("warehouse", "")
     raw_type = order.get("cargo_type", "boxes")
-    # Русская метка для расчёта
-    cargo_label_ru = "Короба" if raw_type == "boxes" else "Палеты"
     unit_label = "коробов" if raw_type == "boxes" else "палет"
     client_chat_id = order.get("chat_id")
     driver_mid = order.get("driver_mid")
     client_summ_mid = order.get("summ_mid")
     deal_type = order.get("type")  # "delivery" или "fulfilment"
-    delivery_str = svc.format_date(order.get("delivery_date"))
-    pickup_str   = svc.format_date(order.get("pickup_date"))
+    # изменения сделки копятся и уходят в Битрикс одним запросом в finalize()
+    deal = DealUpdate(deal_id)
 
     # Функция для финального шага (общая)
     async def finalize():
+        # Сначала перевести сделку в C2:PREPAYMENT_INVOICE — вместе с остальными
+        #    изменениями сделки одним запросом, до уведомлений: ошибка Telegram
+        #    не должна оставить сделку без количества и суммы
+        deal.set({"STAGE_ID": "C2:PREPAYMENT_INVOICE"})
+        await deal.flush()
+
         # 4. Финальное уведомление клиенту
         final_text = (
             f"*Изменился статус Вашей заявки #{deal_id}, {warehouse}.*\n"
@@ -144,119 +162,76 @@ async def handle_final_quantity_input(chat_id: int, user: dict, qty: int, deal_i
             text=f"Данные по заказу #{deal_id} успешно обновлены."
         )
 
-        # 6. Перевести сделку в C2:PREPAYMENT_INVOICE
-        async with AsyncClient() as client:
-            await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.deal.update",
-                json={
-                    "id": deal_id,
-                    "fields": {"STAGE_ID": "C2:PREPAYMENT_INVOICE"}
-                }
-            )
-
         # Сброс состояния водителя
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "driver"},
-            {"$set": {"state": None, "active_deal_id": None}}
+        await sessions.update(chat_id, "driver", {"state": None, "active_deal_id": None})
+
+    # если что-то упадёт до finalize(), накопленное всё равно уйдёт в сделку
+    async with deal:
+        # Сценарий 1: количество не изменилось
+        if qty == orig_qty:
+            new_cost = order.get("delivery_cost", 0)
+            await finalize()
+            return
+
+        # Сценарий 2: количество изменилось
+        # 1) Пересчёт стоимости
+        new_cost = tariffs.quote(deal_type or "delivery", warehouse, raw_type, qty)
+
+        # Обновляем ордер в БД
+        await users_collection.database["orders"].update_one(
+            {"_id": ObjectId(order["_id"])},
+            {"$set": {"cargo_quantity": qty, "delivery_cost": new_cost}}
         )
 
-    # Сценарий 1: количество не изменилось
-    if qty == orig_qty:
-        new_cost = order.get("delivery_cost", 0)
-        await finalize()
-        return
-
-    # Сценарий 2: количество изменилось
-    # 1) Пересчёт стоимости
-    if deal_type == "fulfilment":
-        new_cost = svc.calculate_delivery_cost_fulfilment(warehouse, cargo_label_ru, qty)
-    else:
-        new_cost = svc.calculate_delivery_cost(warehouse, cargo_label_ru, qty)
+        # 2) Обновляем поля сделки в Битрикс
+        deal.set({
+            "UF_CRM_1724923582938": qty,
+            "OPPORTUNITY": new_cost
+        })
 
-    # Обновляем ордер в БД
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order["_id"])},
-        {"$set": {"cargo_quantity": qty, "delivery_cost": new_cost}}
-    )
-
-    # 2) Обновляем поля сделки в Битрикс
-    async with AsyncClient() as client:
-        await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.deal.update",
-            json={
-                "id": deal_id,
-                "fields": {
-                    "UF_CRM_1724923582938": qty,
-                    "OPPORTUNITY": new_cost
-                }
-            }
-        )
-
-     # 3) Пересобираем и правим суммари водителя
-    order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
-    new_text, new_kb = await render_driver_message(order)
-    try:
-        await svc.driver_bot.edit_message_text(
-            chat_id=order["driver_chat_id"],
-            message_id=order["driver_mid"],
-            text=new_text,
-            reply_markup=new_kb,
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.warning("Не удалось обновить первое сообщение водителю: %s", e)
+         # 3) Пересобираем и правим суммари водителя
+        order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
+        new_text, new_kb = await render_driver_message(order)
+        try:
+            await svc.driver_bot.edit_message_text(
+                chat_id=order["driver_chat_id"],
+                message_id=order["driver_mid"],
+                text=new_text,
+                reply_markup=new_kb,
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.warning("Не удалось обновить первое сообщение водителю: %s", e)
 
-    # 4) Пересобираем и правим суммари клиента
-    bot = svc.delivery_bot if deal_type == "delivery" else svc.fulfilment_bot
-    parts = [
-        "✅ Ваша заявка успешно отправлена!",
-        "📋 Содержимое заявки:",
-        "",
-        f"🆔 Номер заявки: #{deal_id}",
-        f"🏢 ИП / организация: {order.get('org_name', '—')}",
-        f"📍 Адрес ИП / организации: {order.get('org_address', '—')}",
-        f"🏦 БИК: {order.get('bik', '—')}",
-        f"💳 Р/С: {order.get('rs', '—')}",
-        f"📦 Тип поставки: {cargo_label_ru}",
-        f"🔢 Количество: {qty}",                # <-- обновлено
-        f"🏬 Склад: {warehouse}",
-        f"📅 Дата сдачи: {delivery_str}",
-        f"🚚 Дата забора: {pickup_str}",
-        f"🏠 Адрес забора: {order.get('pickup_address', '—')}",
-        f"📞 Телефон: {order.get('phone_number', '—')}",
-        f"💰 Стоимость: {new_cost} ₽"           # <-- обновлено
-    ]
-    new_summary = "\n".join(parts)
-    try:
-        await bot.edit_message_text(
-            chat_id=client_chat_id,
-            message_id=client_summ_mid,
-            text=new_summary,
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error("Не удалось обновить суммари клиента: %s", e)
+        # 4) Пересобираем и правим суммари клиента
+        bot = svc.delivery_bot if deal_type == "delivery" else svc.fulfilment_bot
+        new_summary = svc.render_order_summary(order, deal_id)
+        try:
+            await bot.edit_message_text(
+                chat_id=client_chat_id,
+                message_id=client_summ_mid,
+                text=new_summary,
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.error("Не удалось обновить суммари клиента: %s", e)
 
-    # Переходим к финалу
-    await finalize()
+        # Переходим к финалу
+        await finalize()
 
 @on_callback("packing#")
-async def handle_packing(chat_id: int, user: dict, callback_query: dict):
-    data = callback_query.get("data", "")
+async def handle_packing(chat_id: int, user: dict, callback_query: CallbackQuery):
+    data = callback_query.data
     m = re.match(r"packing#(\d+)", data)
     if not m:
         return
     deal_id = m.group(1)
 
     # 1. Перевести сделку в C2:EXECUTING
-    async with AsyncClient() as client:
-        try:
-            await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.deal.update",
-                json={"id": deal_id, "fields": {"STAGE_ID": "C2:EXECUTING"}}
-            )
-        except Exception as e:
-            logger.error("Bitrix update error: %s", e)
+    try:
+        await bitrix.call("crm.deal.update", {"id": deal_id, "fields": {"STAGE_ID": "C2:EXECUTING"}})
+    except (BitrixError, HTTPError) as e:
+        logger.error("Bitrix update error: %s", e)
 
     # 2. Сменить кнопку у водителя
     order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
@@ -292,22 +267,18 @@ async def handle_packing(chat_id: int, user: dict, callback_query: dict):
         logger.error("Cannot notify client: %s", e)
 
 @on_callback("delivering#")
-async def handle_delivering(chat_id: int, user: dict, callback_query: dict):
-    data = callback_query.get("data", "")
+async def handle_delivering(chat_id: int, user: dict, callback_query: CallbackQuery):
+    data = callback_query.data
     m = re.match(r"delivering#(\d+)", data)
     if not m:
         return
     deal_id = m.group(1)
 
     # 1. Переводим сделку в C2:FINAL_INVOICE
-    async with AsyncClient() as client:
-        try:
-            await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.deal.update",
-                json={"id": deal_id, "fields": {"STAGE_ID": "C2:FINAL_INVOICE"}}
-            )
-        except Exception as e:
-            logger.error("Bitrix update error: %s", e)
+    try:
+        await bitrix.call("crm.deal.update", {"id": deal_id, "fields": {"STAGE_ID": "C2:FINAL_INVOICE"}})
+    except (BitrixError, HTTPError) as e:
+        logger.error("Bitrix update error: %s", e)
 
     # 2. Сменить кнопку у водителя на "Доставлено"
     order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
@@ -346,18 +317,15 @@ async def handle_delivering(chat_id: int, user: dict, callback_query: dict):
         logger.error("Cannot notify client about delivering: %s", e)
 
 @on_callback("delivered#")
-async def handle_driver_delivered(chat_id: int, user: dict, callback_query: dict):
-    data = callback_query.get("data", "")
+async def handle_driver_delivered(chat_id: int, user: dict, callback_query: CallbackQuery):
+    data = callback_query.data
     m = re.match(r"delivered#(\d+)", data)
     if not m:
         return
     deal_id = m.group(1)
 
     # 1) Ставим водителя в режим awaiting_gate и сохраняем deal_id
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "driver"},
-        {"$set": {"state": "awaiting_gate", "active_deal_id": deal_id}}
-    )
+    await sessions.update(chat_id, "driver", {"state": "awaiting_gate", "active_deal_id": deal_id})
 
     # 2) Меняем кнопку в первом сообщении на "Завершено"
     order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
@@ -382,7 +350,7 @@ async def handle_driver_delivered(chat_id: int, user: dict, callback_query: dict
         svc.driver_bot
     )
 
-@on_state("awaiting_gate")
+@on_state("awaiting_gate", guard=prompt_gate)
 async def handle_gate_input(chat_id: int, user: dict, text: str):
     deal_id = user.get("active_deal_id")
     if not deal_id:
@@ -396,21 +364,14 @@ async def handle_gate_input(chat_id: int, user: dict, text: str):
     iso_time = now_msk.strftime("%Y-%m-%dT%H:%M:%S")
     display_time = now_msk.strftime("%d.%m.%Y %H:%M")
 
-    async with AsyncClient() as client:
-        try:
-            await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.deal.update",
-                json={
-                    "id": deal_id,
-                    "fields": {
-                        "STAGE_ID": "C2:UC_1E3Z8W",
-                        "UF_CRM_1724923710659": gate_number,
-                        "UF_CRM_1724923678625": iso_time
-                    }
-                }
-            )
-        except Exception as e:
-            logger.error("Ошибка обновления сделки в Bitrix при вводе ворот: %s", e)
+    # стадия, ворота, время сдачи и услуга в сделке — одним batch-запросом
+    async with DealUpdate(deal_id) as deal:
+        deal.set({
+            "STAGE_ID": "C2:UC_1E3Z8W",
+            "UF_CRM_1724923710659": gate_number,
+            "UF_CRM_1724923678625": iso_time
+        })
+        service_name = await svc.set_deal_service_row(deal_id, deal)
 
     # 2) В кнопке водителю уже стоит null, ничего не правим (можно убрать клавиатуру)
     # Опционально: можно удалить inline-клавиатуру
@@ -453,43 +414,20 @@ async def handle_gate_input(chat_id: int, user: dict, text: str):
         logger.error("Не удалось уведомить клиента о завершении заявки: %s", e)
 
     # 5) Сбрасываем состояние водителя
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "driver"},
-        {"$set": {"state": None, "active_deal_id": None}}
-    )
-
-    # 6) Формируем услугу в сделке
-    service_name = await svc.set_deal_service_row(deal_id)
+    await sessions.update(chat_id, "driver", {"state": None, "active_deal_id": None})
 
     # 7) Переводим ордер в статус awaiting_payment
-    update_fields = {"status": "awaiting_payment", "service_name": service_name}
-
-    # 8) Если это fulfilment — генерим счёт и даём ссылку
-    order = await users_collection.database["orders"].find_one(
-        {"bitrix_deal_id": deal_id}
-    )
-    deal_type = order.get("type", "delivery")
-    if deal_type == "fulfilment":
-        url_public = await svc.generate_deal_invoice_public_url(deal_id)
-        update_fields["invoice_url"] = url_public
-        update_fields["payment_type"] = 'invoice'
-
-    # 9) Сохраняем всё в ордере
     await users_collection.database["orders"].update_one(
         {"bitrix_deal_id": deal_id},
-        {"$set": update_fields}
+        {"$set": {"status": "awaiting_payment", "service_name": service_name}}
     )
 
-    # 10) Если был fulfilment — шлём клиенту ссылку на счёт
-    if deal_type == "fulfilment":
-        client_chat_id = order.get("chat_id")
-        await svc.fulfilment_bot.send_message(
-            chat_id=client_chat_id,
-            text=f"📄 Ваш счёт готов и доступен для скачивания:\n{url_public}"
-        )
+    # 8) Счёт генерируем в фоне: fulfilment получит ссылку, как только он
+    # будет готов, для delivery он будет ждать кнопки «Оплатить по счету»
+    invoices.prefetch(deal_id, issue=deal_type == "fulfilment")
 
-    else:
-        # 10) Для delivery просим выбрать способ оплаты
+    if deal_type != "fulfilment":
+        # 9) Для delivery просим выбрать способ оплаты
         client_chat_id = order.get("chat_id")
         pay_keyboard = {
             "keyboard": [
@@ -514,10 +452,7 @@ async def render_driver_message(order: dict) -> tuple[str, InlineKeyboardMarkup]
 
     # <-- вот здесь берём тип из заказа
     order_type = order.get("type", "delivery")
-    client = await users_collection.find_one({
-        "chat_id": order["chat_id"],
-        "type":    order_type
-    })
+    client = await sessions.get(order["chat_id"], order_type)
     client_username = client.get("username", "—")
 
     text = (
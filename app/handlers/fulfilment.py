@@ -1,13 +1,19 @@
 import re
 import logging
 from app.config import get_settings
-from httpx import AsyncClient
+from httpx import HTTPError
 from datetime import datetime
 from bson import ObjectId
-from app.handlers.decorators import on_command, on_state
+from app.handlers.decorators import on_command, on_state, PAYLOAD_MESSAGE
+from app.capacity import capacity
+from app.dadata import parties
 from app.db import users_collection
+from app.outbox import outbox
+from app.profiles import profiles
+from app import requisites
+from app.sessions import sessions
+from app.tariffs import tariffs
 import app.services as svc
-from aiogram.enums.chat_action import ChatAction
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
@@ -17,20 +23,20 @@ logger = logging.getLogger(__name__)
 async def handle_fulfilment_start(chat_id, user, message):
     # если такого пользователя ещё нет — создаём
     if not user:
-        await users_collection.insert_one({
+        await sessions.create({
             "chat_id": chat_id,
-            "username": message["chat"].get("username"),
-            "first_name": message["chat"].get("first_name"),
-            "last_name": message["chat"].get("last_name"),
+            "username": message.chat.username,
+            "first_name": message.chat.first_name,
+            "last_name": message.chat.last_name,
             "type": "fulfilment",
             "created_at": datetime.utcnow(),
             "active_order": None
         })
+    # брошенная неотправленная заявка не держит место в машине
+    elif user.get("active_order"):
+        await capacity.release(ObjectId(user["active_order"]), unsubmitted_only=True)
     # сбрасываем состояние и текущий заказ
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "start", "active_order": None}}
-    )
+    await sessions.update(chat_id, "fulfilment", {"state": "start", "active_order": None})
     # отсылаем вводное сообщение
     await svc.send_intro_message_ff(chat_id)
 
@@ -50,27 +56,17 @@ async def handle_start_state(chat_id, user, text):
 
 @on_command("Создать новую заявку")
 async def handle_create_application(chat_id, user, message):
-    # 1) Смотрим, есть ли у юзера предыдущие заказы и собираем уникальные org_name
-    cursor = users_collection.database["orders"].find({"chat_id": chat_id})
-    orgs = set()
-    async for order in cursor:
-        if (order.get("inn")
-            and order.get("org_name")
-            and order.get("org_address")
-            and order.get("rs")
-            and order.get("bik")):
-            orgs.add(order["org_name"])
+    # 1) Берём из профиля клиента организации с полными реквизитами
+    profile = await profiles.get(chat_id)
+    orgs = [org["org_name"] for org in profiles.ranked(profile, "orgs")]
 
     if orgs:
         # 2a) Есть организации — предлагаем выбрать или ввести ИНН
-        buttons = [[{"text": n} ] for n in sorted(orgs)]
+        buttons = [[{"text": n} ] for n in orgs]
         buttons.append([{"text": "🔄 Начать заново"}])
         keyboard = {"keyboard": buttons, "resize_keyboard": True}
 
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "select_existing_org"}}
-        )
+        await sessions.update(chat_id, "fulfilment", {"state": "select_existing_org"})
         await svc.send_text(
             chat_id,
             "Выберите организацию из списка или введите ИНН компании",
@@ -80,40 +76,39 @@ async def handle_create_application(chat_id, user, message):
 
     else:
         # 2b) Нет — сразу просим ИНН
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "awaiting_inn"}}
-        )
+        await sessions.update(chat_id, "fulfilment", {"state": "awaiting_inn"})
         await svc.send_text(chat_id, "Введите ИНН компании", svc.fulfilment_bot)
 
 @on_state("awaiting_inn")
 async def handle_inn_input(chat_id, user, text):
-    inn = text
-
-    # 1) Запрос к Dadata
-    async with AsyncClient() as client:
-        resp = await client.post(
-            "https://suggestions.dadata.ru/suggestions/api/4_1/rs/findById/party",
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Token {settings.DADATA_TOKEN}"
-            },
-            json={"query": inn}
+    inn = text.strip()
+
+    # 0) Опечатки отсекаем по контрольным цифрам, не тратя запрос к Dadata
+    error = requisites.check_inn(inn)
+    if error:
+        await svc.send_text(chat_id, f"❌ {error} Проверьте ИНН.", svc.fulfilment_bot)
+        return
+
+    # 1) Организация по ИНН (кэш, при промахе — Dadata)
+    try:
+        party = await parties.find_party(inn)
+    except HTTPError as e:
+        logger.error("Dadata findById/party failed for %s: %s", inn, e)
+        await svc.send_text(
+            chat_id,
+            "❌ Не удалось проверить ИНН. Попробуйте ещё раз чуть позже.",
+            svc.fulfilment_bot
         )
-    data = resp.json()
-    suggestions = data.get("suggestions", [])
+        return
 
     # 2) Если не нашли — остаёмся в той же стадии
-    if not suggestions:
+    if party is None:
         await svc.send_text(chat_id, "❌ Организация не найдена. Проверьте ИНН.", svc.fulfilment_bot)
         return
 
-    # 3) Берём первую подсказку
-    item = suggestions[0]
-    org_name    = item["data"]["name"]["full_with_opf"]
-    addr_obj    = item["data"].get("address")
-    org_address = addr_obj["value"] if addr_obj else "— адрес не указан —"
+    # 3) Название и адрес организации
+    org_name    = party["org_name"]
+    org_address = party["org_address"]
 
     # 4) Вставляем «плоский» заказ в коллекцию orders
     order_doc = {
@@ -130,10 +125,7 @@ async def handle_inn_input(chat_id, user, text):
     order_id = str(res.inserted_id)
 
     # 5) Сохраняем в профиле пользователя активный заказ и переводим в confirm_inn
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"active_order": order_id, "state": "confirm_inn"}}
-    )
+    await sessions.update(chat_id, "fulfilment", {"active_order": order_id, "state": "confirm_inn"})
 
     # 6) Спрашиваем подтверждение
     keyboard = {
@@ -155,25 +147,15 @@ async def handle_select_existing_org(chat_id, user, text):
     # Если пользователь ввёл цифры — это ИНН, переходим к вводу ИНН
     if text.isdigit():
         # Передаём текущего user, но его при этом можно обновить:
-        user = await users_collection.find_one({"chat_id": chat_id, "type": "fulfilment"})
+        user = await sessions.get(chat_id, "fulfilment")
         await handle_inn_input(chat_id, user, text)
         return
 
     # Иначе это выбор существующей организации по названию
     org_name = text
 
-    # 2) Ищем последний полностью заполненный заказ с таким org_name
-    last_order = await users_collection.database["orders"].find_one(
-        {
-            "chat_id": chat_id,
-            "org_name": org_name,
-            "inn": {"$exists": True},
-            "org_address": {"$exists": True},
-            "rs": {"$exists": True},
-            "bik": {"$exists": True}
-        },
-        sort=[("created_at", -1)]
-    )
+    # 2) Берём последние реквизиты организации с таким org_name из профиля клиента
+    last_order = profiles.find_org(await profiles.get(chat_id), org_name)
     if not last_order:
         # Не нашли — просим ввести ИНН
         await svc.send_text(
@@ -183,10 +165,7 @@ async def handle_select_existing_org(chat_id, user, text):
             {"keyboard":[[{"text":"🔄 Начать заново"}]], "resize_keyboard": True}
         )
         # Остаёмся в той же стадии
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "select_existing_org"}}
-        )
+        await sessions.update(chat_id, "fulfilment", {"state": "select_existing_org"})
         return
 
     # 3) Копируем все поля из найденного заказа
@@ -206,13 +185,10 @@ async def handle_select_existing_org(chat_id, user, text):
     new_order_id = str(res.inserted_id)
 
     # 4) Сохраняем новый active_order и переходим к выбору склада
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {
+    await sessions.update(chat_id, "fulfilment", {
             "active_order": new_order_id,
             "state":        "select_warehouse"
-        }}
-    )
+        })
 
     # 5) Предлагаем выбрать склад
     # Предлагаем выбрать склад — используем WAREHOUSES из services.py
@@ -232,10 +208,7 @@ async def handle_select_existing_org(chat_id, user, text):
 async def handle_confirm_inn(chat_id, user, text):
     # 1) Подтвердили найденную организацию → ввод Р/С
     if text == "✅ Продолжить":
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "awaiting_rs"}}
-        )
+        await sessions.update(chat_id, "fulfilment", {"state": "awaiting_rs"})
         keyboard = {
             "keyboard": [[{"text": "🔄 Начать заново"}]],
             "resize_keyboard": True
@@ -250,10 +223,7 @@ async def handle_confirm_inn(chat_id, user, text):
 
     # 2) Хотят ввести ИНН заново → возвращаем в awaiting_inn
     if text == "❌ Ввести другой ИНН":
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "awaiting_inn"}}
-        )
+        await sessions.update(chat_id, "fulfilment", {"state": "awaiting_inn"})
         await svc.send_text(
             chat_id,
             "Введите ИНН компании",
@@ -280,16 +250,12 @@ async def handle_confirm_inn(chat_id, user, text):
 async def handle_rs_input(chat_id, user, text):
     rs = text.strip()
     order_id = user["active_order"]
-    # Сохраняем расчётный счёт в заказ
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"rs": rs}}
-    )
-    # Переходим к вводу БИК
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "awaiting_bik"}}
-    )
+    error = requisites.check_account(rs)
+    if error:
+        await svc.send_text(chat_id, f"❌ {error} Введите расчётный счёт ещё раз.", svc.fulfilment_bot)
+        return
+    # Сохраняем расчётный счёт в заказ и переходим к вводу БИК
+    await svc.transition(chat_id, "fulfilment", order_id, {"rs": rs}, {"state": "awaiting_bik"})
     # Только «Начать заново»
     await svc.send_text(
         chat_id,
@@ -303,16 +269,25 @@ async def handle_rs_input(chat_id, user, text):
 async def handle_bik_input(chat_id, user, text):
     bik = text.strip()
     order_id = user["active_order"]
-    # Сохраняем БИК в заказ
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"bik": bik}}
-    )
-    # Переходим к выбору склада
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "select_warehouse"}}
-    )
+    error = requisites.check_bik(bik)
+    if error:
+        await svc.send_text(chat_id, f"❌ {error} Введите БИК ещё раз.", svc.fulfilment_bot)
+        return
+    # Ключ счёта считается от БИК: при несовпадении ошибка может быть в любом из двух,
+    # поэтому возвращаемся к вводу счёта
+    order = await users_collection.database["orders"].find_one({"_id": ObjectId(order_id)}, {"rs": 1})
+    rs = (order or {}).get("rs")
+    if rs and not requisites.account_key_valid(rs, bik):
+        await sessions.update(chat_id, "fulfilment", {"state": "awaiting_rs"})
+        await svc.send_text(
+            chat_id,
+            "❌ Расчётный счёт не соответствует БИК банка. Введите расчётный счёт ещё раз.",
+            svc.fulfilment_bot,
+            {"keyboard":[[{"text":"🔄 Начать заново"}]], "resize_keyboard":True}
+        )
+        return
+    # Сохраняем БИК в заказ и переходим к выбору склада
+    await svc.transition(chat_id, "fulfilment", order_id, {"bik": bik}, {"state": "select_warehouse"})
     
     rows = [svc.WAREHOUSES[i : i + 2] for i in range(0, len(svc.WAREHOUSES), 2)]
     buttons = [[{"text": w} for w in row] for row in rows]
@@ -337,10 +312,7 @@ async def handle_select_warehouse(chat_id, user, text):
             svc.fulfilment_bot,
             {"keyboard":[[{"text":"🔄 Начать заново"}]], "resize_keyboard": True}
         )
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "start"}}
-        )
+        await sessions.update(chat_id, "fulfilment", {"state": "start"})
         return
 
     warehouse = text.strip()
@@ -359,49 +331,10 @@ async def handle_select_warehouse(chat_id, user, text):
         )
         return
 
-    # сохраняем выбранный склад
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"warehouse": warehouse}}
-    )
-    # переходим к выбору даты сдачи
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "select_delivery_date"}}
-    )
+    # сохраняем выбранный склад и переходим к выбору даты сдачи
+    await svc.transition(chat_id, "fulfilment", order_id, {"warehouse": warehouse}, {"state": "select_delivery_date"})
 
-    # 1) Получаем пары дат через calculate_schedule
-    slots = svc.calculate_schedule(warehouse)
-    if not slots:
-        await svc.send_text(
-            chat_id,
-            "⛔ Нет доступных дат сдачи поставки на ближайшие 2 недели.",
-            svc.fulfilment_bot,
-            {"keyboard":[[{"text":"🔄 Начать заново"}]], "resize_keyboard": True}
-        )
-        return
-
-    # 2) Собираем до 6 уникальных дат сдачи
-    unique_dates: list[str] = []
-    for slot in slots:
-        d_str = slot["delivery"].strftime("%d.%m.%Y")
-        if d_str not in unique_dates:
-            unique_dates.append(d_str)
-        if len(unique_dates) >= 6:
-            break
-
-    # 3) Разбиваем по 2 даты на строку
-    rows = [unique_dates[i : i + 2] for i in range(0, len(unique_dates), 2)]
-    buttons = [[{"text": d} for d in row] for row in rows]
-    buttons.append([{"text": "🔄 Начать заново"}])
-    keyboard = {"keyboard": buttons, "resize_keyboard": True}
-
-    await svc.send_text(
-        chat_id,
-        "📅 Выберите дату сдачи поставки:",
-        svc.fulfilment_bot,
-        keyboard
-    )
+    await svc.prompt_delivery_date_selection(chat_id, svc.fulfilment_bot, warehouse)
 
 @on_state("select_delivery_date")
 async def handle_select_delivery_date(chat_id, user, text):
@@ -410,39 +343,36 @@ async def handle_select_delivery_date(chat_id, user, text):
     try:
         delivery_date = _dt.strptime(text.strip(), "%d.%m.%Y").date()
     except ValueError:
+        delivery_date = None
+
+    order_id = user.get("active_order")
+    oid = ObjectId(order_id) if isinstance(order_id, str) else order_id
+    order = await users_collection.database["orders"].find_one({"_id": oid})
+    warehouse = order.get("warehouse", "")
+    # груз уже известен, если вернулись к выбору даты с шага количества или отправки
+    load = svc.load_units(order.get("cargo_type"), order["cargo_quantity"]) if order.get("cargo_quantity") else 0
+
+    # Дата должна быть в текущем календаре склада: клавиатура могла устареть
+    # (праздник, закрытие склада, заполненная машина), а дату могли ввести вручную
+    if delivery_date is None or not svc.delivery_date_available(warehouse, delivery_date, load):
         await svc.send_text(
             chat_id,
-            "❌ Неверный формат даты. Выберите из кнопок.",
+            "❌ Неверный формат даты. Выберите из кнопок." if delivery_date is None
+            else "❌ Эта дата недоступна. Выберите из кнопок.",
             svc.fulfilment_bot
         )
-        order_id = user.get("active_order")
-        oid = ObjectId(order_id) if isinstance(order_id, str) else order_id
-        order = await users_collection.database["orders"].find_one({"_id": oid})
-        warehouse = order.get("warehouse", "")
-        await svc.prompt_delivery_date_selection(chat_id, svc.fulfilment_bot, warehouse)
+        await svc.prompt_delivery_date_selection(chat_id, svc.fulfilment_bot, warehouse, load)
         return
 
-    order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"delivery_date": delivery_date.isoformat()}}
-    )
+    order = await svc.transition(chat_id, "fulfilment", order_id, {"delivery_date": delivery_date.isoformat()})
 
     # Получаем возможные даты забора для этой даты разгрузки
-    order     = await users_collection.database["orders"].find_one({"_id": ObjectId(order_id)})
     warehouse = order.get("warehouse", "")
     pickups   = svc.get_pickup_dates(warehouse, delivery_date)  # :contentReference[oaicite:0]{index=0}
 
     # Если только одна дата забора — сохраняем и сразу переходим к выбору типа груза
     if len(pickups) == 1:
-        await users_collection.database["orders"].update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": {"pickup_date": pickups[0].isoformat()}}
-        )
-        await users_collection.update_one(
-            {"chat_id": chat_id, "type": "fulfilment"},
-            {"$set": {"state": "select_cargo_type"}}
-        )
+        await svc.transition(chat_id, "fulfilment", order_id, {"pickup_date": pickups[0].isoformat()}, {"state": "select_cargo_type"})
         await svc.send_cargo_type_selection(chat_id, svc.fulfilment_bot)
         return
 
@@ -455,10 +385,7 @@ async def handle_select_delivery_date(chat_id, user, text):
     buttons.append([{"text": "🔄 Начать заново"}])
     keyboard = {"keyboard": buttons, "resize_keyboard": True}
 
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "select_pickup_date"}}
-    )
+    await sessions.update(chat_id, "fulfilment", {"state": "select_pickup_date"})
     await svc.send_text(
         chat_id,
         "🚚 Выберите дату забора поставки:",
@@ -503,14 +430,7 @@ async def handle_select_pickup_date(chat_id, user, text):
         return
 
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"pickup_date": pickup_date.isoformat()}}
-    )
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "select_cargo_type"}}
-    )
+    await svc.transition(chat_id, "fulfilment", order_id, {"pickup_date": pickup_date.isoformat()}, {"state": "select_cargo_type"})
     await svc.send_cargo_type_selection(chat_id, svc.fulfilment_bot)
 
 @on_state("select_cargo_type")
@@ -528,18 +448,9 @@ async def handle_select_cargo_type(chat_id, user, text):
     # Определяем тип груза
     cargo_type = "boxes" if "Короба" in text else "pallets"
 
-    # Сохраняем в заказе
+    # Сохраняем в заказе, переходим к вводу количества и меняем состояние
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"cargo_type": cargo_type}}
-    )
-
-    # Переходим к вводу количества и меняем состояние
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "enter_cargo_quantity"}}
-    )
+    await svc.transition(chat_id, "fulfilment", order_id, {"cargo_type": cargo_type}, {"state": "enter_cargo_quantity"})
 
     # Запрос количества
     cargo_label = "коробов" if cargo_type == "boxes" else "палет"
@@ -573,17 +484,14 @@ async def handle_enter_cargo_quantity(chat_id, user, text):
         )
         return
 
-    # сохраняем количество
+    # груз должен поместиться в машину на выбранную дату
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"cargo_quantity": qty}}
-    )
-    # переходим к выбору/вводу адреса
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "enter_pickup_address"}}
-    )
+    order = await users_collection.database["orders"].find_one({"_id": ObjectId(order_id)})
+    if not await svc.check_cargo_room(chat_id, svc.fulfilment_bot, "fulfilment", order, qty):
+        return
+
+    # сохраняем количество и переходим к выбору/вводу адреса
+    await svc.transition(chat_id, "fulfilment", order_id, {"cargo_quantity": qty}, {"state": "enter_pickup_address"})
     await svc.prompt_pickup_address_selection(chat_id, svc.fulfilment_bot)
 
 
@@ -600,14 +508,7 @@ async def handle_enter_pickup_address(chat_id, user, text):
         return
 
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"pickup_address": address}}
-    )
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "enter_phone_number"}}
-    )
+    await svc.transition(chat_id, "fulfilment", order_id, {"pickup_address": address}, {"state": "enter_phone_number"})
     await svc.prompt_phone_number_selection(chat_id, svc.fulfilment_bot)
 
 
@@ -623,30 +524,23 @@ async def handle_typing_pickup_address(chat_id, user, text):
         return
 
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"pickup_address": address}}
-    )
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "enter_phone_number"}}
-    )
+    await svc.transition(chat_id, "fulfilment", order_id, {"pickup_address": address}, {"state": "enter_phone_number"})
     await svc.prompt_phone_number_selection(chat_id, svc.fulfilment_bot)
 
 
-@on_state("enter_phone_number")
+@on_state("enter_phone_number", payload=PAYLOAD_MESSAGE)
 async def handle_enter_phone_number(chat_id, user, message):
     # 0) Логируем, что пришло
     logger.info("enter_phone_number ➔ %r", message)
 
-    # 1) Пробуем достать контакт из message["contact"]
+    # 1) Пробуем достать контакт из message.contact
     phone = None
-    contact = message.get("contact")
-    if contact and contact.get("phone_number"):
-        phone = contact["phone_number"]
+    contact = message.contact
+    if contact and contact.phone_number:
+        phone = contact.phone_number
 
     # 2) Иначе пробуем извлечь из текста
-    text = message.get("text", "").strip()
+    text = message.text.strip()
     if phone is None and text.startswith("📞 "):
         phone = text.lstrip("📞 ").strip()
     if phone is None and re.fullmatch(r"\+\d+", text):
@@ -662,25 +556,11 @@ async def handle_enter_phone_number(chat_id, user, message):
 
     # 4) Сохраняем номер в заказ и рассчитываем стоимость
     order_id = user.get("active_order")
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"phone_number": phone}}
-    )
-    cost = await svc.calculate_delivery_cost_ff(chat_id)
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"delivery_cost": cost}}
-    )
-
-    # 5) Переходим к финальному суммари
-    await users_collection.update_one(
-        {"chat_id": chat_id, "type": "fulfilment"},
-        {"$set": {"state": "awaiting_order_submit"}}
-    )
+    order = await svc.transition(chat_id, "fulfilment", order_id, {"phone_number": phone})
+    cost = tariffs.quote("fulfilment", order.get("warehouse", ""), order.get("cargo_type"), order.get("cargo_quantity", 0))
 
-    order = await users_collection.database["orders"].find_one(
-        {"_id": ObjectId(order_id)}
-    )
+    # 5) Сохраняем стоимость и переходим к финальному суммари
+    order = await svc.transition(chat_id, "fulfilment", order_id, {"delivery_cost": cost}, {"state": "awaiting_order_submit"})
 
     delivery_iso = order.get("delivery_date")
     pickup_iso   = order.get("pickup_date")
@@ -764,32 +644,29 @@ async def handle_awaiting_order_submit(chat_id, user, text):
     order = await users_collection.database["orders"].find_one(
         {"_id": ObjectId(order_id)}
     )
-    delivery_iso = order.get("delivery_date")
-    pickup_iso   = order.get("pickup_date")
-
-    delivery_str = (
-    datetime.fromisoformat(delivery_iso)
-    .strftime("%d.%m.%Y")
-    if delivery_iso
-    else "—"
-    )
-    pickup_str = (
-        datetime.fromisoformat(pickup_iso)
-        .strftime("%d.%m.%Y")
-        if pickup_iso
-        else "—"
-    )
+    if order.get("sync_status"):
+        await svc.send_text(
+            chat_id,
+            "ℹ️ Эта заявка уже отправлена.",
+            svc.fulfilment_bot
+        )
+        return
 
-    # Отправляем в Битрикс и получаем номер заявки
-    await svc.fulfilment_bot.send_chat_action(chat_id, ChatAction.TYPING)
-    deal_id = await svc.send_to_bitrix(order, user.get("username", ""))
+    # Бронируем место в машине на дату сдачи; если день уже заполнен —
+    # возвращаем к выбору даты (заполненные дни в клавиатуру не попадут)
+    if not await capacity.reserve(order):
+        await sessions.update(chat_id, "fulfilment", {"state": "select_delivery_date"})
+        await svc.send_text(
+            chat_id,
+            "⛔ На выбранную дату машины уже заполнены. Пожалуйста, выберите другую дату сдачи.",
+            svc.fulfilment_bot
+        )
+        await svc.prompt_delivery_date_selection(
+            chat_id, svc.fulfilment_bot, order.get("warehouse", ""),
+            svc.load_units(order.get("cargo_type"), order.get("cargo_quantity", 0))
+        )
+        return
 
-    # Сохраняем bitrix_deal_id в заказе
-    await users_collection.database["orders"].update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"bitrix_deal_id": deal_id}}
-    )
-    
     # Удаляем прежнее суммари
     summ_mid = order.get("summ_mid")
     if summ_mid:
@@ -798,39 +675,20 @@ async def handle_awaiting_order_submit(chat_id, user, text):
         except:
             pass
 
-    # Составляем окончательный суммари с номером заявки
-    parts = [
-        "✅ Ваша заявка успешно отправлена!",
-        "📋 Содержимое заявки:",
-        "",
-        f"🆔 Номер заявки: #{deal_id}",
-        f"🏢 Организация: {order.get('org_name', '—')}",
-        f"📍 Адрес организации: {order.get('org_address', '—')}",
-        f"🏦 БИК: {order.get('bik', '—')}",
-        f"💳 Р/С: {order.get('rs', '—')}",
-        f"📦 Тип поставки: {'Короба' if order.get('cargo_type') == 'boxes' else 'Палеты'}",
-        f"🔢 Количество: {order.get('cargo_quantity', '—')}",
-        f"🏬 Склад: {order.get('warehouse', '—')}",
-        f"📅 Дата сдачи: {delivery_str}",
-        f"🚚 Дата забора: {pickup_str}",
-        f"🏠 Адрес забора: {order.get('pickup_address', '—')}",
-        f"📞 Телефон: {order.get('phone_number', '—')}",
-        f"💰 Стоимость: {order.get('delivery_cost', '—')} ₽"
-    ]
-    final_summary = "\n".join(parts)
-    
-    # Отправляем финальное суммари и сохраняем его message_id
-    sent = await svc.send_text(
-        chat_id,
-        final_summary,
-        svc.fulfilment_bot
-    )
-    new_mid = getattr(sent, "message_id", None) or sent.json().get("result", {}).get("message_id")
-    if new_mid:
-        await users_collection.database["orders"].update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": {"summ_mid": new_mid}}
+    # Сразу подтверждаем приём: номер заявки допишет в это сообщение
+    # воркер outbox, когда сделка будет создана в Битриксе
+    try:
+        sent = await svc.send_text(
+            chat_id,
+            svc.render_order_summary(order),
+            svc.fulfilment_bot
         )
+        new_mid = getattr(sent, "message_id", None) or sent.json().get("result", {}).get("message_id")
+        await outbox.enqueue(order, user.get("username", ""), new_mid)
+    except Exception:
+        # заявка не ушла в outbox — место в машине не держим
+        await capacity.release(order["_id"], unsubmitted_only=True)
+        raise
 
     notify_text = "📨 При изменении статуса вы получите уведомление."
     keyboard = {
@@ -0,0 +1,90 @@
+# app/holidays.py
+
+import asyncio
+import logging
+from datetime import date
+from typing import Dict, Optional, Set
+
+from pymongo.errors import PyMongoError
+
+from app.config import get_settings
+from app.db import calendar_exceptions_collection
+from app.schedule import schedule_index
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Виды исключений: closed — сдачи нет, open — сдача в день вне расписания,
+# no_pickup — забора нет
+KINDS = ("closed", "open", "no_pickup")
+
+class CalendarOverlay:
+    """
+    Исключения из недельного расписания: праздники, закрытия складов
+    маркетплейса, переносы. Документ коллекции calendar_exceptions —
+    {warehouse (или "*" для всех), date (ISO), kind, reason}; исключения
+    заводятся и удаляются прямо в Mongo (одно на склад + дату + вид, см.
+    уникальный индекс в app/indexes.py).
+
+    Исключения начиная с сегодняшнего дня компилируются в schedule_index,
+    так что выбор даты остаётся поиском по словарю. Каждый процесс раз
+    в poll_interval секунд перечитывает коллекцию (она маленькая) и,
+    если набор изменился, пересобирает календарь затронутых складов —
+    правки, в том числе сделанные прямо в Mongo, применяются без рестарта.
+    """
+
+    def __init__(self, collection, poll_interval: float):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self._current: Dict[str, Dict[str, Set[date]]] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        try:
+            await self.refresh()
+        except PyMongoError as e:
+            logger.error("Cannot load calendar exceptions: %s", e)
+        self._poll_task = asyncio.create_task(self._poll(), name="calendar-poll")
+
+    async def stop(self) -> None:
+        if self._poll_task:
+            self._poll_task.cancel()
+            await asyncio.gather(self._poll_task, return_exceptions=True)
+            self._poll_task = None
+
+    async def refresh(self) -> bool:
+        """Перечитывает исключения; True — набор изменился и календарь пересобран."""
+        exceptions: Dict[str, Dict[str, Set[date]]] = {}
+        cursor = self.collection.find(
+            {"date": {"$gte": date.today().isoformat()}},
+            {"warehouse": 1, "date": 1, "kind": 1},
+        )
+        async for doc in cursor:
+            if doc.get("kind") not in KINDS:
+                logger.warning("Skipping calendar exception with unknown kind: %s", doc)
+                continue
+            try:
+                day = date.fromisoformat(doc["date"])
+            except (KeyError, TypeError, ValueError):
+                logger.warning("Skipping calendar exception with bad date: %s", doc)
+                continue
+            exceptions.setdefault(doc["warehouse"], {}).setdefault(doc["kind"], set()).add(day)
+
+        if exceptions == self._current:
+            return False
+        self._current = exceptions
+        schedule_index.set_exceptions(exceptions)
+        logger.info("Calendar exceptions applied: %s", {
+            wh: {kind: len(days) for kind, days in kinds.items()} for wh, kinds in exceptions.items()
+        })
+        return True
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.refresh()
+            except PyMongoError as e:
+                logger.warning("Calendar exceptions refresh failed: %s", e)
+
+holidays = CalendarOverlay(calendar_exceptions_collection, settings.CALENDAR_POLL_INTERVAL)
@@ -0,0 +1,149 @@
+# app/indexes.py
+
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.config import get_settings
+from app.db import db
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Индексы, которые нужны горячим запросам, по коллекциям.
+# Имена не задаём — Mongo сгенерирует стандартные (chat_id_1_type_1 …),
+# так уже существующие индексы с теми же ключами не конфликтуют.
+INDEXES: dict[str, list[IndexModel]] = {
+    "users": [
+        # sessions.get / update — на каждый апдейт
+        IndexModel([("chat_id", ASCENDING), ("type", ASCENDING)], unique=True),
+        # поиск водителя по username при назначении на заказ
+        IndexModel([("type", ASCENDING), ("username", ASCENDING)]),
+    ],
+    "orders": [
+        # callback'и водителей и хуки Битрикса
+        IndexModel([("bitrix_deal_id", ASCENDING)]),
+        # списки адресов / телефонов / организаций клиента, последний заказ по org_name
+        IndexModel([("chat_id", ASCENDING), ("created_at", DESCENDING)]),
+        # «свежий заказ в статусе …» (оплата, in_progress)
+        IndexModel([("chat_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)]),
+        # ежедневные напоминания об оплате
+        IndexModel([("status", ASCENDING), ("invoice_url", ASCENDING)]),
+    ],
+    # расчёты читаются только по _id
+    "calcs": [],
+    "updates": [
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=settings.UPDATE_DEDUP_TTL),
+    ],
+    # воркеры outbox забирают ближайшие к отправке записи
+    "outbox": [
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+    ],
+    # кэш Dadata: протухшая запись (expires_at) ещё отдаётся, пока Dadata
+    # недоступна, и удаляется только по истечении purge_at
+    "dadata_parties": [
+        IndexModel([("purge_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    # последняя версия тарифов; уникальность защищает от двух одновременных publish
+    "tariffs": [
+        IndexModel([("version", DESCENDING)], unique=True),
+    ],
+    # карта заполненных дней: документы начиная с сегодняшней даты
+    "capacity": [
+        IndexModel([("date", ASCENDING)]),
+    ],
+    # исключения календаря: выборка начиная с сегодняшней даты; одно исключение
+    # каждого вида на склад и дату
+    "calendar_exceptions": [
+        IndexModel([("date", ASCENDING), ("warehouse", ASCENDING), ("kind", ASCENDING)], unique=True),
+    ],
+    # процессы, делящие лимит Битрикса: запись умершего процесса удаляется сама
+    "bitrix_processes": [
+        IndexModel([("seen_at", ASCENDING)], expireAfterSeconds=int(settings.BITRIX_HEARTBEAT * 3)),
+    ],
+    "job_runs": [
+        IndexModel([("job_id", ASCENDING), ("started_at", DESCENDING)]),
+    ],
+}
+
+# Индексы, которые больше не нужны и мешают (удаляются при старте)
+OBSOLETE_INDEXES: dict[str, list[str]] = {
+    # TTL по expires_at удалял запись раньше, чем её можно отдать протухшей
+    "dadata_parties": ["expires_at_1"],
+}
+
+def _key(spec) -> tuple:
+    return tuple((field, int(direction)) for field, direction in spec.items())
+
+async def ensure_indexes() -> None:
+    """
+    Удаляет устаревшие индексы и создаёт объявленные (create_indexes идемпотентен).
+    Ошибка одной коллекции (например, дубликаты под уникальным индексом)
+    не мешает остальным и не роняет старт приложения — такой индекс
+    попадёт в missing отчёта.
+    """
+    for name, index_names in OBSOLETE_INDEXES.items():
+        try:
+            existing = await db[name].index_information()
+            for index_name in index_names:
+                if index_name in existing:
+                    await db[name].drop_index(index_name)
+                    logger.info("Dropped obsolete index %s on %s", index_name, name)
+        except OperationFailure as e:
+            logger.error("Failed to drop obsolete indexes on %s: %s", name, e)
+
+    for name, models in INDEXES.items():
+        if not models:
+            continue
+        try:
+            await db[name].create_indexes(models)
+        except OperationFailure as e:
+            logger.error("Failed to create indexes on %s: %s", name, e)
+
+    for name, report in (await index_report()).items():
+        if report["missing"]:
+            logger.warning("Missing indexes on %s: %s", name, report["missing"])
+
+async def report_indexes() -> int:
+    """
+    Периодическая задача: пишет в лог недостающие и неиспользуемые индексы.
+    Возвращает число проблемных индексов.
+    """
+    problems = 0
+    for name, report in (await index_report()).items():
+        if report["missing"]:
+            logger.warning("Missing indexes on %s: %s", name, report["missing"])
+        if report["unused"]:
+            logger.warning("Unused indexes on %s: %s", name, report["unused"])
+        problems += len(report["missing"]) + len(report["unused"])
+    return problems
+
+async def index_report() -> dict[str, dict[str, list]]:
+    """
+    По каждой коллекции из INDEXES:
+      missing — объявлены, но отсутствуют в базе;
+      unused  — есть в базе, но с момента старта mongod ни разу не
+                использовались ($indexStats), кроме _id_.
+    """
+    report = {}
+    for name, models in INDEXES.items():
+        collection = db[name]
+        existing = {}
+        async for index in collection.list_indexes():
+            existing[_key(index["key"])] = index["name"]
+
+        declared = {_key(m.document["key"]): m.document["name"] for m in models}
+        missing = [idx for key, idx in declared.items() if key not in existing]
+
+        unused = []
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                if stat["name"] != "_id_" and stat["accesses"]["ops"] == 0:
+                    unused.append(stat["name"])
+        except OperationFailure as e:
+            # $indexStats недоступен (нет прав / старая версия) — пропускаем
+            logger.info("Index stats unavailable for %s: %s", name, e)
+
+        report[name] = {"missing": missing, "unused": sorted(unused)}
+    return report
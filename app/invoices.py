@@ -0,0 +1,217 @@
+# app/invoices.py
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+import app.services as svc
+from app.bitrix_client import priority, BACKGROUND
+from app.config import get_settings
+from app.db import orders_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class InvoiceCache:
+    """
+    Счета Битрикса («Счёт» из генератора документов), сгенерированные заранее.
+
+    Генерация — три последовательных вызова Битрикса, поэтому она
+    запускается в фоне (prefetch), как только сделка переходит в финальную
+    стадию, а публичная ссылка сохраняется в заказе в invoice_public_url.
+    Поле invoice_url по-прежнему ставится только когда счёт выдан клиенту
+    (от него зависят напоминания об оплате).
+
+    Один счёт на сделку: в процессе повторные запросы ждут уже идущую
+    генерацию, между процессами генерацию «застолбляет» lease в заказе
+    (invoice_locked_until, продлевается, пока генерация идёт), остальные
+    ждут появления ссылки. Ссылка записывается, только если lease всё ещё
+    наш; иначе берётся ссылка процесса, который его перехватил.
+    Периодический sweep() догоняет заказы, для которых фоновая генерация
+    не дошла до конца (ошибка Битрикса, рестарт).
+
+    Фулфилменту счёт выдаётся сразу (issue), доставке — по кнопке
+    «Оплатить по счету».
+    """
+
+    def __init__(self, orders, lease: int, sweep_batch: int, poll_interval: float = 0.5):
+        self.orders = orders
+        self.lease = timedelta(seconds=lease)
+        self.sweep_batch = sweep_batch
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def prefetch(self, deal_id: str, issue: bool = False) -> None:
+        """
+        Запускает генерацию счёта в фоне, не дожидаясь результата.
+        issue=True — по готовности сразу отправить счёт клиенту.
+        """
+        task = asyncio.create_task(self._prefetch(deal_id, issue), name=f"invoice-{deal_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def get(self, order: dict) -> str:
+        """
+        Публичная ссылка на счёт по сделке заказа: из заказа, если уже
+        сгенерирована, иначе генерирует (или дожидается идущей генерации).
+        """
+        if order.get("invoice_public_url"):
+            return order["invoice_public_url"]
+        return await self._single_flight(order["bitrix_deal_id"])
+
+    async def issue(self, deal_id: str, url: str) -> bool:
+        """
+        Выдаёт счёт клиенту: ставит invoice_url (с этого момента заказ
+        попадает в напоминания) и отправляет ссылку. Повторно не выдаёт.
+        """
+        order = await self.orders.find_one_and_update(
+            {"bitrix_deal_id": deal_id, "invoice_url": {"$exists": False}},
+            {"$set": {"invoice_url": url, "payment_type": "invoice"}},
+        )
+        if order is None:
+            return False
+        bot = svc.fulfilment_bot if order.get("type") == "fulfilment" else svc.delivery_bot
+        await bot.send_message(
+            chat_id=order["chat_id"],
+            text=f"📄 Ваш счёт готов и доступен для скачивания:\n{url}"
+        )
+        return True
+
+    async def sweep(self) -> int:
+        """
+        Периодическая задача: генерирует счета для заказов, ожидающих оплаты,
+        у которых ссылки ещё нет, и выдаёт невыданные счета фулфилмента.
+        Возвращает число обработанных заказов.
+        """
+        cursor = self.orders.find(
+            {
+                "status":         "awaiting_payment",
+                "bitrix_deal_id": {"$exists": True},
+                "invoice_url":    {"$exists": False},
+                "$or": [
+                    {"invoice_public_url": {"$exists": False}},
+                    {"type": "fulfilment"},
+                ],
+            },
+            {"bitrix_deal_id": 1, "type": 1, "invoice_public_url": 1},
+        ).limit(self.sweep_batch)
+
+        done = 0
+        async for order in cursor:
+            deal_id = order["bitrix_deal_id"]
+            try:
+                with priority(BACKGROUND):
+                    url = await self.get(order)
+                if order.get("type") == "fulfilment":
+                    await self.issue(deal_id, url)
+            except Exception as e:
+                logger.error("Invoice sweep failed for deal %s: %s", deal_id, e)
+                continue
+            done += 1
+        return done
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _prefetch(self, deal_id: str, issue: bool) -> None:
+        try:
+            with priority(BACKGROUND):
+                url = await self._single_flight(deal_id)
+            if issue:
+                await self.issue(deal_id, url)
+        except Exception as e:
+            # догонит sweep или запрос клиента
+            logger.error("Invoice prefetch failed for deal %s: %s", deal_id, e)
+
+    async def _single_flight(self, deal_id: str) -> str:
+        future = self._inflight.get(deal_id)
+        if future is None:
+            future = asyncio.ensure_future(self._generate(deal_id))
+            self._inflight[deal_id] = future
+            future.add_done_callback(lambda _: self._inflight.pop(deal_id, None))
+        # shield: отмена одного ожидающего не должна прерывать генерацию для остальных
+        return await asyncio.shield(future)
+
+    async def _generate(self, deal_id: str) -> str:
+        deadline = datetime.utcnow() + self.lease
+        while True:
+            now = datetime.utcnow()
+            order = await self.orders.find_one_and_update(
+                {
+                    "bitrix_deal_id":     deal_id,
+                    "invoice_public_url": {"$exists": False},
+                    "$or": [
+                        {"invoice_locked_until": {"$exists": False}},
+                        {"invoice_locked_until": {"$lt": now}},
+                    ],
+                },
+                {"$set": {"invoice_locked_until": now + self.lease, "invoice_locked_by": self.owner}},
+            )
+            if order is not None:
+                break
+
+            # ссылка уже есть или счёт генерирует другой процесс — ждём её
+            order = await self.orders.find_one({"bitrix_deal_id": deal_id}, {"invoice_public_url": 1})
+            if order is None:
+                raise RuntimeError(f"Нет заказа для сделки {deal_id}")
+            if order.get("invoice_public_url"):
+                return order["invoice_public_url"]
+            if now > deadline:
+                raise TimeoutError(f"Счёт по сделке {deal_id} генерируется другим процессом слишком долго")
+            await asyncio.sleep(self.poll_interval)
+
+        heartbeat = asyncio.create_task(self._hold_lease(order["_id"]), name=f"invoice-lease-{deal_id}")
+        try:
+            url = await svc.generate_deal_invoice_public_url(deal_id)
+        except BaseException:
+            await self.orders.update_one(
+                {"_id": order["_id"], "invoice_locked_by": self.owner},
+                {"$unset": {"invoice_locked_until": "", "invoice_locked_by": ""}}
+            )
+            raise
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+        res = await self.orders.update_one(
+            {"_id": order["_id"], "invoice_locked_by": self.owner},
+            {"$set": {"invoice_public_url": url, "invoice_generated_at": datetime.utcnow()},
+             "$unset": {"invoice_locked_until": "", "invoice_locked_by": ""}}
+        )
+        if not res.matched_count:
+            # lease перехватил другой процесс — его ссылка главная, если уже есть
+            current = await self.orders.find_one({"_id": order["_id"]}, {"invoice_public_url": 1})
+            logger.warning("Invoice lease for deal %s was lost during generation", deal_id)
+            if current and current.get("invoice_public_url"):
+                return current["invoice_public_url"]
+            return url
+        logger.info("Invoice for deal %s cached: %s", deal_id, url)
+        return url
+
+    async def _hold_lease(self, order_id) -> None:
+        interval = self.lease.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                res = await self.orders.update_one(
+                    {"_id": order_id, "invoice_locked_by": self.owner},
+                    {"$set": {"invoice_locked_until": datetime.utcnow() + self.lease}}
+                )
+            except Exception as e:
+                logger.error("Invoice lease renewal failed for %s: %s", order_id, e)
+                continue
+            if not res.matched_count:
+                logger.warning("Invoice lease on %s lost while generating", order_id)
+                return
+
+invoices = InvoiceCache(
+    orders_collection,
+    settings.INVOICE_LEASE_SECONDS,
+    settings.INVOICE_SWEEP_BATCH,
+)
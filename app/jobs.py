@@ -2,8 +2,9 @@ import datetime
 from app.db import users_collection
 import app.services as svc
 
-async def send_payment_reminders():
+async def send_payment_reminders() -> int:
     now = datetime.datetime.utcnow()
+    sent = 0
     cursor = users_collection.database["orders"].find({
         "status": "awaiting_payment",
         "invoice_url": {"$exists": True}
@@ -36,3 +37,6 @@ async def send_payment_reminders():
             {"_id":order["_id"]},
             {"$set":{"last_reminder_at": now}}
         )
+        sent += 1
+
+    return sent
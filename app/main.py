@@ -2,9 +2,21 @@ from fastapi import FastAPI
 from app.config import get_settings
 import httpx
 import logging
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
 from app.jobs import send_payment_reminders
+from app.scheduler import job_scheduler
+from app.sessions import sessions
+from app.bitrix_client import bitrix
+from app.capacity import capacity
+from app.dadata import parties
+from app.holidays import holidays
+from app.indexes import ensure_indexes, report_indexes
+from app.invoices import invoices
+from app.outbox import outbox
+from app.requisites import bik_directory, report_invalid_requisites
+from app.paykeeper import paykeeper
+from app.rate_share import rate_share
+from app.tariffs import tariffs
+from app.updates import update_queue
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,6 +27,7 @@ from app.endpoints.fulfilment import router as fulfilment_router
 from app.endpoints.driver import router as driver_router
 from app.endpoints.bitrix import router as bitrix_router
 from app.endpoints.payments import router as payments_router
+from app.endpoints.tariffs import router as tariffs_router
 
 settings = get_settings()
 app = FastAPI()
@@ -25,6 +38,7 @@ app.include_router(fulfilment_router, prefix=settings.API_PREFIX)
 app.include_router(driver_router, prefix=settings.API_PREFIX)
 app.include_router(bitrix_router, prefix=settings.API_PREFIX)
 app.include_router(payments_router, prefix=settings.API_PREFIX)
+app.include_router(tariffs_router, prefix=settings.API_PREFIX)
 
 # Установка Telegram webhook при запуске
 @app.on_event("startup")
@@ -47,7 +61,58 @@ async def register_telegram_webhooks():
             except Exception as e:
                 print(f"[WEBHOOK ERROR] {name}: {e}")
 
-scheduler = AsyncIOScheduler()
-scheduler.add_job(send_payment_reminders, 'cron', hour=9, minute=0, id="daily_reminder_9am")
-scheduler.start()
-logger.info("Scheduled send_payment_reminders every day at 09:00")
\ No newline at end of file
+@app.on_event("startup")
+async def create_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def load_bik_directory():
+    # справочник БИК грузится один раз, до первого ввода реквизитов
+    bik_directory()
+
+@app.on_event("startup")
+async def start_bitrix_client():
+    await bitrix.start()
+    await rate_share.start()
+    await paykeeper.start()
+    await parties.start()
+
+@app.on_event("startup")
+async def start_update_queue():
+    await sessions.start()
+    await tariffs.start()
+    await capacity.start()
+    await holidays.start()
+    update_queue.start()
+    outbox.start()
+
+# Задачи по расписанию выполняет только процесс-лидер (см. app/scheduler.py)
+job_scheduler.add_job(send_payment_reminders, "daily_reminder_9am", "cron", hour=9, minute=0)
+job_scheduler.add_job(report_indexes, "daily_index_report", "cron", hour=4, minute=0)
+job_scheduler.add_job(report_invalid_requisites, "daily_requisites_audit", "cron", hour=4, minute=30)
+job_scheduler.add_job(invoices.sweep, "invoice_sweep", "interval", minutes=settings.INVOICE_SWEEP_MINUTES)
+
+@app.on_event("startup")
+async def start_scheduler():
+    await job_scheduler.start()
+    logger.info("Scheduled send_payment_reminders every day at 09:00")
+
+# Остановка — одним обработчиком и по порядку: сначала всё, что ещё может
+# ходить в Битрикс / PayKeeper / Dadata (задачи, очередь апдейтов, outbox,
+# счета), и только потом закрываем их клиентов
+@app.on_event("shutdown")
+async def shutdown():
+    await job_scheduler.stop()
+    await update_queue.stop()
+    await outbox.stop()
+    await invoices.stop()
+    await tariffs.stop()
+    await capacity.stop()
+    await holidays.stop()
+    await sessions.stop()
+
+    await rate_share.stop()
+    await bitrix.close()
+    await paykeeper.close()
+    await parties.close()
+    logger.info("Bitrix call stats: %s", bitrix.stats())
@@ -0,0 +1,244 @@
+# app/outbox.py
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import app.services as svc
+from app.bitrix_client import priority, BACKGROUND, INTERACTIVE
+from app.config import get_settings
+from app.db import outbox_collection, orders_collection
+from app.profiles import profiles
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class BitrixOutbox:
+    """
+    Очередь отправки заявок в Битрикс, переживающая рестарты.
+
+    При отправке заявки хендлер только пишет запись в коллекцию outbox
+    (_id = _id заказа, поэтому повторное нажатие не создаст вторую сделку)
+    и сразу отвечает клиенту. Пул воркеров забирает записи, создаёт
+    сделку через send_to_bitrix и правит сообщение клиента, дописывая номер
+    заявки. При ошибке запись возвращается в очередь с экспоненциальной
+    задержкой, после max_attempts помечается failed.
+
+    Запись «захватывается» воркером на lease секунд (locked_until) и, пока
+    идёт отправка, lease продлевается каждые lease/3 секунд — долгий
+    send_to_bitrix (ожидание лимита, повторы) не отдаст запись второму
+    воркеру. Если процесс умер посреди отправки, продления прекращаются
+    и запись подхватит другой воркер. Перед повторной отправкой (после
+    ошибки или перехвата записи) сделка сначала ищется в Битриксе по
+    ORIGIN_ID = _id заказа: прошлая попытка могла её создать, не получив ответа.
+    """
+
+    def __init__(self, collection, orders, workers: int, poll_interval: float, lease: int,
+                 max_attempts: int, backoff: float, backoff_max: float):
+        self.collection = collection
+        self.orders = orders
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"outbox-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info("Bitrix outbox started with %s workers", self.workers)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, order: dict, telegram_username: str, summ_mid: Optional[int]) -> bool:
+        """
+        Ставит заказ в очередь синхронизации. summ_mid — сообщение клиенту,
+        которое будет дополнено номером заявки.
+        Возвращает False, если заказ уже был отправлен.
+        """
+        now = datetime.utcnow()
+        try:
+            await self.collection.insert_one({
+                "_id":             order["_id"],
+                "chat_id":         order["chat_id"],
+                "type":            order.get("type"),
+                "username":        telegram_username,
+                "summ_mid":        summ_mid,
+                "status":          "pending",
+                "attempts":        0,
+                "next_attempt_at": now,
+                "created_at":      now,
+            })
+        except DuplicateKeyError:
+            return False
+
+        await self.orders.update_one(
+            {"_id": order["_id"]},
+            {"$set": {"sync_status": "pending", "submitted_at": now, "summ_mid": summ_mid}}
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                # воркер, взявший запись, умер, не дождавшись ответа
+                {"status": "processing", "locked_until": {"$lt": now}},
+            ]},
+            {"$set": {"status": "processing", "locked_until": now + self.lease, "owner": self.owner},
+             "$inc": {"claims": 1}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                entry = await self._claim()
+            except Exception as e:
+                logger.error("Outbox claim failed: %s", e)
+                entry = None
+
+            if entry is None:
+                # ждём новую запись из этого процесса или следующий опрос
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = asyncio.create_task(self._hold_lease(entry["_id"]), name=f"outbox-lease-{entry['_id']}")
+            try:
+                await self._process(entry)
+            except Exception as e:
+                await self._retry(entry, e)
+            finally:
+                heartbeat.cancel()
+                await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _hold_lease(self, entry_id) -> None:
+        interval = self.lease.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                res = await self.collection.update_one(
+                    {"_id": entry_id, "status": "processing", "owner": self.owner},
+                    {"$set": {"locked_until": datetime.utcnow() + self.lease}}
+                )
+            except Exception as e:
+                logger.error("Outbox: lease renewal failed for %s: %s", entry_id, e)
+                continue
+            if not res.matched_count:
+                logger.warning("Outbox: lease on %s lost while processing", entry_id)
+                return
+
+    async def _process(self, entry: dict) -> None:
+        order = await self.orders.find_one({"_id": entry["_id"]})
+        if order is None:
+            logger.warning("Outbox: order %s no longer exists, dropping", entry["_id"])
+            await self.collection.update_one({"_id": entry["_id"]}, {"$set": {"status": "dropped"}})
+            return
+
+        # сделка могла быть создана попыткой, которая не успела отметить запись
+        deal_id = order.get("bitrix_deal_id")
+        if not deal_id:
+            # первую попытку ждёт клиент, повторы уступают место интерактивным запросам
+            lane = BACKGROUND if entry.get("attempts") else INTERACTIVE
+            with priority(lane):
+                if entry.get("attempts") or entry.get("claims", 1) > 1:
+                    # прошлая попытка (или умерший воркер) могла создать сделку и не
+                    # дождаться ответа (таймаут чтения на crm.deal.add / batch) —
+                    # ищем её по _id заказа
+                    deal_id = await svc.find_deal_by_order(order)
+                    if deal_id:
+                        logger.info("Outbox: order %s already has deal %s in Bitrix", entry["_id"], deal_id)
+                if not deal_id:
+                    deal_id = await svc.send_to_bitrix(order, entry.get("username", ""))
+
+        await self.collection.update_one(
+            {"_id": entry["_id"]},
+            {"$set": {"status": "done", "deal_id": deal_id, "finished_at": datetime.utcnow()},
+             "$unset": {"locked_until": ""}}
+        )
+        await self.orders.update_one({"_id": entry["_id"]}, {"$set": {"sync_status": "synced"}})
+        logger.info("Outbox: order %s synced as deal %s", entry["_id"], deal_id)
+
+        # Пополняем адресную книгу клиента (организация, адрес, телефон)
+        try:
+            await profiles.record_order(order)
+        except Exception as e:
+            logger.error("Outbox: cannot update client profile for %s: %s", entry["_id"], e)
+        await self._notify(entry, svc.render_order_summary(order, deal_id))
+
+    async def _retry(self, entry: dict, error: Exception) -> None:
+        attempts = entry.get("attempts", 0) + 1
+        update = {"attempts": attempts, "last_error": repr(error)}
+        if attempts >= self.max_attempts:
+            update["status"] = "failed"
+            logger.error("Outbox: order %s failed after %s attempts: %s", entry["_id"], attempts, error)
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.backoff_max)
+            update.update(status="pending", next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+            logger.warning(
+                "Outbox: order %s attempt %s failed (%s), retry in %.0fs",
+                entry["_id"], attempts, error, delay
+            )
+        try:
+            await self.collection.update_one({"_id": entry["_id"]}, {"$set": update})
+        except Exception as e:
+            # запись останется processing и будет перехвачена по истечении lease
+            logger.error("Outbox: failed to reschedule %s: %s", entry["_id"], e)
+            return
+
+        if update["status"] == "failed":
+            await self.orders.update_one({"_id": entry["_id"]}, {"$set": {"sync_status": "failed"}})
+            await self._notify(
+                entry,
+                "⚠️ Не удалось зарегистрировать заявку автоматически. "
+                "Менеджер свяжется с вами в ближайшее время.",
+                edit=False
+            )
+
+    async def _notify(self, entry: dict, text: str, edit: bool = True) -> None:
+        bot = svc.fulfilment_bot if entry.get("type") == "fulfilment" else svc.delivery_bot
+        try:
+            if edit and entry.get("summ_mid"):
+                await bot.edit_message_text(chat_id=entry["chat_id"], message_id=entry["summ_mid"], text=text)
+            else:
+                await bot.send_message(chat_id=entry["chat_id"], text=text)
+        except Exception as e:
+            logger.error("Outbox: cannot update client message for %s: %s", entry["_id"], e)
+
+outbox = BitrixOutbox(
+    outbox_collection,
+    orders_collection,
+    settings.OUTBOX_WORKERS,
+    settings.OUTBOX_POLL_INTERVAL,
+    settings.OUTBOX_LEASE_SECONDS,
+    settings.OUTBOX_MAX_ATTEMPTS,
+    settings.OUTBOX_BACKOFF,
+    settings.OUTBOX_BACKOFF_MAX,
+)
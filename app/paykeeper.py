@@ -0,0 +1,113 @@
+# app/paykeeper.py
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import httpx
+
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class PayKeeperError(RuntimeError):
+    """PayKeeper ответил без нужных полей (нет token / invoice_id)."""
+
+class PayKeeperClient:
+    """
+    Общий на процесс клиент PayKeeper для счетов СБП.
+
+    Один httpx.AsyncClient с пулом keep-alive соединений и Basic-авторизацией.
+    Токен (/info/settings/token/) кэшируется на token_ttl секунд и
+    обновляется заранее, за refresh_ahead до истечения; одновременные
+    запросы ждут одно обновление, а не запрашивают токен каждый сам.
+    Если PayKeeper отверг токен раньше срока, он сбрасывается и запрос
+    повторяется один раз со свежим.
+    """
+
+    def __init__(self, token_url: str, invoice_url: str, user: str, password: str,
+                 timeout: float, token_ttl: int, refresh_ahead: int = 60):
+        self.token_url = token_url
+        self.invoice_url = invoice_url
+        self.auth = (user, password)
+        self.timeout = timeout
+        self.token_ttl = token_ttl
+        self.refresh_ahead = refresh_ahead
+        self._client: Optional[httpx.AsyncClient] = None
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(auth=self.auth, timeout=self.timeout)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def bill_base_url(self) -> str:
+        # https://<сервер>/change/invoice/preview/ → https://<сервер>
+        return self.invoice_url.split("/change")[0]
+
+    async def create_invoice(self, amount: float, clientid: str, orderid: str,
+                             service_name: str, client_phone: str) -> str:
+        """
+        Создаёт счёт и возвращает публичную ссылку на оплату.
+        :raises PayKeeperError: PayKeeper не вернул token / invoice_id
+        :raises httpx.HTTPError: сетевая ошибка или не-2xx ответ
+        """
+        if self._client is None:
+            await self.start()
+
+        payment_data = {
+            "pay_amount":   amount,
+            "clientid":     clientid,
+            "orderid":      orderid,
+            "service_name": service_name,
+            "client_phone": client_phone,
+        }
+        for attempt in range(2):
+            token = await self._get_token(force=attempt > 0)
+            resp = await self._client.post(self.invoice_url, data={**payment_data, "token": token})
+            resp.raise_for_status()
+            result = resp.json()
+            invoice_id = result.get("invoice_id")
+            if invoice_id:
+                return f"{self.bill_base_url}/bill/{invoice_id}/"
+            logger.warning("PayKeeper invoice rejected (attempt %s): %s", attempt + 1, resp.text)
+        raise PayKeeperError(f"PayKeeper не вернул invoice_id: {resp.text}")
+
+    async def _get_token(self, force: bool = False) -> str:
+        if not force and self._fresh():
+            return self._token
+        stale = self._token
+        async with self._refresh_lock:
+            # пока ждали блокировку, токен мог обновить другой запрос
+            if self._fresh() and (not force or self._token != stale):
+                return self._token
+            resp = await self._client.get(self.token_url)
+            resp.raise_for_status()
+            token = resp.json().get("token")
+            if not token:
+                raise PayKeeperError(f"PayKeeper не вернул token: {resp.text}")
+            self._token = token
+            self._expires_at = time.monotonic() + self.token_ttl
+            logger.info("PayKeeper token refreshed")
+            return token
+
+    def _fresh(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_ahead
+
+paykeeper = PayKeeperClient(
+    settings.PAYKEEPER_TOKEN_URL,
+    settings.PAYKEEPER_INVOICE_URL,
+    settings.PAYKEEPER_USER,
+    settings.PAYKEEPER_PASSWORD,
+    settings.PAYKEEPER_TIMEOUT,
+    settings.PAYKEEPER_TOKEN_TTL,
+)
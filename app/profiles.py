@@ -0,0 +1,132 @@
+# app/profiles.py
+
+import hashlib
+import logging
+from datetime import datetime
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from app.config import get_settings
+from app.db import client_profiles_collection, orders_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Реквизиты организации, без которых её нельзя переиспользовать в новой заявке
+ORG_FIELDS = ("inn", "org_name", "org_address", "rs", "bik")
+
+def _key(value: str) -> str:
+    # значения (адреса, названия) могут содержать точки и $ — в ключи поля не годятся
+    return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+def _order_entries(order: dict) -> dict[str, dict[str, dict]]:
+    """
+    Раскладывает заказ на записи профиля: {раздел: {ключ: поля записи}}.
+    Неполные организации, «адреса» из одних цифр и пустые значения пропускаются.
+    """
+    entries: dict[str, dict[str, dict]] = {"orgs": {}, "addresses": {}, "phones": {}}
+
+    if all(order.get(f) for f in ORG_FIELDS):
+        name = order["org_name"]
+        entries["orgs"][_key(name)] = {f: order[f] for f in ORG_FIELDS}
+
+    addr = (order.get("pickup_address") or "").strip()
+    if addr and not addr.isdigit():
+        entries["addresses"][_key(addr)] = {"value": addr}
+
+    phone = (order.get("phone_number") or "").strip()
+    if phone:
+        entries["phones"][_key(phone)] = {"value": phone}
+
+    return entries
+
+class ClientProfiles:
+    """
+    Материализованная «адресная книга» клиента: один документ на chat_id
+    с уникальными организациями, адресами забора и телефонами из его заказов.
+    У каждой записи — count (сколько раз использована) и last_used.
+
+    Профиль обновляется инкрементально при отправке заявки (record_order).
+    Для клиентов, у которых профиля ещё нет, он один раз собирается
+    из истории заказов при первом обращении.
+    """
+
+    SECTIONS = ("orgs", "addresses", "phones")
+
+    def __init__(self, collection, orders, max_buttons: int, half_life_days: int):
+        self.collection = collection
+        self.orders = orders
+        self.max_buttons = max_buttons
+        self.half_life = half_life_days * 86400
+
+    async def get(self, chat_id: int) -> dict:
+        profile = await self.collection.find_one({"_id": chat_id})
+        if profile is None:
+            profile = await self._backfill(chat_id)
+        return profile
+
+    async def record_order(self, order: dict) -> None:
+        chat_id = order["chat_id"]
+        now = datetime.utcnow()
+        update_set = {"updated_at": now}
+        update_inc = {}
+        for section, items in _order_entries(order).items():
+            for key, fields in items.items():
+                for name, value in fields.items():
+                    update_set[f"{section}.{key}.{name}"] = value
+                update_set[f"{section}.{key}.last_used"] = now
+                update_inc[f"{section}.{key}.count"] = 1
+
+        update = {"$set": update_set}
+        if update_inc:
+            update["$inc"] = update_inc
+        res = await self.collection.update_one({"_id": chat_id}, update)
+        if not res.matched_count:
+            # профиля ещё нет — собираем из истории, текущий заказ уже в ней
+            await self._backfill(chat_id)
+
+    async def _backfill(self, chat_id: int) -> dict:
+        profile = {"_id": chat_id, **{s: {} for s in self.SECTIONS}}
+        cursor = self.orders.find({"chat_id": chat_id}).sort("created_at", 1)
+        async for order in cursor:
+            used_at = order.get("created_at") or datetime.utcnow()
+            for section, items in _order_entries(order).items():
+                for key, fields in items.items():
+                    entry = profile[section].setdefault(key, {"count": 0})
+                    entry.update(fields)
+                    entry["count"] += 1
+                    entry["last_used"] = used_at
+        profile["updated_at"] = datetime.utcnow()
+
+        try:
+            await self.collection.insert_one(profile)
+        except DuplicateKeyError:
+            # профиль параллельно создал другой воркер
+            return await self.collection.find_one({"_id": chat_id})
+        logger.info("Backfilled client profile for chat %s", chat_id)
+        return profile
+
+    def ranked(self, profile: dict, section: str) -> list[dict]:
+        """
+        Записи раздела по убыванию веса: count, затухающий вдвое
+        за каждые PROFILE_HALF_LIFE_DAYS с последнего использования.
+        """
+        now = datetime.utcnow()
+
+        def score(entry: dict) -> float:
+            age = (now - entry.get("last_used", now)).total_seconds()
+            return entry.get("count", 0) * 0.5 ** (max(age, 0) / self.half_life)
+
+        entries = sorted(profile.get(section, {}).values(), key=score, reverse=True)
+        return entries[:self.max_buttons]
+
+    def find_org(self, profile: dict, org_name: str) -> Optional[dict]:
+        return profile.get("orgs", {}).get(_key(org_name))
+
+profiles = ClientProfiles(
+    client_profiles_collection,
+    orders_collection,
+    settings.PROFILE_MAX_BUTTONS,
+    settings.PROFILE_HALF_LIFE_DAYS,
+)
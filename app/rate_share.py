@@ -0,0 +1,90 @@
+# app/rate_share.py
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Optional
+
+from app.bitrix_client import bitrix, RateLimiter
+from app.config import get_settings
+from app.db import bitrix_processes_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class RateShare:
+    """
+    Делит лимит вебхука Битрикса (rate/burst на весь портал) между
+    процессами, которые им пользуются: воркерами uvicorn и хостами.
+
+    Каждый процесс раз в heartbeat секунд отмечается в коллекции
+    bitrix_processes и считает записи, обновлённые за последние три
+    интервала; свой RateLimiter он настраивает на rate / N. Запись
+    умершего процесса перестаёт учитываться через три интервала.
+    Пока подсчёта не было (или база недоступна), N = processes из настроек.
+    """
+
+    def __init__(self, collection, limiter: RateLimiter, rate: float, burst: int,
+                 processes: int, heartbeat: float):
+        self.collection = collection
+        self.limiter = limiter
+        self.rate = rate
+        self.burst = burst
+        self.heartbeat = heartbeat
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.processes = 0
+        self._task: Optional[asyncio.Task] = None
+        self._apply(processes)
+
+    async def start(self) -> None:
+        await self._beat()
+        self._task = asyncio.create_task(self._loop(), name="bitrix-rate-share")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # уходим сразу, чтобы остальные процессы забрали нашу долю
+        try:
+            await self.collection.delete_one({"_id": self.owner})
+        except Exception as e:
+            logger.warning("Cannot unregister from Bitrix rate share: %s", e)
+
+    async def _beat(self) -> None:
+        now = datetime.utcnow()
+        try:
+            await self.collection.update_one({"_id": self.owner}, {"$set": {"seen_at": now}}, upsert=True)
+            alive = await self.collection.count_documents(
+                {"seen_at": {"$gte": now - timedelta(seconds=self.heartbeat * 3)}}
+            )
+        except Exception as e:
+            logger.warning("Bitrix rate share heartbeat failed: %s", e)
+            return
+        self._apply(max(1, alive))
+
+    def _apply(self, processes: int) -> None:
+        if processes == self.processes:
+            return
+        self.processes = processes
+        self.limiter.configure(self.rate / processes, max(1, self.burst // processes))
+        logger.info(
+            "Bitrix rate limit shared by %s processes: %.2f req/s, burst %s",
+            processes, self.limiter.rate, self.limiter.burst
+        )
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            await self._beat()
+
+rate_share = RateShare(
+    bitrix_processes_collection,
+    bitrix.limiter,
+    settings.BITRIX_RATE,
+    settings.BITRIX_BURST,
+    settings.BITRIX_PROCESSES,
+    settings.BITRIX_HEARTBEAT,
+)
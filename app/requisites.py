@@ -0,0 +1,135 @@
+# app/requisites.py
+
+import logging
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from typing import Iterable, Optional
+
+from app.config import get_settings
+from app.db import orders_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Весовые коэффициенты контрольных цифр ИНН (приказ ФНС)
+INN10_WEIGHTS = (2, 4, 10, 3, 5, 9, 4, 6, 8)
+INN12_WEIGHTS_11 = (7, 2, 4, 10, 3, 5, 9, 4, 6, 8)
+INN12_WEIGHTS_12 = (3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8)
+
+# Весовые коэффициенты ключа счёта (положение ЦБ № 579-П), на 3 + 20 разрядов
+ACCOUNT_WEIGHTS = (7, 1, 3) * 7 + (7, 1)
+
+def _checksum(digits: str, weights: tuple) -> int:
+    return sum(int(d) * w for d, w in zip(digits, weights)) % 11 % 10
+
+def check_inn(inn: str) -> Optional[str]:
+    """ИНН юрлица (10 цифр) или ИП (12 цифр) с контрольными цифрами. None — ИНН корректен."""
+    if not inn.isdigit() or len(inn) not in (10, 12):
+        return "ИНН должен состоять из 10 или 12 цифр."
+    if len(inn) == 10:
+        ok = _checksum(inn, INN10_WEIGHTS) == int(inn[9])
+    else:
+        ok = (_checksum(inn, INN12_WEIGHTS_11) == int(inn[10])
+              and _checksum(inn, INN12_WEIGHTS_12) == int(inn[11]))
+    return None if ok else "Неверные контрольные цифры ИНН."
+
+def check_account(rs: str) -> Optional[str]:
+    """Формат расчётного счёта; ключ проверяется вместе с БИК в account_key_valid()."""
+    if not rs.isdigit() or len(rs) != 20:
+        return "Расчётный счёт должен состоять из 20 цифр."
+    return None
+
+def check_bik(bik: str) -> Optional[str]:
+    """Формат БИК (9 цифр, код России 04) и, если задан справочник, его наличие в нём."""
+    if not bik.isdigit() or len(bik) != 9:
+        return "БИК должен состоять из 9 цифр."
+    if not bik.startswith("04"):
+        return "БИК российского банка начинается с 04."
+    directory = bik_directory()
+    if directory and bik not in directory:
+        return "Банк с таким БИК не найден в справочнике ЦБ."
+    return None
+
+def account_key_valid(rs: str, bik: str) -> bool:
+    """
+    Контрольный ключ счёта: 3 разряда от БИК + 20 цифр счёта с весами 7-1-3,
+    сумма младших разрядов произведений должна делиться на 10.
+    Для счетов в подразделениях ЦБ (РКЦ) вместо трёх последних цифр БИК
+    берутся «0» и его 5–6 цифры.
+    """
+    prefix = "0" + bik[4:6] if bik[6:9] in ("000", "001", "002") else bik[6:9]
+    digits = prefix + rs
+    return sum(int(d) * w % 10 for d, w in zip(digits, ACCOUNT_WEIGHTS)) % 10 == 0
+
+def validate_requisites(inn: Optional[str], rs: Optional[str], bik: Optional[str]) -> dict[str, str]:
+    """Все ошибки реквизитов заказа: {поле: причина}. Пустые поля пропускаются."""
+    errors = {}
+    if inn and (error := check_inn(inn)):
+        errors["inn"] = error
+    if rs and (error := check_account(rs)):
+        errors["rs"] = error
+    if bik and (error := check_bik(bik)):
+        errors["bik"] = error
+    if rs and bik and not errors.keys() & {"rs", "bik"} and not account_key_valid(rs, bik):
+        errors["rs"] = "Расчётный счёт не соответствует БИК банка."
+    return errors
+
+@lru_cache(maxsize=1)
+def bik_directory() -> dict[str, str]:
+    """
+    Справочник БИК → название банка из файла ЦБ в формате ED807 (XML),
+    путь — settings.BIK_DIRECTORY_PATH. Без файла проверка по справочнику
+    не выполняется. Читается один раз на процесс.
+    """
+    path = settings.BIK_DIRECTORY_PATH
+    if not path:
+        return {}
+    directory = {}
+    try:
+        for _, elem in ET.iterparse(path):
+            # пространство имён ED807 меняется от версии к версии — сравниваем локальные имена
+            if elem.tag.rsplit("}", 1)[-1] != "BICDirectoryEntry":
+                continue
+            bic = elem.get("BIC")
+            info = next((c for c in elem if c.tag.rsplit("}", 1)[-1] == "ParticipantInfo"), None)
+            if bic:
+                directory[bic] = info.get("NameP", "") if info is not None else ""
+            elem.clear()
+    except (OSError, ET.ParseError) as e:
+        logger.error("Cannot load BIK directory %s: %s", path, e)
+        return {}
+    logger.info("Loaded %s BIK entries from %s", len(directory), path)
+    return directory
+
+def audit_orders(orders: Iterable[dict]) -> list[dict]:
+    """Пакетная проверка: [{_id, chat_id, errors}] для заказов с ошибками в реквизитах."""
+    report = []
+    for order in orders:
+        errors = validate_requisites(order.get("inn"), order.get("rs"), order.get("bik"))
+        if errors:
+            report.append({"_id": order["_id"], "chat_id": order.get("chat_id"), "errors": errors})
+    return report
+
+async def report_invalid_requisites() -> int:
+    """
+    Периодическая задача: проверяет реквизиты заказов, пишет ошибки в лог.
+    Возвращает число заказов с ошибками.
+    """
+    cursor = orders_collection.find(
+        {"$or": [{"inn": {"$exists": True}}, {"rs": {"$exists": True}}, {"bik": {"$exists": True}}]},
+        {"chat_id": 1, "inn": 1, "rs": 1, "bik": 1},
+    )
+    invalid = 0
+    batch = []
+    async for order in cursor:
+        batch.append(order)
+        if len(batch) >= 1000:
+            invalid += _log_report(audit_orders(batch))
+            batch = []
+    invalid += _log_report(audit_orders(batch))
+    return invalid
+
+def _log_report(report: list[dict]) -> int:
+    for item in report:
+        logger.warning("Invalid requisites in order %s (chat %s): %s", item["_id"], item["chat_id"], item["errors"])
+    return len(report)
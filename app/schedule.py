@@ -0,0 +1,225 @@
+# app/schedule.py
+
+from datetime import date, timedelta
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Set
+
+from aiogram.types import ReplyKeyboardMarkup
+
+DELIVERY_DAYS_BY_WAREHOUSE = {
+    # ПН, СР, ПТ
+    **{wh: [0, 2, 4] for wh in ["Электросталь", "Обухово", "Рязань", "Владимир"]},
+    # ПН только Котовск
+    "Котовск": [0],
+    # ВТ, ЧТ, СБ
+    **{wh: [1, 3, 5] for wh in ["Коледино", "Подольск", "Подольск 4", "Тула"]},
+    # ВС
+    **{wh: [6] for wh in ["Казань", "Новосемейкино"]},
+}
+
+# Сколько дней вперёд (начиная с завтра) показываем даты сдачи
+DAYS_AHEAD = 14
+# Сколько дат сдачи помещается на клавиатуру
+MAX_DATE_BUTTONS = 6
+
+RESTART_BUTTON = {"text": "🔄 Начать заново"}
+
+def _pickup_candidates(warehouse: str, delivery_date: date) -> List[date]:
+    """
+      - Котовск: предыдущее воскресенье + день доставки
+      - Казань/Новосемейкино: пятница перед доставкой
+      - Все остальные: день доставки
+    """
+    if warehouse == "Котовск":
+        prev_sunday = delivery_date - timedelta(days=(delivery_date.weekday() - 6) % 7)
+        return [prev_sunday, delivery_date]
+    if warehouse in {"Казань", "Новосемейкино"}:
+        prev_friday = delivery_date - timedelta(days=(delivery_date.weekday() - 4) % 7)
+        return [prev_friday]
+    return [delivery_date]
+
+def date_keyboard(dates: List[date]) -> ReplyKeyboardMarkup:
+    """Даты по две в ряд + «Начать заново»."""
+    labels = [d.strftime("%d.%m.%Y") for d in dates]
+    buttons = [[{"text": t} for t in labels[i : i + 2]] for i in range(0, len(labels), 2)]
+    buttons.append([RESTART_BUTTON])
+    return ReplyKeyboardMarkup.model_validate({"keyboard": buttons, "resize_keyboard": True})
+
+class WarehouseCalendar(NamedTuple):
+    slots: List[Dict[str, date]]          # [{"delivery", "pickup"}] как у calculate_schedule
+    pickups: Dict[date, List[date]]       # дата сдачи → даты забора
+    delivery_dates: List[date]            # первые MAX_DATE_BUTTONS дат сдачи
+    keyboard: Optional[ReplyKeyboardMarkup]  # клавиатура выбора даты сдачи (None — дат нет)
+
+class DayRules(NamedTuple):
+    """Отступления склада от недельного расписания."""
+    closed: FrozenSet[date] = frozenset()     # сдачи нет (праздник, склад закрыт, машины заполнены)
+    open: FrozenSet[date] = frozenset()       # сдача есть, хотя день недели не по расписанию
+    no_pickup: FrozenSet[date] = frozenset()  # забора нет
+
+    def is_delivery_day(self, warehouse: str, d: date) -> bool:
+        if d in self.closed:
+            return False
+        return d in self.open or d.weekday() in DELIVERY_DAYS_BY_WAREHOUSE.get(warehouse, [])
+
+    def pickup_dates(self, warehouse: str, delivery_date: date, today: date) -> List[date]:
+        return [
+            p for p in _pickup_candidates(warehouse, delivery_date)
+            if p > today and p not in self.no_pickup
+        ]
+
+NO_RULES = DayRules()
+
+def _build_calendar(warehouse: str, today: date, rules: DayRules = NO_RULES) -> WarehouseCalendar:
+    slots: List[Dict[str, date]] = []
+    pickups: Dict[date, List[date]] = {}
+    for offset in range(1, DAYS_AHEAD + 1):
+        d = today + timedelta(days=offset)
+        if not rules.is_delivery_day(warehouse, d):
+            continue
+        dates = rules.pickup_dates(warehouse, d, today)
+        if not dates:
+            continue
+        pickups[d] = dates
+        slots.extend({"delivery": d, "pickup": p} for p in dates)
+
+    delivery_dates = list(pickups)[:MAX_DATE_BUTTONS]
+    keyboard = date_keyboard(delivery_dates) if delivery_dates else None
+    return WarehouseCalendar(slots, pickups, delivery_dates, keyboard)
+
+class ScheduleIndex:
+    """
+    Календарь сдачи/забора на DAYS_AHEAD дней по всем складам, собранный
+    один раз на день: слоты, даты забора по дате сдачи и готовая клавиатура
+    выбора даты. Индекс привязан к date.today() и пересобирается при
+    первом обращении после полуночи (по локальному времени сервера).
+
+    Поверх недельного расписания накладываются:
+      - исключения календаря (set_exceptions — праздники, закрытия
+        складов, см. app/holidays.py), для склада или для всех ("*");
+      - заблокированные дни (set_blocked — машины заполнены,
+        см. app/capacity.py).
+    При их изменении пересобираются только затронутые склады.
+    """
+
+    def __init__(self):
+        self._day: Optional[date] = None
+        self._calendars: Dict[str, WarehouseCalendar] = {}
+        self._blocked: Dict[str, Set[date]] = {}
+        # склад или "*" → вид исключения → даты
+        self._exceptions: Dict[str, Dict[str, Set[date]]] = {}
+        self._rules: Dict[str, DayRules] = {}
+
+    def calendar(self, warehouse: str) -> WarehouseCalendar:
+        today = date.today()
+        if today != self._day:
+            self.rebuild(today)
+        cal = self._calendars.get(warehouse)
+        if cal is None:
+            # склад вне расписания — пустой календарь, тоже запоминаем
+            cal = self._calendars[warehouse] = _build_calendar(warehouse, today, self.rules(warehouse))
+        return cal
+
+    def rules(self, warehouse: str) -> DayRules:
+        rules = self._rules.get(warehouse)
+        if rules is None:
+            rules = self._rules[warehouse] = self._compile_rules(warehouse)
+        return rules
+
+    def rebuild(self, today: Optional[date] = None) -> None:
+        today = today or date.today()
+        self._calendars = {
+            wh: _build_calendar(wh, today, self.rules(wh))
+            for wh in DELIVERY_DAYS_BY_WAREHOUSE
+        }
+        self._day = today
+
+    def set_blocked(self, blocked: Set[tuple]) -> None:
+        """Пары (склад, дата), которые не предлагать."""
+        by_warehouse: Dict[str, Set[date]] = {}
+        for warehouse, day in blocked:
+            by_warehouse.setdefault(warehouse, set()).add(day)
+        changed = {
+            wh for wh in by_warehouse.keys() | self._blocked.keys()
+            if by_warehouse.get(wh) != self._blocked.get(wh)
+        }
+        self._blocked = by_warehouse
+        self._refresh(changed)
+
+    def set_exceptions(self, exceptions: Dict[str, Dict[str, Set[date]]]) -> None:
+        """Исключения календаря: {склад или "*": {"closed" | "open" | "no_pickup": даты}}."""
+        changed = {
+            wh for wh in exceptions.keys() | self._exceptions.keys()
+            if exceptions.get(wh) != self._exceptions.get(wh)
+        }
+        self._exceptions = exceptions
+        if "*" in changed:
+            changed = set(DELIVERY_DAYS_BY_WAREHOUSE) | self._calendars.keys() | changed
+        self._refresh(changed - {"*"})
+
+    def _compile_rules(self, warehouse: str) -> DayRules:
+        common = self._exceptions.get("*", {})
+        own = self._exceptions.get(warehouse, {})
+
+        def dates(kind: str) -> FrozenSet[date]:
+            return frozenset(common.get(kind, set()) | own.get(kind, set()))
+
+        return DayRules(
+            closed=dates("closed") | frozenset(self._blocked.get(warehouse, set())),
+            open=dates("open"),
+            no_pickup=dates("no_pickup"),
+        )
+
+    def _refresh(self, warehouses: Set[str]) -> None:
+        for wh in warehouses:
+            self._rules.pop(wh, None)
+            if self._day is not None:
+                self._calendars[wh] = _build_calendar(wh, self._day, self.rules(wh))
+
+schedule_index = ScheduleIndex()
+
+def calculate_schedule(
+    warehouse: str,
+    start_date: date = None,
+    days_ahead: int = DAYS_AHEAD
+) -> List[Dict[str, date]]:
+    """
+    Возвращает список словарей с ключами:
+      - 'delivery': дата перевозки (строго > сегодня)
+      - 'pickup':   дата забора (строго > сегодня)
+    По умолчанию start_date = завтра — тогда список берётся из индекса
+    (общий, не изменять).
+    """
+    if start_date is None and days_ahead == DAYS_AHEAD:
+        return schedule_index.calendar(warehouse).slots
+    if start_date is None:
+        start_date = date.today() + timedelta(days=1)
+
+    rules = schedule_index.rules(warehouse)
+    result: List[Dict[str, date]] = []
+    for offset in range(days_ahead):
+        d = start_date + timedelta(days=offset)
+        if rules.is_delivery_day(warehouse, d):
+            for pickup_date in get_pickup_dates(warehouse, d):
+                result.append({"delivery": d, "pickup": pickup_date})
+    return result
+
+def get_pickup_dates(
+    warehouse: str,
+    delivery_date: date
+) -> List[date]:
+    """
+    Возвращает доступные даты забора (строго > сегодня):
+      - Котовск: предыдущий воскресный день + день доставки
+      - Казань/Новосемейкино: пятница перед доставкой
+      - Все остальные: день доставки
+    Даты из исключений календаря (no_pickup) не предлагаются; если сдачи
+    в этот день нет (не по расписанию, closed, машины заполнены) — [].
+    Для дат сдачи из календаря — из индекса.
+    """
+    cached = schedule_index.calendar(warehouse).pickups.get(delivery_date)
+    if cached is not None:
+        return list(cached)
+    rules = schedule_index.rules(warehouse)
+    if not rules.is_delivery_day(warehouse, delivery_date):
+        return []
+    return rules.pickup_dates(warehouse, delivery_date, date.today())
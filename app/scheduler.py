@@ -0,0 +1,175 @@
+# app/scheduler.py
+
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.config import get_settings
+from app.db import locks_collection, job_runs_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[Optional[int]]]
+
+# Плановое время срабатывания триггера для выполняемого запуска
+_scheduled_run_time: ContextVar[Optional[datetime]] = ContextVar("scheduled_run_time", default=None)
+
+class _RunTimeExecutor(AsyncIOExecutor):
+    """
+    AsyncIOExecutor, который передаёт задаче плановое время срабатывания
+    (при coalesce=True — последнее из run_times): задача создаётся
+    в контексте с выставленным _scheduled_run_time.
+    """
+
+    def _do_submit_job(self, job, run_times):
+        token = _scheduled_run_time.set(run_times[-1])
+        try:
+            super()._do_submit_job(job, run_times)
+        finally:
+            _scheduled_run_time.reset(token)
+
+class JobScheduler:
+    """
+    Планировщик фоновых задач, общий для всех воркеров uvicorn и хостов.
+
+    Триггеры (cron/interval) тикают в каждом процессе, но задачу выполняет
+    только лидер — владелец lease-блокировки в коллекции locks. Лидер
+    продлевает lease каждые lease/3 секунд; если он умер, lease истекает
+    и блокировку забирает другой процесс.
+
+    Каждый запуск дополнительно «застолбляется» в job_runs по ключу
+    job_id + плановое время срабатывания триггера (а не время фактического
+    старта), так что ни опоздавший запуск, ни смена лидера не выполнят одно
+    срабатывание дважды. Там же хранится история: начало, конец,
+    число обработанных элементов и ошибка.
+    """
+
+    LOCK_NAME = "scheduler-leader"
+
+    def __init__(self, locks, runs, lease_seconds: int):
+        self.locks = locks
+        self.runs = runs
+        self.lease = timedelta(seconds=lease_seconds)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._scheduler = AsyncIOScheduler(executors={"default": _RunTimeExecutor()})
+        self._lease_task: Optional[asyncio.Task] = None
+        self._lease_until: Optional[datetime] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lease_until is not None and self._lease_until > datetime.utcnow()
+
+    def add_job(self, func: Job, job_id: str, trigger: str, **trigger_args) -> None:
+        """
+        Регистрирует задачу. func — корутина без аргументов, может вернуть
+        число обработанных элементов (пишется в историю запусков).
+        """
+        self._scheduler.add_job(
+            self._run, trigger, args=[job_id, func], id=job_id,
+            coalesce=True, max_instances=1, **trigger_args
+        )
+        logger.info("Registered job %s (%s %s)", job_id, trigger, trigger_args)
+
+    async def start(self) -> None:
+        await self._acquire()
+        self._lease_task = asyncio.create_task(self._hold_lease(), name="scheduler-lease")
+        self._scheduler.start()
+
+    async def stop(self) -> None:
+        self._scheduler.shutdown(wait=False)
+        if self._lease_task:
+            self._lease_task.cancel()
+            await asyncio.gather(self._lease_task, return_exceptions=True)
+        # отпускаем lease сразу, чтобы другой процесс не ждал его истечения
+        if self.is_leader:
+            await self.locks.delete_one({"_id": self.LOCK_NAME, "owner": self.owner})
+        self._lease_until = None
+
+    async def _acquire(self) -> bool:
+        now = datetime.utcnow()
+        expires_at = now + self.lease
+        try:
+            await self.locks.find_one_and_update(
+                {
+                    "_id": self.LOCK_NAME,
+                    "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}],
+                },
+                {"$set": {"owner": self.owner, "expires_at": expires_at, "renewed_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # блокировка жива и принадлежит другому процессу
+            if self._lease_until:
+                logger.warning("Scheduler leadership lost by %s", self.owner)
+            self._lease_until = None
+            return False
+
+        if not self._lease_until:
+            logger.info("Scheduler leadership acquired by %s", self.owner)
+        self._lease_until = expires_at
+        return True
+
+    async def _hold_lease(self) -> None:
+        interval = self.lease.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._acquire()
+            except Exception as e:
+                logger.error("Scheduler lease renewal failed: %s", e)
+
+    async def _run(self, job_id: str, func: Job) -> None:
+        if not self.is_leader:
+            return
+
+        scheduled = _scheduled_run_time.get()
+        if scheduled is not None:
+            fired_at = scheduled.astimezone(timezone.utc).replace(tzinfo=None, microsecond=0)
+        else:
+            fired_at = datetime.utcnow().replace(second=0, microsecond=0)
+        run_id = f"{job_id}:{fired_at:%Y-%m-%dT%H:%M:%S}"
+        started_at = datetime.utcnow()
+        try:
+            await self.runs.insert_one({
+                "_id":        run_id,
+                "job_id":     job_id,
+                "owner":      self.owner,
+                "fired_at":   fired_at,
+                "started_at": started_at,
+                "status":     "running",
+            })
+        except DuplicateKeyError:
+            logger.info("Job run %s already claimed, skipping", run_id)
+            return
+
+        result = {"status": "ok", "items": None, "error": None}
+        try:
+            result["items"] = await func()
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            result.update(status="error", error=repr(e))
+
+        finished_at = datetime.utcnow()
+        result.update(
+            finished_at=finished_at,
+            duration=(finished_at - started_at).total_seconds(),
+        )
+        await self.runs.update_one({"_id": run_id}, {"$set": result})
+        logger.info(
+            "Job %s finished: status=%s items=%s in %.2fs",
+            job_id, result["status"], result["items"], result["duration"]
+        )
+
+job_scheduler = JobScheduler(locks_collection, job_runs_collection, settings.SCHEDULER_LEASE_SECONDS)
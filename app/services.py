@@ -1,11 +1,22 @@
+import asyncio
 from aiogram import Bot
 from aiogram.types import ReplyKeyboardMarkup
 from datetime import datetime, date, timedelta
 from bson import ObjectId
+from pymongo import ReturnDocument
 from app.db import users_collection
 from app.db import calcs_collection
+from app.bitrix_client import bitrix, BitrixBatch, BitrixError, DealUpdate
+from app.capacity import capacity, day_capacity, load_units
+from app.companies import companies
+from app.profiles import profiles
+from app.schedule import (
+    DELIVERY_DAYS_BY_WAREHOUSE, MAX_DATE_BUTTONS, calculate_schedule, date_keyboard,
+    get_pickup_dates, schedule_index,
+)
+from app.sessions import sessions
 from app.config import get_settings
-from httpx import AsyncClient
+from httpx import HTTPError
 from typing import Optional, List, Dict
 import logging
 settings = get_settings()
@@ -38,17 +49,6 @@ WAREHOUSE_MAP = {
 
 INV_WAREHOUSE_MAP = {v: k for k, v in WAREHOUSE_MAP.items()}
 
-DELIVERY_DAYS_BY_WAREHOUSE = {
-    # ПН, СР, ПТ
-    **{wh: [0, 2, 4] for wh in ["Электросталь", "Обухово", "Рязань", "Владимир"]},
-    # ПН только Котовск
-    "Котовск": [0],
-    # ВТ, ЧТ, СБ
-    **{wh: [1, 3, 5] for wh in ["Коледино", "Подольск", "Подольск 4", "Тула"]},
-    # ВС
-    **{wh: [6] for wh in ["Казань", "Новосемейкино"]},
-}
-
 CARGO_TYPE_OPTIONS = ["Короба", "Палеты"]
 
 def format_date(iso: str | None) -> str:
@@ -56,6 +56,46 @@ def format_date(iso: str | None) -> str:
         return "—"
     return datetime.fromisoformat(iso).strftime("%d.%m.%Y")
 
+def render_order_summary(order: dict, deal_id: Optional[str] = None) -> str:
+    """
+    Итоговое сообщение клиенту по отправленной заявке.
+    Без deal_id — заявка принята, но ещё передаётся в Битрикс.
+    """
+    if order.get("type") == "fulfilment":
+        org_label, org_addr_label = "Организация", "Адрес организации"
+    else:
+        org_label, org_addr_label = "ИП / организация", "Адрес ИП / организации"
+
+    if deal_id:
+        parts = [
+            "✅ Ваша заявка успешно отправлена!",
+            "📋 Содержимое заявки:",
+            "",
+            f"🆔 Номер заявки: #{deal_id}",
+        ]
+    else:
+        parts = [
+            "⏳ Ваша заявка принята и регистрируется.",
+            "Номер заявки появится в этом сообщении.",
+            "📋 Содержимое заявки:",
+            "",
+        ]
+    parts += [
+        f"🏢 {org_label}: {order.get('org_name', '—')}",
+        f"📍 {org_addr_label}: {order.get('org_address', '—')}",
+        f"🏦 БИК: {order.get('bik', '—')}",
+        f"💳 Р/С: {order.get('rs', '—')}",
+        f"📦 Тип поставки: {'Короба' if order.get('cargo_type') == 'boxes' else 'Палеты'}",
+        f"🔢 Количество: {order.get('cargo_quantity', '—')}",
+        f"🏬 Склад: {order.get('warehouse', '—')}",
+        f"📅 Дата сдачи: {format_date(order.get('delivery_date'))}",
+        f"🚚 Дата забора: {format_date(order.get('pickup_date'))}",
+        f"🏠 Адрес забора: {order.get('pickup_address', '—')}",
+        f"📞 Телефон: {order.get('phone_number', '—')}",
+        f"💰 Стоимость: {order.get('delivery_cost', '—')} ₽"
+    ]
+    return "\n".join(parts)
+
 async def send_text(chat_id: int, text: str, bot: Bot, reply_markup: ReplyKeyboardMarkup = None, parse_mode: str = "Markdown"):
     message = await bot.send_message(
         chat_id=chat_id,
@@ -65,6 +105,35 @@ async def send_text(chat_id: int, text: str, bot: Bot, reply_markup: ReplyKeyboa
     )
     return message
 
+async def transition(
+    chat_id: int,
+    bot_type: str,
+    order_id,
+    order_fields: Optional[dict] = None,
+    user_fields: Optional[dict] = None
+) -> Optional[dict]:
+    """
+    Один шаг диалога за один сетевой круг: изменение заказа ($set order_fields)
+    и изменение пользователя (user_fields, обычно state) отправляются в Mongo
+    параллельно. Возвращает заказ после изменения (или текущий заказ, если
+    order_fields пуст), чтобы хендлеру не нужно было перечитывать его.
+    """
+    oid = ObjectId(order_id) if isinstance(order_id, str) else order_id
+    orders = users_collection.database["orders"]
+    if order_fields:
+        order_op = orders.find_one_and_update(
+            {"_id": oid},
+            {"$set": order_fields},
+            return_document=ReturnDocument.AFTER
+        )
+    else:
+        order_op = orders.find_one({"_id": oid})
+
+    if not user_fields:
+        return await order_op
+    order, _ = await asyncio.gather(order_op, sessions.update(chat_id, bot_type, user_fields))
+    return order
+
 async def send_intro_message(chat_id: int) -> None:
     text = (
         "Для создания заявки потребуется указать следующие данные:\n"
@@ -80,18 +149,41 @@ async def send_intro_message(chat_id: int) -> None:
     keyboard = {"keyboard": [[{"text": "📦 Создать заявку"}], [{"text": "🔄 Начать заново"}]], "resize_keyboard": True}
     await send_text(chat_id, text, delivery_bot, keyboard)
 
+def delivery_dates_for(warehouse: str, load: int = 0) -> List[date]:
+    """
+    Даты сдачи из календаря склада, на которые в машине есть место
+    под груз в load коробов (load=0 — груз ещё не известен).
+    """
+    calendar = schedule_index.calendar(warehouse)
+    if not load:
+        return calendar.delivery_dates
+    return [d for d in calendar.pickups if capacity.remaining(warehouse, d) >= load][:MAX_DATE_BUTTONS]
+
+def delivery_date_available(warehouse: str, day: date, load: int = 0) -> bool:
+    """Дата есть в текущем календаре склада и (если груз известен) в машине хватает места."""
+    if day not in schedule_index.calendar(warehouse).pickups:
+        return False
+    return not load or capacity.remaining(warehouse, day) >= load
+
 async def prompt_delivery_date_selection(
     chat_id: int,
     bot,
-    warehouse: str
+    warehouse: str,
+    load: int = 0
 ) -> bool:
     """
     Показывает первые 6 уникальных дат сдачи поставки
     (только начиная с завтрашнего дня) в виде ReplyKeyboardMarkup.
+    load — груз заказа в коробах, если уже известен: дни, где для него
+    не хватает места, не показываются.
     """
-    # calculate_schedule теперь начинается с завтра
-    slots = calculate_schedule(warehouse)
-    if not slots:
+    # даты и клавиатура уже собраны в календаре на сегодня
+    calendar = schedule_index.calendar(warehouse)
+    keyboard = calendar.keyboard
+    if load:
+        dates = delivery_dates_for(warehouse, load)
+        keyboard = date_keyboard(dates) if dates else None
+    if keyboard is None:
         await send_text(
             chat_id,
             "⛔ Нет доступных дат сдачи поставки на ближайшие 2 недели.",
@@ -100,19 +192,6 @@ async def prompt_delivery_date_selection(
         )
         return False
 
-    unique_dates: List[str] = []
-    for slot in slots:
-        d_str = slot["delivery"].strftime("%d.%m.%Y")
-        if d_str not in unique_dates:
-            unique_dates.append(d_str)
-        if len(unique_dates) >= 6:
-            break
-
-    rows = [unique_dates[i : i + 2] for i in range(0, len(unique_dates), 2)]
-    buttons = [[{"text": d} for d in row] for row in rows]
-    buttons.append([{"text": "🔄 Начать заново"}])
-    keyboard = {"keyboard": buttons, "resize_keyboard": True}
-
     await send_text(
         chat_id,
         "📅 Выберите дату сдачи поставки:",
@@ -121,6 +200,44 @@ async def prompt_delivery_date_selection(
     )
     return True
 
+async def check_cargo_room(chat_id: int, bot, bot_type: str, order: dict, qty: int) -> bool:
+    """
+    Шаг ввода количества: груз должен помещаться в машину вообще
+    (day_capacity склада) и в остаток места на выбранную дату.
+    Если не помещается в машину — просит ввести меньше; если не хватает
+    места на дату — сохраняет количество и возвращает к выбору даты,
+    показывая только дни, где места хватает. False — дальше не идём.
+    """
+    warehouse = order.get("warehouse", "")
+    cargo_type = order.get("cargo_type")
+    units = load_units(cargo_type, qty)
+    limit = day_capacity(warehouse)
+    if units > limit:
+        if cargo_type == "pallets":
+            most = f"{limit // settings.BOXES_PER_PALLET} палет"
+        else:
+            most = f"{limit} коробов"
+        await send_text(
+            chat_id,
+            f"❌ Такой объём не помещается в одну машину (не больше {most}). "
+            "Введите меньшее количество или оформите несколько заявок.",
+            bot
+        )
+        return False
+
+    delivery_date = order.get("delivery_date")
+    if delivery_date and capacity.remaining(warehouse, date.fromisoformat(delivery_date)) < units:
+        await transition(chat_id, bot_type, order["_id"], {"cargo_quantity": qty}, {"state": "select_delivery_date"})
+        await send_text(
+            chat_id,
+            "⛔ На выбранную дату в машине не хватает места для такого объёма. "
+            "Пожалуйста, выберите другую дату сдачи.",
+            bot
+        )
+        await prompt_delivery_date_selection(chat_id, bot, warehouse, units)
+        return False
+    return True
+
 async def send_cargo_type_selection(chat_id: int, bot) -> None:
     keyboard = {
         "keyboard": [
@@ -144,65 +261,6 @@ async def init_calc(chat_id: int, marketplace: str) -> ObjectId:
     result = await calcs_collection.insert_one(calc_doc)
     return result.inserted_id
 
-def calculate_schedule(
-    warehouse: str,
-    start_date: date = None,
-    days_ahead: int = 14
-) -> List[Dict[str, date]]:
-    """
-    Возвращает список словарей с ключами:
-      - 'delivery': дата перевозки (строго > сегодня)
-      - 'pickup':   дата забора (строго > сегодня)
-    По умолчанию start_date = завтра.
-    """
-    if start_date is None:
-        start_date = date.today() + timedelta(days=1)
-
-    result: List[Dict[str, date]] = []
-    delivery_days = [0] if warehouse == "Котовск" else DELIVERY_DAYS_BY_WAREHOUSE.get(warehouse, [])
-
-    for offset in range(days_ahead):
-        d = start_date + timedelta(days=offset)
-        if d.weekday() in delivery_days:
-            for pickup_date in get_pickup_dates(warehouse, d):
-                result.append({"delivery": d, "pickup": pickup_date})
-
-    return result
-
-def get_pickup_dates(
-    warehouse: str,
-    delivery_date: date
-) -> List[date]:
-    """
-    Возвращает доступные даты забора (строго > сегодня):
-      - Котовск: предыдущий воскресный день + день доставки
-      - Казань/Новосемейкино: пятница перед доставкой
-      - Все остальные: день доставки
-    Отфильтровывает любые даты ≤ сегодня.
-    """
-    from datetime import timedelta
-
-    today = date.today()
-    candidates: List[date] = []
-
-    if warehouse == "Котовск":
-        prev_sunday = delivery_date
-        while prev_sunday.weekday() != 6:
-            prev_sunday -= timedelta(days=1)
-        candidates = [prev_sunday, delivery_date]
-
-    elif warehouse in {"Казань", "Новосемейкино"}:
-        prev_friday = delivery_date
-        while prev_friday.weekday() != 4:
-            prev_friday -= timedelta(days=1)
-        candidates = [prev_friday]
-
-    else:
-        candidates = [delivery_date]
-
-    # оставляем только те, что строго после сегодняшнего дня
-    return [d for d in candidates if d > today]
-
 async def prompt_warehouse_selection(chat_id: int, bot: Bot) -> None:
     """
     Просит пользователя выбрать склад для расчёта стоимости.
@@ -240,158 +298,13 @@ async def prompt_cargo_type_selection(chat_id: int, bot: Bot) -> None:
         keyboard
     )
 
-def calculate_delivery_cost(
-    warehouse: str,
-    cargo_type: str,
-    quantity: int
-) -> int:
-    """
-    Вычисляет стоимость доставки.
-
-    Параметры:
-      - warehouse: название склада (например, "Коледино", "Новосемейкино" и т.д.)
-      - cargo_type: "Короба" или "Палеты"
-      - quantity: количество коробов или палет (целое >= 0)
-
-    Возвращает:
-      - общую стоимость в рублях (int)
-    """
-   # Группы складов для коробов
-    box_group1 = {"Коледино", "Электросталь", "Подольск", "Подольск 4", "Обухово"}
-    box_group2 = {"Владимир", "Тула", "Рязань"}
-    box_group3 = {"Казань", "Котовск"}
-    box_group4 = {"Новосемейкино"}
-    pickup_fee = 500  # единая плата за забор для коробов
-
-    # Группы складов для палет
-    pal_group1 = box_group1
-    pal_group2 = box_group2
-    pal_group3 = {"Казань", "Котовск"}
-    pal_group4 = {"Новосемейкино"}
-
-    # Обработка нулевого количества
-    if quantity <= 0:
-        return 0
-
-    # Расчёт базовой стоимости
-    if cargo_type == "Короба":
-        if warehouse in box_group1:
-            rate = 200
-        elif warehouse in box_group2:
-            rate = 300
-        elif warehouse in box_group3:
-            rate = 500
-        elif warehouse in box_group4:
-            rate = 600
-        else:
-            raise ValueError(f"Неизвестный склад для коробов: {warehouse}")
-        base_cost = rate * quantity + pickup_fee
-
-    elif cargo_type == "Палеты":
-        if warehouse in pal_group1:
-            # 3000 за первую + 1250 за каждую дополнительную
-            base_cost = 3000 + max(0, quantity - 1) * 1250
-        elif warehouse in pal_group2:
-            # 4000 за первую + 2000 за каждую дополнительную
-            base_cost = 4000 + max(0, quantity - 1) * 2000
-        elif warehouse in pal_group3:
-            # 6000 за каждую палету
-            base_cost = 6000 * quantity
-        elif warehouse in pal_group4:
-            # 7500 за каждую палету
-            base_cost = 7500 * quantity
-        else:
-            raise ValueError(f"Неизвестный склад для палет: {warehouse}")
-
-    else:
-        raise ValueError(f"Неизвестный тип поставки: {cargo_type}")
-
-    return base_cost
-
-def calculate_delivery_cost_fulfilment(
-    warehouse: str,
-    cargo_type: str,
-    quantity: int
-) -> int:
-    """
-    Вычисляет стоимость доставки.
-
-    Параметры:
-      - warehouse: название склада (например, "Коледино", "Новосемейкино" и т.д.)
-      - cargo_type: "Короба" или "Палеты"
-      - quantity: количество коробов или палет (целое >= 0)
-
-    Возвращает:
-      - общую стоимость в рублях (int)
-    """
-   # Группы складов для коробов
-    box_group1 = {"Коледино", "Электросталь", "Подольск", "Подольск 4", "Обухово"}
-    box_group2 = {"Владимир", "Тула", "Рязань"}
-    box_group3 = {"Казань", "Котовск"}
-    box_group4 = {"Новосемейкино"}
-    pickup_fee = 500  # единая плата за забор для коробов
-
-    # Группы складов для палет
-    pal_group1 = box_group1
-    pal_group2 = box_group2
-    pal_group3 = {"Казань", "Котовск"}
-    pal_group4 = {"Новосемейкино"}
-
-    # Обработка нулевого количества
-    if quantity <= 0:
-        return 0
-
-    # Расчёт базовой стоимости
-    if cargo_type == "Короба":
-        if warehouse in box_group1:
-            rate = 182
-        elif warehouse in box_group2:
-            rate = 245
-        elif warehouse in box_group3:
-            rate = 400
-        elif warehouse in box_group4:
-            rate = 500
-        else:
-            raise ValueError(f"Неизвестный склад для коробов: {warehouse}")
-        base_cost = rate * quantity + pickup_fee
-
-    elif cargo_type == "Палеты":
-        if warehouse in pal_group1:
-            # 3000 за первую + 1250 за каждую дополнительную
-            base_cost = 3000 + max(0, quantity - 1) * 1250
-        elif warehouse in pal_group2:
-            # 4000 за первую + 2000 за каждую дополнительную
-            base_cost = 4000 + max(0, quantity - 1) * 2000
-        elif warehouse in pal_group3:
-            # 6000 за каждую палету
-            base_cost = 6000 * quantity
-        elif warehouse in pal_group4:
-            # 7500 за каждую палету
-            base_cost = 7500 * quantity
-        else:
-            raise ValueError(f"Неизвестный склад для палет: {warehouse}")
-
-    else:
-        raise ValueError(f"Неизвестный тип поставки: {cargo_type}")
-
-    return base_cost
-
 async def prompt_pickup_address_selection(chat_id: int, bot: Bot) -> None:
-    orders_cursor = users_collection.database["orders"].find({"chat_id": chat_id})
-    addresses = set()
-
-    async for order in orders_cursor:
-        addr = order.get("pickup_address")
-        if not addr:
-            continue
-        clean = addr.strip()
-        # Пропускаем «адреса», которые состоят только из цифр
-        if clean.isdigit():
-            continue
-        addresses.add(clean)
+    # адреса из профиля клиента, частые и недавние — выше
+    profile = await profiles.get(chat_id)
+    addresses = [entry["value"] for entry in profiles.ranked(profile, "addresses")]
 
     if addresses:
-        buttons = [[{"text": f"📍 {a}"}] for a in sorted(addresses)]
+        buttons = [[{"text": f"📍 {a}"}] for a in addresses]
         buttons.append([{"text": "🔄 Начать заново"}])
         keyboard = {"keyboard": buttons, "resize_keyboard": True}
         await send_text(
@@ -413,15 +326,10 @@ async def prompt_pickup_address_selection(chat_id: int, bot: Bot) -> None:
         )
 
 async def prompt_phone_number_selection(chat_id: int, bot: Bot) -> None:
-    cursor = users_collection.database["orders"].find({"chat_id": chat_id})
-    phones = set()
-
-    async for order in cursor:
-        phone = order.get("phone_number")
-        if phone:
-            phones.add(phone.strip())
+    profile = await profiles.get(chat_id)
+    phones = [entry["value"] for entry in profiles.ranked(profile, "phones")]
 
-    buttons = [[{"text": f"📞 {p}"}] for p in sorted(phones)] if phones else []
+    buttons = [[{"text": f"📞 {p}"}] for p in phones]
     buttons.append([{
         "text": "📲 Отправить контакт",
         "request_contact": True
@@ -451,266 +359,250 @@ async def send_intro_message_ff(chat_id: int) -> None:
     keyboard = {"keyboard": [[{"text": "Создать новую заявку"}]], "resize_keyboard": True}
     await send_text(chat_id, text, fulfilment_bot, keyboard)
 
-async def calculate_delivery_cost_ff(chat_id: int) -> int:
-    # 1) Берём профиль пользователя с учётом типа
-    user = await users_collection.find_one(
-        {"chat_id": chat_id, "type": "fulfilment"}
+async def send_to_bitrix(order: dict, telegram_username: str) -> str:
+    """
+    1) Ищем компанию по ИНН и org_name (кэш, при промахе — crm.company.list).
+    2) Создаём сделку (deal) в стадии NEW с полями из плоского order.
+       Если компании нет — она создаётся вместе с реквизитами в том же
+       batch-запросе, что и сделка (ссылки $result[...] на новые ID).
+    Сохраняем bitrix_deal_id в заказе и возвращаем его.
+    """
+    # ——————————————————————————————
+    # 1) Найти компанию
+    company = await companies.lookup(order["inn"], order["org_name"])
+
+    # ——————————————————————————————
+    # 2) Создать сделку (и компанию, если её нет)
+    if company:
+        company_id = company["company_id"]
+        logger.info("Bitrix: найдено company_id=%s", company_id)
+        deal_fields = build_deal_fields(order, company_id)
+        logger.info("Bitrix → crm.deal.add: %s", deal_fields)
+        deal_id = await bitrix.call("crm.deal.add", {"fields": deal_fields})
+    else:
+        batch = build_company_batch(order, telegram_username)
+        batch.add("deal", "crm.deal.add", {"fields": build_deal_fields(order, batch.ref("company"))})
+        logger.info("Bitrix → batch: %s", list(batch.build()["cmd"]))
+        results = await batch.execute(bitrix)
+        logger.info(
+            "Bitrix: создана компания company_id=%s, requisite_id=%s",
+            results["company"], results["requisite"]
+        )
+        await companies.remember(order["inn"], order["org_name"], results["company"], results["requisite"])
+        deal_id = results["deal"]
+    logger.info("Bitrix: создана сделка deal_id=%s", deal_id)
+
+    # 3) Сохраняем deal_id в Mongo для последующих обновлений
+    await users_collection.database["orders"].update_one(
+        {"_id": ObjectId(order["_id"])},
+        {"$set": {"bitrix_deal_id": str(deal_id)}}
     )
-    order = None
 
-    # 2) Если в профиле есть active_order, пробуем по нему найти заказ
-    order_id = user.get("active_order") if user else None
-    if order_id:
-        try:
-            order = await users_collection.database["orders"].find_one(
-                {"_id": ObjectId(order_id)}
-            )
-        except Exception:
-            order = None
+    return str(deal_id)
 
-    # 3) Если не нашли — берём самый свежий «in_progress» заказ этого чата
-    if not order:
-        order = await users_collection.database["orders"].find_one(
-            {"chat_id": chat_id, "status": "in_progress"},
-            sort=[("created_at", -1)]
-        )
+async def find_deal_by_order(order: dict) -> Optional[str]:
+    """
+    Сделка, уже созданная для заказа (по ORIGIN_ID = _id заказа), или None.
+    Нужна перед повторной отправкой: если прошлая попытка упала по таймауту,
+    crm.deal.add мог выполниться. Найденный ID сохраняется в заказе.
+    """
+    items = await bitrix.call("crm.deal.list", {
+        "filter": {"ORIGIN_ID": str(order["_id"])},
+        "select": ["ID"],
+    }) or []
+    if not items:
+        return None
+    deal_id = str(items[0]["ID"])
+    await users_collection.database["orders"].update_one(
+        {"_id": ObjectId(order["_id"])},
+        {"$set": {"bitrix_deal_id": deal_id}}
+    )
+    return deal_id
 
-    # 4) Если всё ещё нет — возвращаем 0
-    if not order:
-        return 0
+def build_company_batch(order: dict, telegram_username: str) -> BitrixBatch:
+    """
+    Команды создания компании с реквизитами:
+    company → requisite → address, bankdetail (ID берутся через $result[...]).
+    """
+    batch = BitrixBatch()
+    # — crm.company.add
+    batch.add("company", "crm.company.add", {
+        "fields": {
+            "TITLE":   order["org_name"],
+            "PHONE":   [{"VALUE": order["phone_number"], "VALUE_TYPE": "WORK"}],
+            "IM":      [{"VALUE": telegram_username, "VALUE_TYPE": "TELEGRAM"}],
+        }
+    })
+    # — crm.requisite.add (основной реквизит)
+    batch.add("requisite", "crm.requisite.add", {
+        "fields": {
+            "ENTITY_TYPE_ID":   4,   # 4 = Company
+            "ENTITY_ID":        batch.ref("company"),
+            "PRESET_ID":        1,
+            "NAME":             "Основной реквизит",
+            "RQ_INN":           order["inn"],
+            "RQ_COMPANY_NAME":  order["org_name"],
+            "RQ_COMPANY_FULL_NAME": order["org_name"]
+        }
+    })
+    # — crm.address.add (юридический адрес)
+    batch.add("address", "crm.address.add", {
+        "fields": {
+            "TYPE_ID":         6,  # Legal
+            "ENTITY_TYPE_ID":  8,  # Requisite
+            "ENTITY_ID":       batch.ref("requisite"),
+            "COUNTRY":         "RU",
+            "ADDRESS_1":       order["org_address"]
+        }
+    })
+    # — crm.requisite.bankdetail.add (банковские реквизиты)
+    batch.add("bankdetail", "crm.requisite.bankdetail.add", {
+        "fields": {
+            "ENTITY_ID":       batch.ref("requisite"),
+            "NAME": "Банк",
+            "RQ_BIK":          order["bik"],
+            "RQ_ACC_NUM":      order["rs"],
+            "RQ_ACC_CURRENCY": "RUB"
+        }
+    })
+    return batch
 
-    # 5) Теперь гарантированно есть order, берём поля
-    warehouse  = order.get("warehouse", "")
-    cargo_type = order.get("cargo_type")
-    quantity   = order.get("cargo_quantity", 0)
-    cost = 0
-
-    if cargo_type == "boxes":
-        if warehouse in ["Коледино", "Электросталь", "Подольск", "Подольск 4", "Обухово"]:
-            cost = quantity * 182
-        elif warehouse in ["Тула", "Рязань", "Владимир"]:
-            cost = quantity * 245
-        elif warehouse in ["Казань", "Котовск"]:
-            cost = quantity * 400
-        elif warehouse in ["Новосемейкино"]:
-            cost = quantity * 500
-        cost += 500
-
-    elif cargo_type == "pallets":
-        if warehouse in ["Коледино", "Электросталь", "Подольск", "Подольск 4", "Обухово"]:
-            if quantity >= 1:
-                cost = 3000 + 1250 * (quantity - 1)
-        elif warehouse in ["Тула", "Рязань", "Владимир"]:
-            if quantity >= 1:
-                cost = 4000 + 2000 * (quantity - 1)
-        elif warehouse in ["Казань", "Котовск"]:
-            cost = 6000 * quantity
-        elif warehouse in ["Новосемейкино"]:
-            cost = 7500 * quantity
-
-    return cost
+def build_deal_fields(order: dict, company_id) -> dict:
+    """Поля crm.deal.add для плоского order."""
+    dt_now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    warehouse_id = WAREHOUSE_MAP.get(order["warehouse"])
 
-async def send_to_bitrix(order: dict, telegram_username: str) -> str:
+    if order.get("type") == "fulfilment":
+        deal_title = f"Фулфилмент → {order['warehouse']}, {order['org_name']}"
+    else:
+        deal_title = f"Доставка → {order['warehouse']}, {order['org_name']}"
+
+    deal_fields = {
+        "TITLE":         deal_title,
+        "STAGE_ID":      "NEW",
+        "OPPORTUNITY":   order["delivery_cost"],
+        "CURRENCY_ID":   "RUB",
+        "COMPANY_ID":    company_id,
+        "DATE_CREATE":   dt_now,
+        "ASSIGNED_BY_ID": 1,
+        "CATEGORY_ID": 2,
+        # _id заказа: по нему находим сделку, если ответ на crm.deal.add потерялся
+        "ORIGIN_ID":     str(order["_id"]),
+        "UF_CRM_1729569844156": 114,
+        "UF_CRM_1724923450176": order["pickup_address"],
+        "UF_CRM_1724923582938": order["cargo_quantity"],
+        "UF_CRM_1751787406541": 252 if order["cargo_type"]=="pallets" else 250,
+        "UF_CRM_1724923635379": order["delivery_date"],
+        "UF_CRM_1724923649863": order["pickup_date"],
+        "UF_CRM_1724923726538": order["chat_id"],
+        "UF_CRM_1724923553452": warehouse_id,
+    }
+    if order.get("type") == "fulfilment":
+        deal_fields["UF_CRM_1751787327257"] = 1
+    return deal_fields
+
+# Поля договора в сделке: заполняются менеджером в Битриксе, локально их нет,
+# пока не прочитаем один раз (дальше — из заказа)
+DEAL_CONTRACT_FIELDS = {
+    "contract_number": "UF_CRM_1751973413773",
+    "contract_date":   "UF_CRM_1752132156032",
+}
+
+async def get_deal_contract(order: dict) -> dict:
     """
-    1) Ищем компанию по org_name, если не нашли — создаём с реквизитами.
-    2) Создаём сделку (deal) в стадии NEW с полями из плоского order.
-    Сохраняем bitrix_deal_id в заказе и возвращаем его.
+    Номер и дата договора для сделки заказа: из заказа, а если их там
+    нет — из Битрикса (crm.deal.list с выборкой двух полей). Договор —
+    поле сделки, а не компании: у новой сделки он может быть другим,
+    поэтому найденное сохраняется только в заказ. Пока номера договора
+    нет, каждый вызов читает Битрикс.
     """
-    async with AsyncClient() as client:
-        # ——————————————————————————————
-        # 1) Найти или создать компанию
-        # — crm.company.list
-        company_name = order["org_name"]
-        payload = {"filter": {"TITLE": company_name}}
-        logger.info("Bitrix → crm.company.list: %s", payload)
-        resp = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.company.list",
-            json=payload
-        )
-        resp.raise_for_status()
-        items = resp.json().get("result", [])
+    if order.get("contract_number"):
+        return {k: order.get(k) for k in DEAL_CONTRACT_FIELDS}
+
+    items = await bitrix.call("crm.deal.list", {
+        "filter": {"ID": order["bitrix_deal_id"]},
+        "select": list(DEAL_CONTRACT_FIELDS.values()),
+    }) or [{}]
+    deal = items[0] if items else {}
+    contract = {k: deal.get(field) or None for k, field in DEAL_CONTRACT_FIELDS.items()}
+    if not contract["contract_number"]:
+        # договор ещё не оформлен — не запоминаем, перечитаем в следующий раз
+        return contract
+
+    await users_collection.database["orders"].update_one({"_id": order["_id"]}, {"$set": contract})
+    order.update(contract)
+    return contract
+
+def build_service_name(warehouse: str, deliv_date: Optional[str], contract: dict) -> str:
+    """Название услуги в товарной позиции сделки (и счёте)."""
+    def fmt_date(d: Optional[str]) -> Optional[str]:
+        try:
+            return datetime.fromisoformat(d).strftime("%d.%m.%Y")
+        except Exception:
+            return None
 
-        if items:
-            company_id = items[0]["ID"]
-            logger.info("Bitrix: найдено company_id=%s", company_id)
-        else:
-            # — crm.company.add
-            payload = {
-                "fields": {
-                    "TITLE":   company_name,
-                    "PHONE":   [{"VALUE": order["phone_number"], "VALUE_TYPE": "WORK"}],
-                    "IM":      [{"VALUE": telegram_username, "VALUE_TYPE": "TELEGRAM"}],
-                }
-            }
-            logger.info("Bitrix → crm.company.add: %s", payload)
-            resp = await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.company.add",
-                json=payload
-            )
-            resp.raise_for_status()
-            company_id = resp.json()["result"]
-            logger.info("Bitrix: создана компания company_id=%s", company_id)
-
-            # — crm.requisite.add (основной реквизит)
-            payload = {
-                "fields": {
-                    "ENTITY_TYPE_ID":   4,   # 4 = Company
-                    "ENTITY_ID":        company_id,
-                    "PRESET_ID":        1,
-                    "NAME":             "Основной реквизит",
-                    "RQ_INN":           order["inn"],
-                    "RQ_COMPANY_NAME":  order["org_name"],
-                    "RQ_COMPANY_FULL_NAME": order["org_name"]
-                }
-            }
-            logger.info("Bitrix → crm.requisite.add: %s", payload)
-            resp = await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.requisite.add",
-                json=payload
-            )
-            resp.raise_for_status()
-            requisite_id = resp.json()["result"]
-
-            # — crm.address.add (юридический адрес)
-            payload = {
-                "fields": {
-                    "TYPE_ID":         6,  # Legal
-                    "ENTITY_TYPE_ID":  8,  # Requisite
-                    "ENTITY_ID":       requisite_id,
-                    "COUNTRY":         "RU",
-                    "ADDRESS_1":       order["org_address"]
-                }
-            }
-            logger.info("Bitrix → crm.address.add: %s", payload)
-            resp = await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.address.add",
-                json=payload
-            )
-            resp.raise_for_status()
-
-            # — crm.requisite.bankdetail.add (банковские реквизиты)
-            payload = {
-                "fields": {
-                    "ENTITY_ID":       requisite_id,
-                    "NAME": "Банк",
-                    "RQ_BIK":          order["bik"],
-                    "RQ_ACC_NUM":      order["rs"],
-                    "RQ_ACC_CURRENCY": "RUB"
-                }
-            }
-            logger.info("Bitrix → crm.requisite.bankdetail.add: %s", payload)
-            resp = await client.post(
-                f"{settings.BITRIX_WEBHOOK_URL}crm.requisite.bankdetail.add",
-                json=payload
-            )
-            resp.raise_for_status()
-
-        # ——————————————————————————————
-        # 2) Создать сделку
-        # — crm.deal.add
-        dt_now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
-        warehouse_id = WAREHOUSE_MAP.get(order["warehouse"])
-
-        if order.get("type") == "fulfilment":
-            deal_title = f"Фулфилмент → {order['warehouse']}, {order['org_name']}"
-        else:
-            deal_title = f"Доставка → {order['warehouse']}, {order['org_name']}"
-
-        deal_fields = {
-            "TITLE":         deal_title,
-            "STAGE_ID":      "NEW",
-            "OPPORTUNITY":   order["delivery_cost"],
-            "CURRENCY_ID":   "RUB",
-            "COMPANY_ID":    company_id,
-            "DATE_CREATE":   dt_now,
-            "ASSIGNED_BY_ID": 1,
-            "CATEGORY_ID": 2,
-            "UF_CRM_1729569844156": 114,
-            "UF_CRM_1724923450176": order["pickup_address"],
-            "UF_CRM_1724923582938": order["cargo_quantity"],
-            "UF_CRM_1751787406541": 252 if order["cargo_type"]=="pallets" else 250,
-            "UF_CRM_1724923635379": order["delivery_date"],
-            "UF_CRM_1724923649863": order["pickup_date"],
-            "UF_CRM_1724923726538": order["chat_id"],
-            "UF_CRM_1724923553452": warehouse_id,
-        }
-        if order.get("type") == "fulfilment":
-            deal_fields["UF_CRM_1751787327257"] = 1
-        
-        logger.info("Bitrix → crm.deal.add: %s", deal_fields)
-        resp = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.deal.add",
-            json={"fields": deal_fields}
-        )
-        resp.raise_for_status()
-        deal_id = resp.json().get("result")
-        logger.info("Bitrix: создана сделка deal_id=%s", deal_id)
-
-        # 3) Сохраняем deal_id в Mongo для последующих обновлений
-        await users_collection.database["orders"].update_one(
-            {"_id": ObjectId(order["_id"])},
-            {"$set": {"bitrix_deal_id": str(deal_id)}}
-        )
+    deliv_date = fmt_date(deliv_date)
+    contract_number = contract.get("contract_number")
+    contract_date = fmt_date(contract.get("contract_date"))
 
-        return str(deal_id)
+    if contract_number:
+        name = f"Оплата по договору №{contract_number}"
+        if contract_date:
+            name += f" от {contract_date}"
+        name += ", транспортировка "
+    else:
+        name = "Транспортировка "
+    if deliv_date:
+        name += f"{deliv_date} "
+    name += warehouse
+    return name
 
-async def set_deal_service_row(deal_id: str) -> None:
-    async with AsyncClient() as client:
-        # 1) Получаем сделку
-        resp = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.deal.get",
-            json={"id": deal_id}
+async def set_deal_service_row(deal_id: str, deal_update: Optional[DealUpdate] = None) -> str:
+    """
+    Формирует услугу (товарную позицию) сделки и возвращает её название.
+    Цена, склад и дата берутся из заказа в Mongo, договор — через
+    get_deal_contract(); сделка из Битрикса читается, только если заказа нет.
+    Если передан deal_update, позиция уходит вместе с его изменениями
+    одним запросом при flush, иначе — сразу через crm.deal.productrows.set.
+    """
+    order = await users_collection.database["orders"].find_one({"bitrix_deal_id": deal_id})
+    if order:
+        price = order.get("delivery_cost", 0)
+        name = build_service_name(
+            order.get("warehouse", ""),
+            order.get("pickup_date"),
+            await get_deal_contract(order),
         )
-        resp.raise_for_status()
-        deal = resp.json().get("result", {})
-
-        # Извлекаем поля
-        price             = deal.get("OPPORTUNITY", 0)
-        wh_code           = deal.get("UF_CRM_1724923553452")
-        raw_deliv_date    = deal.get("UF_CRM_1724923649863")
-        contract_number   = deal.get("UF_CRM_1751973413773")
-        raw_contract_date = deal.get("UF_CRM_1752132156032")
-
-        # 2) Форматим
-        warehouse = INV_WAREHOUSE_MAP.get(int(wh_code), str(wh_code))
-        def fmt_date(d: Optional[str]) -> Optional[str]:
-            try:
-                return datetime.fromisoformat(d).strftime("%d.%m.%Y")
-            except Exception:
-                return None
-
-        deliv_date = fmt_date(raw_deliv_date)
-        contract_date = fmt_date(raw_contract_date)
-
-        # 3) Собираем название услуги
-        if contract_number:
-            name = f"Оплата по договору №{contract_number}"
-            if contract_date:
-                name += f" от {contract_date}"
-            name += ", транспортировка "
-        else:
-            name = "Транспортировка "
-        if deliv_date:
-            name += f"{deliv_date} "
-        name += warehouse
-
-        # 4) Формируем rows и пушим в Bitrix
-        product_rows = [{
-            "PRODUCT_NAME": name,
-            "PRICE":        price,
-            "QUANTITY":     1
-        }]
-
-        resp2 = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.deal.productrows.set",
-            json={"id": deal_id, "rows": product_rows}
+    else:
+        # сделка заведена в Битриксе без бота — берём всё из неё
+        deal = await bitrix.call("crm.deal.get", {"id": deal_id}) or {}
+        price = deal.get("OPPORTUNITY", 0)
+        wh_code = deal.get("UF_CRM_1724923553452")
+        name = build_service_name(
+            INV_WAREHOUSE_MAP.get(int(wh_code), str(wh_code)) if wh_code else "",
+            deal.get("UF_CRM_1724923649863"),
+            {k: deal.get(field) for k, field in DEAL_CONTRACT_FIELDS.items()},
         )
-        if resp2.is_error:
-            logger.error("Bitrix productrows.set failed: %s", resp2.text)
-        else:
-            logger.info("Bitrix productrows.set response: %s", resp2.json())
+
+    # Формируем rows и пушим в Bitrix
+    product_rows = [{
+        "PRODUCT_NAME": name,
+        "PRICE":        price,
+        "QUANTITY":     1
+    }]
+
+    if deal_update is not None:
+        deal_update.set_product_rows(product_rows)
         return name
 
+    try:
+        result = await bitrix.call("crm.deal.productrows.set", {"id": deal_id, "rows": product_rows})
+    except (BitrixError, HTTPError) as e:
+        logger.error("Bitrix productrows.set failed: %s", e)
+    else:
+        logger.info("Bitrix productrows.set response: %s", result)
+    return name
+
 async def generate_deal_invoice_public_url(deal_id: str) -> str:
     """
     Генерирует в Bitrix документ «Счёт» по сделке и возвращает публичный URL для скачивания.
@@ -723,53 +615,39 @@ async def generate_deal_invoice_public_url(deal_id: str) -> str:
     :raises RuntimeError: при ошибках API или отсутствии нужных полей в ответе
     :return: публичная ссылка на документ
     """
-    async with AsyncClient() as client:
-        # 1. Создаём документ
-        doc_payload = {
-            "templateId":    4,        # ID шаблона «Счёт»
-            "entityTypeId":  2,        # 2 = Deal
-            "entityId":      deal_id,
-            "values":        [],       # доп. поля
-            "stampsEnabled": 0         # без печати/подписи
-        }
-        logger.info("Bitrix → crm.documentgenerator.document.add: %r", doc_payload)
-        resp = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.documentgenerator.document.add",
-            json=doc_payload
-        )
-        resp.raise_for_status()
-        result = resp.json().get("result", {})
-        document = result.get("document", {})
-        document_id = document.get("id")
-        if not document_id:
-            logger.error("Bitrix did not return document.id: %s", resp.text)
-            raise RuntimeError("Не удалось получить document_id от Bitrix")
-
-        logger.info("Создан документ «Счёт», ID=%s", document_id)
-
-        # 2. Включаем публичный доступ
-        enable_payload = {"id": document_id, "status": 1}
-        logger.info("Bitrix → crm.documentgenerator.document.enablepublicurl: %r", enable_payload)
-        resp = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.documentgenerator.document.enablepublicurl",
-            json=enable_payload
-        )
-        resp.raise_for_status()
-        logger.info("Публичная ссылка включена для документа %s", document_id)
-
-        # 3. Получаем публичный URL
-        get_payload = {"id": document_id}
-        logger.info("Bitrix → crm.documentgenerator.document.get.json: %r", get_payload)
-        resp = await client.post(
-            f"{settings.BITRIX_WEBHOOK_URL}crm.documentgenerator.document.get.json",
-            json=get_payload
-        )
-        resp.raise_for_status()
-        doc = resp.json().get("result", {}).get("document", {})
-        url_public = doc.get("publicUrl")
-        if not url_public:
-            logger.error("Bitrix did not return publicUrl: %s", resp.text)
-            raise RuntimeError("Не удалось получить publicUrl от Bitrix")
-
-        logger.info("Сгенерирован публичный URL счёта: %s", url_public)
-        return url_public
\ No newline at end of file
+    # 1. Создаём документ
+    doc_payload = {
+        "templateId":    4,        # ID шаблона «Счёт»
+        "entityTypeId":  2,        # 2 = Deal
+        "entityId":      deal_id,
+        "values":        [],       # доп. поля
+        "stampsEnabled": 0         # без печати/подписи
+    }
+    logger.info("Bitrix → crm.documentgenerator.document.add: %r", doc_payload)
+    result = await bitrix.call("crm.documentgenerator.document.add", doc_payload) or {}
+    document = result.get("document", {})
+    document_id = document.get("id")
+    if not document_id:
+        logger.error("Bitrix did not return document.id: %s", result)
+        raise RuntimeError("Не удалось получить document_id от Bitrix")
+
+    logger.info("Создан документ «Счёт», ID=%s", document_id)
+
+    # 2. Включаем публичный доступ
+    enable_payload = {"id": document_id, "status": 1}
+    logger.info("Bitrix → crm.documentgenerator.document.enablepublicurl: %r", enable_payload)
+    await bitrix.call("crm.documentgenerator.document.enablepublicurl", enable_payload)
+    logger.info("Публичная ссылка включена для документа %s", document_id)
+
+    # 3. Получаем публичный URL
+    get_payload = {"id": document_id}
+    logger.info("Bitrix → crm.documentgenerator.document.get.json: %r", get_payload)
+    result = await bitrix.call("crm.documentgenerator.document.get.json", get_payload) or {}
+    doc = result.get("document", {})
+    url_public = doc.get("publicUrl")
+    if not url_public:
+        logger.error("Bitrix did not return publicUrl: %s", result)
+        raise RuntimeError("Не удалось получить publicUrl от Bitrix")
+
+    logger.info("Сгенерирован публичный URL счёта: %s", url_public)
+    return url_public
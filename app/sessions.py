@@ -0,0 +1,141 @@
+# app/sessions.py
+
+import asyncio
+import logging
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from app.cache import LRUCache
+from app.config import get_settings
+from app.db import users_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class SessionCache:
+    """
+    In-process кэш пользовательских документов (state, active_order, …) для
+    машины состояний ботов. Ключ — (type, chat_id), LRU + TTL.
+
+    Все изменения пользователя идут через update(): запись сразу уходит в Mongo
+    и применяется к закэшированной копии (write-through). Каждая запись
+    увеличивает поле version; запись из кэша делается с условием на version,
+    поэтому устаревшая копия не перетрёт чужие изменения.
+
+    Изменения, сделанные другими воркерами, приходят через change stream
+    коллекции users: если version в событии не совпадает с нашей — копия
+    выбрасывается. Если change stream недоступен (standalone Mongo), кэш
+    чтений отключается и get() всегда читает из базы.
+    """
+
+    def __init__(self, collection, maxsize: int, ttl: int):
+        self.collection = collection
+        self._cache = LRUCache(maxsize, ttl)
+        self._keys = LRUCache(maxsize, ttl)  # _id → (type, chat_id) для событий change stream
+        self._watch_task: Optional[asyncio.Task] = None
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self) -> None:
+        self._watch_task = asyncio.create_task(self._watch(), name="session-watch")
+
+    async def stop(self) -> None:
+        self.enabled = False
+        if self._watch_task:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+
+    async def get(self, chat_id: int, bot_type: str) -> Optional[dict]:
+        key = (bot_type, chat_id)
+        if self.enabled:
+            user = self._cache.get(key)
+            if user is not None:
+                self.hits += 1
+                return user
+
+        self.misses += 1
+        user = await self.collection.find_one({"chat_id": chat_id, "type": bot_type})
+        if user:
+            self._remember(key, user)
+        return user
+
+    async def create(self, doc: dict) -> dict:
+        doc.setdefault("version", 0)
+        res = await self.collection.insert_one(doc)
+        doc["_id"] = res.inserted_id
+        self._remember((doc["type"], doc["chat_id"]), doc)
+        return doc
+
+    async def update(self, chat_id: int, bot_type: str, fields: dict) -> Optional[dict]:
+        """
+        Записывает fields ($set) в документ пользователя и возвращает
+        актуальную копию (или None, если пользователя нет).
+        """
+        key = (bot_type, chat_id)
+        cached = self._cache.get(key)
+        if cached is not None and "version" in cached:
+            res = await self.collection.update_one(
+                {"chat_id": chat_id, "type": bot_type, "version": cached["version"]},
+                {"$set": fields, "$inc": {"version": 1}}
+            )
+            if res.matched_count:
+                cached.update(fields)
+                cached["version"] += 1
+                return cached
+            # документ успели изменить в другом процессе — копия устарела
+            self._cache.pop(key)
+
+        user = await self.collection.find_one_and_update(
+            {"chat_id": chat_id, "type": bot_type},
+            {"$set": fields, "$inc": {"version": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if user:
+            self._remember(key, user)
+        return user
+
+    def invalidate(self, chat_id: int, bot_type: str) -> None:
+        self._cache.pop((bot_type, chat_id))
+
+    def _remember(self, key: tuple, user: dict) -> None:
+        self._cache.set(key, user)
+        self._keys.set(user["_id"], key)
+
+    async def _watch(self) -> None:
+        pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]
+        while True:
+            try:
+                async with self.collection.watch(pipeline) as stream:
+                    self.enabled = True
+                    logger.info("Session cache enabled (watching users change stream)")
+                    async for event in stream:
+                        self._on_change(event)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                if not self.enabled:
+                    logger.warning("Session cache disabled, change stream unavailable: %s", e)
+                    return
+                logger.error("Users change stream interrupted: %s", e)
+            # без потока изменений кэшу доверять нельзя
+            self.enabled = False
+            self._cache.clear()
+            await asyncio.sleep(1)
+
+    def _on_change(self, event: dict) -> None:
+        key = self._keys.get(event["documentKey"]["_id"])
+        if key is None:
+            return
+        cached = self._cache.get(key)
+        if cached is None:
+            return
+        updated = event.get("updateDescription", {}).get("updatedFields", {})
+        if event["operationType"] == "update" and updated.get("version") == cached.get("version"):
+            # это наша собственная запись — копия уже актуальна
+            return
+        self._cache.pop(key)
+
+sessions = SessionCache(users_collection, settings.SESSION_CACHE_SIZE, settings.SESSION_CACHE_TTL)
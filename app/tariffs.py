@@ -0,0 +1,253 @@
+# app/tariffs.py
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Iterator, NamedTuple, Optional
+
+import numpy as np
+from pymongo import DESCENDING
+from pymongo.errors import PyMongoError
+
+from app.config import get_settings
+from app.db import tariffs_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class TariffError(ValueError):
+    """Для склада / типа поставки нет тарифа."""
+
+class Rate(NamedTuple):
+    first: int       # за первую единицу
+    per_unit: int    # за каждую следующую
+    pickup_fee: int  # за забор, один раз на заявку
+
+    def cost(self, quantity: int) -> int:
+        if quantity <= 0:
+            return 0
+        return self.first + self.per_unit * (quantity - 1) + self.pickup_fee
+
+# Тип поставки: в заказах — boxes / pallets, в калькуляторе — подписи кнопок
+CARGO_TYPES = {
+    "boxes":   "boxes",
+    "Короба":  "boxes",
+    "pallets": "pallets",
+    "Палеты":  "pallets",
+}
+
+# Коды типов поставки для пакетного расчёта (quote_batch)
+CARGO_CODES = {"boxes": 0, "pallets": 1}
+
+_MOSCOW = ["Коледино", "Электросталь", "Подольск", "Подольск 4", "Обухово"]
+_NEAR = ["Владимир", "Тула", "Рязань"]
+_VOLGA = ["Казань", "Котовск"]
+_SAMARA = ["Новосемейкино"]
+
+def _rows(bot_type: str, box_rates: tuple[int, int, int, int]) -> list[dict]:
+    rows = [
+        {"type": bot_type, "cargo_type": "boxes", "warehouses": group,
+         "first": rate, "per_unit": rate, "pickup_fee": 500}
+        for group, rate in zip((_MOSCOW, _NEAR, _VOLGA, _SAMARA), box_rates)
+    ]
+    rows += [
+        {"type": bot_type, "cargo_type": "pallets", "warehouses": group,
+         "first": first, "per_unit": per_unit, "pickup_fee": 0}
+        for group, first, per_unit in (
+            (_MOSCOW, 3000, 1250),
+            (_NEAR,   4000, 2000),
+            (_VOLGA,  6000, 6000),
+            (_SAMARA, 7500, 7500),
+        )
+    ]
+    return rows
+
+# Встроенная таблица (версия 0) — действует, пока в коллекции tariffs нет своей
+DEFAULT_TARIFFS = {
+    "version": 0,
+    "rows": _rows("delivery", (200, 300, 500, 600)) + _rows("fulfilment", (182, 245, 400, 500)),
+}
+
+def compile_table(doc: dict) -> dict[tuple[str, str, str], Rate]:
+    """
+    Документ тарифов → {(тип бота, склад, тип поставки): Rate}.
+    Строка документа: {type, cargo_type, warehouses: [...], first, per_unit, pickup_fee}.
+    """
+    table = {}
+    for row in doc["rows"]:
+        rate = Rate(int(row["first"]), int(row["per_unit"]), int(row.get("pickup_fee", 0)))
+        cargo_type = CARGO_TYPES[row["cargo_type"]]
+        for warehouse in row["warehouses"]:
+            table[(row["type"], warehouse, cargo_type)] = rate
+    return table
+
+class TariffMatrix:
+    """
+    Та же таблица в виде массивов [склад × тип поставки] по каждому типу бота —
+    для пакетного расчёта numpy без цикла по заказам. Склады нумеруются
+    по порядку warehouses (ID склада = индекс в нём).
+    """
+
+    def __init__(self, table: dict[tuple[str, str, str], Rate]):
+        self.warehouses = sorted({wh for _, wh, _ in table})
+        self.warehouse_ids = {wh: i for i, wh in enumerate(self.warehouses)}
+        shape = (len(self.warehouses), len(CARGO_CODES))
+        self.rates: dict[str, np.ndarray] = {}
+        self.known: dict[str, np.ndarray] = {}
+        for (bot_type, wh, cargo), rate in table.items():
+            if bot_type not in self.rates:
+                self.rates[bot_type] = np.zeros(shape + (3,), dtype=np.int64)
+                self.known[bot_type] = np.zeros(shape, dtype=bool)
+            idx = (self.warehouse_ids[wh], CARGO_CODES[cargo])
+            self.rates[bot_type][idx] = rate
+            self.known[bot_type][idx] = True
+
+    def quote(self, bot_type: str, warehouse_ids: np.ndarray, cargo_codes: np.ndarray,
+              quantities: np.ndarray) -> np.ndarray:
+        rates = self.rates.get(bot_type)
+        if rates is None:
+            raise TariffError(f"Нет тарифов для {bot_type}")
+        warehouse_ids = np.asarray(warehouse_ids, dtype=np.intp)
+        cargo_codes = np.asarray(cargo_codes, dtype=np.intp)
+        quantities = np.asarray(quantities, dtype=np.int64)
+        if not warehouse_ids.shape == cargo_codes.shape == quantities.shape:
+            raise TariffError(
+                f"Массивы разной длины: склады {warehouse_ids.shape}, "
+                f"типы {cargo_codes.shape}, количества {quantities.shape}"
+            )
+        if warehouse_ids.size and (
+            warehouse_ids.min() < 0 or warehouse_ids.max() >= len(self.warehouses)
+            or cargo_codes.min() < 0 or cargo_codes.max() >= len(CARGO_CODES)
+        ):
+            raise TariffError("Неизвестный ID склада или код типа поставки")
+        missing = ~self.known[bot_type][warehouse_ids, cargo_codes]
+        if missing.any():
+            i = int(np.argmax(missing))
+            raise TariffError(
+                f"Нет тарифа ({bot_type}, {cargo_codes[i]}) для склада: {self.warehouses[warehouse_ids[i]]}"
+            )
+        r = rates[warehouse_ids, cargo_codes]
+        cost = r[..., 0] + r[..., 1] * (quantities - 1) + r[..., 2]
+        return np.where(quantities > 0, cost, 0)
+
+class TariffEngine:
+    """
+    Тарифы доставки: таблица из коллекции tariffs (документ с наибольшим
+    version), скомпилированная в словарь — quote() это один поиск по ключу.
+
+    Процесс раз в poll_interval секунд проверяет номер последней версии
+    и, если он сменился, перечитывает и перекомпилирует таблицу. Чтобы
+    поменять тарифы, достаточно вставить документ с большим version.
+    Битая таблица в Mongo не применяется — остаётся действующая.
+    """
+
+    def __init__(self, collection, poll_interval: float):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.version = DEFAULT_TARIFFS["version"]
+        self._table = compile_table(DEFAULT_TARIFFS)
+        self._matrix = TariffMatrix(self._table)
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        try:
+            await self.reload()
+        except PyMongoError as e:
+            logger.error("Cannot load tariffs, using version %s: %s", self.version, e)
+        self._poll_task = asyncio.create_task(self._poll(), name="tariffs-poll")
+
+    async def stop(self) -> None:
+        if self._poll_task:
+            self._poll_task.cancel()
+            await asyncio.gather(self._poll_task, return_exceptions=True)
+            self._poll_task = None
+
+    def quote(self, bot_type: str, warehouse: str, cargo_type: str, quantity: int) -> int:
+        """
+        Стоимость доставки в рублях.
+        :raises TariffError: неизвестный тип поставки или нет тарифа для склада
+        """
+        cargo = CARGO_TYPES.get(cargo_type)
+        if cargo is None:
+            raise TariffError(f"Неизвестный тип поставки: {cargo_type}")
+        rate = self._table.get((bot_type, warehouse, cargo))
+        if rate is None:
+            raise TariffError(f"Нет тарифа ({bot_type}, {cargo}) для склада: {warehouse}")
+        return rate.cost(quantity)
+
+    @property
+    def warehouses(self) -> list[str]:
+        """Склады по порядку их ID для quote_batch()."""
+        return self._matrix.warehouses
+
+    def warehouse_ids(self, warehouses: list[str]) -> np.ndarray:
+        ids = self._matrix.warehouse_ids
+        try:
+            return np.array([ids[wh] for wh in warehouses], dtype=np.intp)
+        except KeyError as e:
+            raise TariffError(f"Нет тарифа для склада: {e.args[0]}") from None
+
+    def quote_batch(self, bot_type: str, warehouse_ids: np.ndarray, cargo_codes: np.ndarray,
+                    quantities: np.ndarray) -> np.ndarray:
+        """
+        Стоимость для массивов одинаковой длины: ID склада (см. warehouses),
+        код типа поставки (CARGO_CODES) и количество. Совпадает с quote()
+        поэлементно (см. tests/test_tariffs.py).
+        :raises TariffError: массивы разной длины или в них есть склад / тип без тарифа
+        """
+        return self._matrix.quote(bot_type, warehouse_ids, cargo_codes, quantities)
+
+    def price_list(self, bot_type: str, max_quantity: int) -> Iterator[list[tuple[str, str, int, int]]]:
+        """
+        Прайс-лист склад × тип поставки × количество 1..max_quantity,
+        по одной пачке строк (склад, тип, количество, стоимость) на склад.
+        """
+        matrix = self._matrix
+        known = matrix.known.get(bot_type)
+        if known is None:
+            raise TariffError(f"Нет тарифов для {bot_type}")
+        q = np.arange(1, max_quantity + 1)
+        for wh_id, wh in enumerate(matrix.warehouses):
+            rows = []
+            for cargo, code in CARGO_CODES.items():
+                if not known[wh_id, code]:
+                    continue
+                costs = matrix.quote(bot_type, np.full_like(q, wh_id), np.full_like(q, code), q)
+                rows.extend(zip([wh] * len(q), [cargo] * len(q), q.tolist(), costs.tolist()))
+            if rows:
+                yield rows
+
+    async def reload(self) -> bool:
+        """Применяет последнюю версию из Mongo, если она новее текущей."""
+        latest = await self.collection.find_one(sort=[("version", DESCENDING)], projection={"version": 1})
+        if latest is None or latest["version"] == self.version:
+            return False
+        doc = await self.collection.find_one({"_id": latest["_id"]})
+        try:
+            table = compile_table(doc)
+            matrix = TariffMatrix(table)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Tariffs version %s is invalid, keeping %s: %s", doc["version"], self.version, e)
+            return False
+        self._table, self._matrix, self.version = table, matrix, doc["version"]
+        logger.info("Tariffs version %s loaded (%s rates)", self.version, len(table))
+        return True
+
+    async def publish(self, rows: list[dict]) -> int:
+        """Сохраняет новую версию таблицы (после проверки) и возвращает её номер."""
+        doc = {"rows": rows}
+        compile_table(doc)
+        latest = await self.collection.find_one(sort=[("version", DESCENDING)], projection={"version": 1})
+        doc.update(version=(latest["version"] if latest else 0) + 1, created_at=datetime.utcnow())
+        await self.collection.insert_one(doc)
+        return doc["version"]
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except PyMongoError as e:
+                logger.warning("Tariffs reload failed: %s", e)
+
+tariffs = TariffEngine(tariffs_collection, settings.TARIFFS_POLL_INTERVAL)
@@ -0,0 +1,49 @@
+# app/telegram.py
+
+import msgspec
+
+# Типизированные апдейты Telegram.
+# Описаны только поля, которые реально читают хендлеры: всё остальное
+# (entities, date, language_code, photo…) декодер пропускает, не создавая объектов.
+# gc=False — структуры без циклов, сборщику мусора их отслеживать не нужно.
+
+class Chat(msgspec.Struct, gc=False):
+    id: int
+    username: str | None = None
+    first_name: str | None = None
+    last_name: str | None = None
+
+class User(msgspec.Struct, gc=False):
+    id: int
+    username: str | None = None
+    first_name: str | None = None
+    last_name: str | None = None
+
+class Contact(msgspec.Struct, gc=False):
+    phone_number: str
+
+class Message(msgspec.Struct, gc=False):
+    message_id: int
+    chat: Chat
+    from_: User | None = msgspec.field(default=None, name="from")
+    text: str = ""
+    contact: Contact | None = None
+
+class CallbackQuery(msgspec.Struct, gc=False):
+    id: str
+    from_: User = msgspec.field(name="from")
+    data: str = ""
+
+class Update(msgspec.Struct, gc=False):
+    update_id: int
+    message: Message | None = None
+    callback_query: CallbackQuery | None = None
+
+_update_decoder = msgspec.json.Decoder(Update)
+
+def decode_update(body: bytes) -> Update:
+    """
+    Декодирует тело вебхука прямо из bytes в Update.
+    :raises msgspec.DecodeError: битый JSON или не та структура
+    """
+    return _update_decoder.decode(body)
@@ -0,0 +1,161 @@
+# app/updates.py
+
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from pymongo.errors import DuplicateKeyError
+
+from app.cache import LRUCache
+from app.config import get_settings
+from app.db import updates_collection
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+Job = tuple[Callable[..., Awaitable[Any]], tuple]
+
+class UpdateQueue:
+    """
+    Фоновая очередь апдейтов Telegram.
+
+    Вебхук только кладёт апдейт в очередь и сразу отвечает 200.
+    Пул воркеров разбирает очередь: апдейты одного chat_id выполняются
+    строго по порядку, разные чаты — параллельно.
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._pending: dict[int, deque[Job]] = {}   # chat_id → апдейты в порядке поступления
+        self._ready: asyncio.Queue | None = None     # chat_id, готовые к обработке
+        self._tasks: list[asyncio.Task] = []
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"update-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info("Update queue started with %s workers", self.workers)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        # даём воркерам дообработать уже принятые апдейты
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._size and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self._size:
+            logger.warning("Update queue stopped with %s unprocessed updates", self._size)
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, chat_id: int, handler: Callable[..., Awaitable[Any]], *args) -> bool:
+        """
+        Ставит handler(*args) в очередь чата chat_id.
+        Возвращает False, если очередь переполнена.
+        """
+        if self._size >= self.maxsize:
+            logger.error("Update queue is full (%s), rejecting update for chat %s", self._size, chat_id)
+            return False
+        if not self._tasks:
+            self.start()
+
+        self._size += 1
+        jobs = self._pending.get(chat_id)
+        if jobs is not None:
+            # чат уже ждёт в очереди или обрабатывается — просто дописываем в хвост
+            jobs.append((handler, args))
+            return True
+
+        self._pending[chat_id] = deque([(handler, args)])
+        self._ready.put_nowait(chat_id)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._pending[chat_id]
+            handler, args = jobs[0]
+            try:
+                await handler(*args)
+            except Exception:
+                logger.exception("Update handler %s failed for chat %s", handler.__name__, chat_id)
+            finally:
+                jobs.popleft()
+                self._size -= 1
+                if jobs:
+                    # следующий апдейт чата — в конец общей очереди, чтобы не держать других
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._pending[chat_id]
+
+class UpdateDeduplicator:
+    """
+    Отбрасывает повторно доставленные апдейты Telegram по update_id.
+
+    Сначала проверяется локальный набор недавних id (без похода в базу),
+    затем id «застолбляется» вставкой в коллекцию updates с уникальным _id —
+    так повтор, пришедший в другой воркер uvicorn, тоже будет отброшен.
+    Записи удаляются TTL-индексом по created_at (см. app/indexes.py).
+    Если апдейт принять не удалось (очередь переполнена, отвечаем 503),
+    id снимается через forget() — иначе повтор от Telegram был бы отброшен.
+    """
+
+    def __init__(self, collection, maxsize: int, ttl: int):
+        self.collection = collection
+        self._recent = LRUCache(maxsize, ttl)
+        self.dropped = 0
+
+    async def is_duplicate(self, bot_type: str, update_id: int | None) -> bool:
+        if update_id is None:
+            return False
+
+        key = f"{bot_type}:{update_id}"
+        if key in self._recent:
+            return self._drop(key)
+        self._recent.set(key, True)
+
+        try:
+            await self.collection.insert_one({"_id": key, "created_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            return self._drop(key)
+        except Exception as e:
+            # база недоступна — лучше обработать апдейт, чем потерять его
+            logger.error("Update dedup insert failed for %s: %s", key, e)
+        return False
+
+    async def forget(self, bot_type: str, update_id: int | None) -> None:
+        """Снимает отметку с апдейта, который не был принят в обработку."""
+        if update_id is None:
+            return
+        key = f"{bot_type}:{update_id}"
+        self._recent.pop(key)
+        try:
+            await self.collection.delete_one({"_id": key})
+        except Exception as e:
+            logger.error("Update dedup delete failed for %s: %s", key, e)
+
+    def _drop(self, key: str) -> bool:
+        self.dropped += 1
+        logger.info("Dropped duplicate update %s (total dropped: %s)", key, self.dropped)
+        return True
+
+update_queue = UpdateQueue(settings.UPDATE_WORKERS, settings.UPDATE_QUEUE_SIZE)
+update_dedup = UpdateDeduplicator(
+    updates_collection,
+    settings.UPDATE_DEDUP_CACHE_SIZE,
+    settings.UPDATE_DEDUP_TTL,
+)
@@ -0,0 +1,76 @@
+# bench/decode_updates.py
+#
+# Микробенчмарк разбора апдейта Telegram на горячем пути вебхука:
+#   - old:    json.loads(body) (так делает Request.json()) + цепочки dict.get
+#             + форматирование всего payload для logger.info("%s", data)
+#   - msgspec: app.telegram.decode_update(body) + доступ к атрибутам
+#
+# Запуск из корня репозитория:
+#   python bench/decode_updates.py
+
+import json
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.telegram import decode_update  # noqa: E402
+
+UPDATE = {
+    "update_id": 912345678,
+    "message": {
+        "message_id": 4521,
+        "from": {
+            "id": 123456789, "is_bot": False, "first_name": "Иван",
+            "last_name": "Петров", "username": "ivan_petrov", "language_code": "ru",
+            "is_premium": True,
+        },
+        "chat": {
+            "id": 123456789, "first_name": "Иван", "last_name": "Петров",
+            "username": "ivan_petrov", "type": "private",
+        },
+        "date": 1760000000,
+        "text": "📨 Отправить заявку",
+        "entities": [{"offset": 0, "length": 2, "type": "custom_emoji", "custom_emoji_id": "5368324170671202286"}],
+        "reply_to_message": {
+            "message_id": 4520,
+            "from": {"id": 7000000001, "is_bot": True, "first_name": "Ecomdelivery", "username": "ecom_bot"},
+            "chat": {"id": 123456789, "type": "private"},
+            "date": 1759999990,
+            "text": "📋 Проверьте данные заявки:\n" + "🏢 Организация: ООО «Ромашка»\n" * 10,
+        },
+    },
+}
+BODY = json.dumps(UPDATE, ensure_ascii=False).encode()
+
+def old_path():
+    data = json.loads(BODY)
+    "%s" % (data,)
+    message = data.get("message", {})
+    text    = message.get("text", "")
+    contact = message.get("contact")
+    chat_id = message.get("chat", {}).get("id")
+    return chat_id, text.strip(), contact
+
+def new_path():
+    update = decode_update(BODY)
+    message = update.message
+    return message.chat.id, message.text.strip(), message.contact
+
+def measure(name, fn, number=100_000):
+    best = min(timeit.repeat(fn, number=number, repeat=5))
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:8s} {best / number * 1e6:8.2f} µs/update   peak alloc {peak:6d} B")
+    return best
+
+if __name__ == "__main__":
+    assert old_path()[:2] == new_path()[:2]
+    print(f"payload: {len(BODY)} bytes")
+    t_old = measure("old", old_path)
+    t_new = measure("msgspec", new_path)
+    print(f"speedup: x{t_old / t_new:.1f}")
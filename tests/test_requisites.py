@@ -0,0 +1,50 @@
+import pytest
+
+from app.requisites import account_key_valid, check_account, check_inn, validate_requisites
+
+@pytest.mark.parametrize("inn", [
+    "7707083893",    # ПАО Сбербанк
+    "7736050003",
+    "7830002293",
+    "500100732259",  # ИП
+])
+def test_valid_inn(inn):
+    assert check_inn(inn) is None
+
+@pytest.mark.parametrize("inn, error", [
+    ("7707083894", "Неверные контрольные цифры ИНН."),
+    ("500100732258", "Неверные контрольные цифры ИНН."),
+    ("500100732249", "Неверные контрольные цифры ИНН."),  # 11-я цифра
+    ("770708389", "ИНН должен состоять из 10 или 12 цифр."),
+    ("77070838931", "ИНН должен состоять из 10 или 12 цифр."),
+    ("77070838ab", "ИНН должен состоять из 10 или 12 цифр."),
+])
+def test_invalid_inn(inn, error):
+    assert check_inn(inn) == error
+
+@pytest.mark.parametrize("rs, bik, valid", [
+    # коммерческий банк: ключ считается от трёх последних цифр БИК
+    ("40702810038000017240", "044525225", True),
+    ("40702810538000017240", "044525225", False),
+    ("40702810038000017240", "044525593", False),
+    # подразделение ЦБ (РКЦ): «0» + 5–6 цифры БИК
+    ("40101810045250010041", "044525000", True),
+    ("40101810145250010041", "044525000", False),
+])
+def test_account_key(rs, bik, valid):
+    assert account_key_valid(rs, bik) is valid
+
+def test_check_account_format():
+    assert check_account("40702810038000017240") is None
+    assert check_account("4070281003800001724") == "Расчётный счёт должен состоять из 20 цифр."
+
+def test_validate_requisites():
+    assert validate_requisites("7707083893", "40702810038000017240", "044525225") == {}
+    assert validate_requisites("7707083893", "40702810538000017240", "044525225") == {
+        "rs": "Расчётный счёт не соответствует БИК банка.",
+    }
+    # ключ счёта не проверяется, пока неверен сам БИК
+    assert validate_requisites(None, "40702810538000017240", "1234") == {
+        "bik": "БИК должен состоять из 9 цифр.",
+    }
+    assert validate_requisites("", None, None) == {}
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from app.tariffs import CARGO_CODES, DEFAULT_TARIFFS, TariffEngine, TariffError
+
+QUANTITIES = list(range(0, 61))
+
+@pytest.fixture
+def engine():
+    # без Mongo: действует встроенная таблица (версия 0)
+    return TariffEngine(collection=None, poll_interval=30)
+
+@pytest.mark.parametrize("bot_type", ["delivery", "fulfilment"])
+def test_quote_batch_matches_quote(engine, bot_type):
+    warehouses, cargo_types, quantities, expected = [], [], [], []
+    for wh in engine.warehouses:
+        for cargo in CARGO_CODES:
+            for q in QUANTITIES:
+                warehouses.append(wh)
+                cargo_types.append(cargo)
+                quantities.append(q)
+                expected.append(engine.quote(bot_type, wh, cargo, q))
+
+    batch = engine.quote_batch(
+        bot_type,
+        engine.warehouse_ids(warehouses),
+        np.array([CARGO_CODES[c] for c in cargo_types]),
+        np.array(quantities),
+    )
+    assert batch.tolist() == expected
+
+def test_quote_batch_covers_every_warehouse(engine):
+    listed = {wh for row in DEFAULT_TARIFFS["rows"] for wh in row["warehouses"]}
+    assert set(engine.warehouses) == listed
+
+def test_quote_batch_empty(engine):
+    assert engine.quote_batch("delivery", [], [], []).tolist() == []
+
+@pytest.mark.parametrize("ids, codes, quantities", [
+    ([0], [], [1]),
+    ([0, 1], [0, 0], [1]),
+    ([], [0], []),
+])
+def test_quote_batch_length_mismatch(engine, ids, codes, quantities):
+    with pytest.raises(TariffError):
+        engine.quote_batch("delivery", ids, codes, quantities)
+
+def test_quote_batch_unknown_ids(engine):
+    with pytest.raises(TariffError):
+        engine.quote_batch("delivery", [len(engine.warehouses)], [0], [1])
+    with pytest.raises(TariffError):
+        engine.quote_batch("delivery", [0], [len(CARGO_CODES)], [1])
+    with pytest.raises(TariffError):
+        engine.quote_batch("unknown", [0], [0], [1])
+
+def test_unknown_warehouse(engine):
+    with pytest.raises(TariffError):
+        engine.warehouse_ids(["Нет такого"])
+    with pytest.raises(TariffError):
+        engine.quote("delivery", "Нет такого", "boxes", 1)